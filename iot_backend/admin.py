@@ -1,7 +1,90 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+
+from .guardrails import estimated_count
+from .models import DeviceType, Device, Log, Rule, RuleEvent
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator counting the objects with estimated_count."""
+
+    @cached_property
+    def count(self):
+        return estimated_count(self.object_list)
+
+
+class KeysetChangeList(ChangeList):
+    """ChangeList paging through the rows by primary key instead of OFFSET.
+
+    Rows are always ordered by descending primary key, the next page is selected by the '<pk>__lt' lookup
+    (ex. ?id__lt=1234) so each page is read from the primary key index whatever its position.
+    """
+
+    def get_ordering(self, request, queryset):
+        return ['-pk']
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        rows = list(self.queryset[:self.list_per_page + 1])
+        keyset_var = f'{self.lookup_opts.pk.attname}__lt'
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = rows[:self.list_per_page]
+        self.can_show_all = False
+        self.multi_page = len(rows) > self.list_per_page
+        self.paginator = paginator
+
+        # links used by the pagination block of keyset_change_list.html
+        self.next_page_url = None
+        if self.multi_page:
+            self.next_page_url = self.get_query_string({keyset_var: self.result_list[-1].pk}, [PAGE_VAR])
+
+        self.first_page_url = None
+        if keyset_var in self.params:
+            self.first_page_url = self.get_query_string(remove=[keyset_var, PAGE_VAR])
+
+
+class KeysetModelAdmin(admin.ModelAdmin):
+    """ModelAdmin for big tables: estimated counts and keyset pagination (see KeysetChangeList)."""
+    change_list_template = 'admin/iot_backend/keyset_change_list.html'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+@admin.register(Device)
+class DeviceAdmin(KeysetModelAdmin):
+    list_display = ('pk', 'serial_number', 'type', 'owner', 'registration_datetime', 'aws_thing_name',
+                    'shadow_version', 'stale_shadow_updates')
+    list_select_related = ('type', 'owner')
+    list_filter = ('type',)
+    raw_id_fields = ('owner',)
+    search_fields = ('=serial_number', '=aws_thing_name')
+
+
+@admin.register(Log)
+class LogAdmin(KeysetModelAdmin):
+    list_display = ('pk', 'reception_datetime', 'device')
+    list_select_related = ('device__type',)
+    # date ranges (today, past 7 days, ...) read through the reception datetime index
+    list_filter = ('reception_datetime',)
+    raw_id_fields = ('device',)
+
+
+@admin.register(RuleEvent)
+class RuleEventAdmin(KeysetModelAdmin):
+    list_display = ('pk', 'event_datetime', 'rule', 'device', 'value', 'measure')
+    list_select_related = ('rule__device_type', 'device__type')
+    list_filter = ('event_datetime',)
+    raw_id_fields = ('device', 'log')
 
-from .models import DeviceType, Device, Log
 
 admin.site.register(DeviceType)
-admin.site.register(Device)
-admin.site.register(Log)
+admin.site.register(Rule)
@@ -0,0 +1,184 @@
+"""
+This module detects the logs delivered more than once (AWS IoT rule actions deliver at least once).
+
+A log is identified by its device and its message identifier (see log_message_id), the pair is unique in the Log table
+(logs without an identifier are never considered duplicates). Checking the table before each insert would cost a
+query per log, inserting blindly a failed insert (and a dead row) per duplicate: each process remembers instead the
+identifiers it has seen recently in a time-windowed Bloom filter.
+
+The filter has two generations: identifiers are added to the current one and looked up in both, the current one
+becomes the previous one every settings.IOT_DEDUP_WINDOW_SECONDS (or when it holds settings.IOT_DEDUP_CAPACITY
+identifiers), so each identifier is remembered for one to two windows with a false positive rate of about
+FALSE_POSITIVE_RATE, in about 1.2 MB per million identifiers.
+
+A new identifier is never in the filter: the log is inserted without further checks. A duplicate delivered to the
+same process within the window is in the filter: the database confirms it with an index lookup (a false positive
+only costs that lookup) and the log is dropped. Duplicates delivered to other processes are rejected by the unique
+index.
+"""
+
+from functools import reduce
+from hashlib import blake2b
+import math
+from operator import or_
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import connections, transaction, IntegrityError
+from django.db.models import Q
+
+from .models import Log
+
+# target false positive rate of each generation of the filter
+FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter:
+    """A Bloom filter of strings."""
+
+    def __init__(self, capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+        self.size = max(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RecentMessages:
+    """Thread-safe time-windowed filter of the recently seen message identifiers (two generations of Bloom filters)."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._current = None
+        self._previous = None
+        self._started = 0.0
+
+    def _rotate(self):
+        capacity = getattr(settings, 'IOT_DEDUP_CAPACITY', 1000000)
+        if (self._current is None or self._current.count >= capacity or
+                monotonic() - self._started >= getattr(settings, 'IOT_DEDUP_WINDOW_SECONDS', 600)):
+            self._previous = self._current
+            self._current = BloomFilter(capacity)
+            self._started = monotonic()
+
+    def seen(self, key):
+        """Adds a key to the filter, returns True if it may have been added before (False if it surely wasn't)."""
+        with self._lock:
+            self._rotate()
+            if key in self._current or (self._previous is not None and key in self._previous):
+                return True
+
+            self._current.add(key)
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._current = self._previous = None
+
+
+recent_messages = RecentMessages()
+
+
+def may_be_duplicate(log):
+    """Returns True if the (unsaved) Log may have already been saved, and remembers it.
+
+    Logs without a message identifier are never duplicates.
+    """
+    if log.message_id is None:
+        return False
+
+    return recent_messages.seen(f'{log.device_id}:{log.message_id}')
+
+
+def drop_duplicates(logs, using):
+    """Returns the (unsaved) Logs of a batch which are not duplicates of saved logs or of other logs of the batch.
+
+    :param logs: List of Logs.
+    :param using: Alias of the database storing the logs.
+    """
+    new_logs = []
+    batch_keys = set()
+    maybe_saved = {}
+    for log in logs:
+        if log.message_id is not None:
+            key = (log.device_id, log.message_id)
+            if key in batch_keys:
+                continue
+            batch_keys.add(key)
+            if may_be_duplicate(log):
+                maybe_saved.setdefault(log.device_id, []).append(log.message_id)
+        new_logs.append(log)
+
+    if not maybe_saved:
+        return new_logs
+
+    # one query through the unique index for the whole batch
+    query = reduce(or_, (Q(device_id=device_pk, message_id__in=message_ids)
+                         for device_pk, message_ids in maybe_saved.items()))
+    saved = set(Log.objects.using(using).filter(query).values_list('device_id', 'message_id'))
+
+    return [log for log in new_logs if (log.device_id, log.message_id) not in saved]
+
+
+def is_saved(log, using):
+    """Returns True if a log with the same device and message identifier as the (unsaved) Log is saved."""
+    if log.message_id is None:
+        return False
+
+    return Log.objects.using(using).filter(device_id=log.device_id, message_id=log.message_id).exists()
+
+
+def save_logs(logs, using):
+    """Saves the Logs of a batch which are not duplicates (see drop_duplicates).
+
+    Duplicates saved concurrently by other processes are rejected by the unique index: the batch is then saved again
+    one log at a time, skipping them. Other integrity errors (ex. a deleted device) are raised.
+
+    :param logs: List of (unsaved) Logs.
+    :param using: Alias of the database storing the logs.
+    :return: The list of saved Logs.
+    """
+    logs = drop_duplicates(logs, using)
+    if not logs:
+        return logs
+
+    try:
+        with transaction.atomic(using=using):
+            # saved logs need their primary keys (ex. for the rules' events)
+            if connections[using].features.can_return_rows_from_bulk_insert:
+                Log.objects.using(using).bulk_create(logs)
+            else:
+                for log in logs:
+                    log.save(using=using)
+
+        return logs
+
+    except IntegrityError:
+        saved = []
+        for log in logs:
+            log.pk = None
+            try:
+                with transaction.atomic(using=using):
+                    log.save(using=using)
+                saved.append(log)
+
+            except IntegrityError:
+                if not is_saved(log, using):
+                    raise
+                print(f"Duplicate log from device with pk={log.device_id}: {log.message_id}")
+
+        return saved
@@ -0,0 +1,207 @@
+"""
+Cost guardrails of the analytical views, whose attributes and devices are lists chosen by the clients.
+
+A request is rejected (400 Bad Request) if it lists more than settings.IOT_QUERY_MAX_ATTRIBUTES attributes or more than
+settings.IOT_QUERY_MAX_DEVICES devices (see split_attributes and split_pks).
+
+The cost of a query is estimated as rows * attributes * passes (the rows are the planner's estimate on PostgreSQL, see
+estimated_count, each row's log file is decoded once for each attribute and pass). Queries costing more than
+settings.IOT_QUERY_COST_BUDGET are run on a random sample of the logs (about 1 every n, see sample_logs), the
+sampling rate is returned to the clients. Queries needing a sampling rate greater than
+settings.IOT_QUERY_MAX_SAMPLING are rejected.
+
+Finally, the views decorated with query_guardrails run their queries with a statement timeout of
+settings.IOT_QUERY_STATEMENT_TIMEOUT_MS milliseconds (PostgreSQL only): a query running longer is canceled and the
+request is answered with 503 Service Unavailable, freeing the worker and its database connection.
+"""
+
+import json
+from contextlib import contextmanager, ExitStack
+from contextvars import ContextVar
+from functools import wraps
+from math import ceil
+
+from django.conf import settings
+from django.db import connections, OperationalError
+from django.db.models import BigIntegerField, ExpressionWrapper, F
+from django.db.models.expressions import Random
+from django.db.models.functions import Abs
+from django.http import HttpResponse
+
+from . import sharding
+
+# statement timeout (milliseconds) of the running view decorated with query_guardrails
+_statement_timeout = ContextVar('iot_statement_timeout', default=None)
+
+
+class QueryTooExpensive(Exception):
+    """Raised when a request exceeds the limits of the guardrails (answered with 400 Bad Request)."""
+
+
+def estimated_count(queryset):
+    """Returns the planner's estimate of the number of rows of the queryset on PostgreSQL, the exact count otherwise.
+
+    The estimate avoids the full scan of an exact COUNT(*) on big tables.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return plan[0]['Plan']['Plan Rows']
+
+
+def split_attributes(attributes):
+    """Returns the list of attributes of an url segment (separated by '&').
+
+    :raise QueryTooExpensive: If there are more than settings.IOT_QUERY_MAX_ATTRIBUTES attributes.
+    """
+    attr_list = attributes.split('&')
+    max_attributes = getattr(settings, 'IOT_QUERY_MAX_ATTRIBUTES', 50)
+    if len(attr_list) > max_attributes:
+        raise QueryTooExpensive(f"Too many attributes: {len(attr_list)} (max {max_attributes})")
+
+    return attr_list
+
+
+def split_pks(pks, max_devices=None):
+    """Returns the list of devices' pks (int) of an url segment (separated by '&').
+
+    :param pks: The url segment.
+    :param max_devices: Max number of devices, settings.IOT_QUERY_MAX_DEVICES if None.
+    :raise QueryTooExpensive: If there are more than max_devices devices.
+    :raise ValueError: If a pk is not an integer.
+    """
+    pk_list = [int(pk) for pk in pks.split('&')]
+    if max_devices is None:
+        max_devices = getattr(settings, 'IOT_QUERY_MAX_DEVICES', 100)
+    if len(pk_list) > max_devices:
+        raise QueryTooExpensive(f"Too many devices: {len(pk_list)} (max {max_devices})")
+
+    return pk_list
+
+
+def estimate_rows(device_pks, log_filter=None):
+    """Returns the estimated number of logs of the given devices (on all their shards).
+
+    :param device_pks: Primary keys of the devices.
+    :param log_filter: Dictionary of other filters of the logs (ex. time range).
+    """
+    return sum(sharding.scatter_logs(device_pks, lambda logs: [estimated_count(logs.filter(**(log_filter or {})))]))
+
+
+def sampling_rate(rows, attributes, passes=1):
+    """Returns the sampling rate n (1 every n logs) which keeps a query within settings.IOT_QUERY_COST_BUDGET.
+
+    :param rows: Estimated number of logs read by the query.
+    :param attributes: Number of attributes extracted from each log.
+    :param passes: Number of times the logs are read (ex. one query for each action).
+    :return: An int, 1 if the query is within the budget.
+    :raise QueryTooExpensive: If the sampling rate is greater than settings.IOT_QUERY_MAX_SAMPLING.
+    """
+    cost = rows * max(attributes, 1) * passes
+    rate = max(ceil(cost / getattr(settings, 'IOT_QUERY_COST_BUDGET', 10 ** 7)), 1)
+
+    max_sampling = getattr(settings, 'IOT_QUERY_MAX_SAMPLING', 1000)
+    if rate > max_sampling:
+        raise QueryTooExpensive(f"The query is too expensive: {rows} logs * {attributes} attributes * {passes} passes"
+                                f" (sampling rate {rate} > {max_sampling})")
+
+    return rate
+
+
+def sample_logs(logs, rate):
+    """Returns a random sample of the logs of the queryset, each log is kept with probability 1 / rate (all of them if
+    rate is 1).
+
+    Each log is drawn independently: whatever the order the devices' logs are stored in, each device keeps about
+    1 every rate of its logs (a regular pattern of the primary keys, ex. devices logging in turn, can't bias the
+    sample). The sample is filtered before the logs' files are decoded, which is the cost bounded by the budget; the
+    rows scanned are bounded by the statement timeout.
+    """
+    if rate == 1:
+        return logs
+
+    if connections[logs.db].vendor == 'sqlite':
+        # RANDOM() is a signed 64 bits integer on SQLite (taken modulo rate with the integer operator, MOD converts
+        # it to a float), the draw depends on the log's pk or SQLite evaluates it only once per query when the logs
+        # are joined with other tables
+        draw = ExpressionWrapper(Random() - F('pk'), output_field=BigIntegerField())
+        draw = ExpressionWrapper(Abs(draw) % rate, output_field=BigIntegerField())
+        return logs.annotate(sample_draw=draw).filter(sample_draw=0)
+
+    return logs.annotate(sample_draw=Random()).filter(sample_draw__lt=1 / rate)
+
+
+@contextmanager
+def statement_timeout(alias):
+    """Applies the statement timeout of the running view (see query_guardrails) to a connection while in the block.
+
+    The timeout is set just before the first query of the block: the connections not used by the view are neither
+    opened nor changed.
+    """
+    milliseconds = _statement_timeout.get()
+    connection = connections[alias]
+    if milliseconds is None or connection.vendor != 'postgresql':
+        yield
+        return
+
+    applied = False
+
+    def set_timeout(execute, sql, params, many, context):
+        nonlocal applied
+        if not applied:
+            applied = True
+            with connection.cursor() as cursor:
+                cursor.execute('SET statement_timeout = %s', [milliseconds])
+
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(set_timeout):
+        try:
+            yield
+        finally:
+            # the timeout lasts as long as the session, the other requests served by the connection must not inherit it
+            if applied and connection.connection is not None and not connection.needs_rollback:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET statement_timeout TO DEFAULT')
+
+
+def query_guardrails(view):
+    """Decorator applying the guardrails to an analytical view (to be applied after use_read_replica).
+
+    QueryTooExpensive is answered with 400 Bad Request, a query canceled by the statement timeout with 503 Service
+    Unavailable.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = _statement_timeout.set(getattr(settings, 'IOT_QUERY_STATEMENT_TIMEOUT_MS', 30000) or None)
+        try:
+            with ExitStack() as stack:
+                # only the databases actually queried by the view get the timeout (see statement_timeout)
+                for alias in connections:
+                    stack.enter_context(statement_timeout(alias))
+
+                return view(request, *args, **kwargs)
+
+        except QueryTooExpensive as e:
+            print(f"Rejected {request.path}: {e}")
+            return HttpResponse(status=400)  # 400 Bad Request
+
+        except OperationalError as e:
+            if _statement_timeout.get() is None or 'statement timeout' not in str(e):
+                raise
+            print(f"Canceled {request.path}: {e}")
+            return HttpResponse(status=503)  # 503 Service Unavailable
+
+        finally:
+            _statement_timeout.reset(token)
+
+    return wrapper
@@ -0,0 +1,27 @@
+"""
+This module applies the steps following the save of new logs, shared by both ingest modes (save_device_log_data in
+'direct' mode, the 'ingest_spool' workers in 'spool' mode, see spool.py).
+"""
+
+from .models import DeviceLatestValues
+from . import livestream, recentcache, rules
+
+
+def process_saved_logs(logs):
+    """Updates the devices' latest values, evaluates the alerting rules, feeds the recent values cache and pushes
+    the logs to the live charts.
+
+    :param logs: List of newly saved Logs (duplicates excluded, see dedup.py).
+    """
+    # only the most recent log of each device is recorded as its latest values
+    latest = {}
+    for log in logs:
+        if log.device_id not in latest or log.reception_datetime >= latest[log.device_id].reception_datetime:
+            latest[log.device_id] = log
+    for log in latest.values():
+        DeviceLatestValues.record(log)
+
+    for log in logs:
+        rules.evaluate_log(log)
+        recentcache.record(log)
+    livestream.publish(logs)
@@ -0,0 +1,307 @@
+"""
+This module streams the logs saved by save_device_log_data to the chart pages with Server-Sent Events.
+
+Logs are published to a broker, which pushes each log to the subscribers of its device. Each subscriber keeps at most
+settings.IOT_STREAM_MAX_PENDING points not yet sent: a slow client never blocks the publisher, the oldest pending
+points are dropped instead (and the number of dropped points is sent with the next message).
+All the points pending when a client is woken up are coalesced into a single message.
+
+On PostgreSQL the logs are published with NOTIFY on the settings.IOT_STREAM_NOTIFY_CHANNEL channel of the 'default'
+database, and each process with subscribers LISTENs to it (in a thread started by the first subscriber): clients
+receive the logs saved by all the worker processes ('ingest_spool' workers included). The notifications of a batch of
+logs are sent with a single query, when the publisher's transaction commits, and are lost while a listener reconnects.
+On other databases the broker lives in the process: clients only receive the logs saved by the same process, so the
+application must be served by a single process (ex. the development server).
+
+Streams are served by the ASGI application returned by asgi_application (see iot_server/asgi.py), which waits for
+logs without holding a thread, or by the dev_attrs_log_stream view on WSGI servers (one thread per client, its
+database connections are closed before streaming).
+Streaming is disabled unless settings.IOT_STREAM_ENABLED is True (see enabled): the chart pages don't open streams, the
+stream URLs return 404 and the saved logs are not published (no notifications are sent). Enable it when the
+application is served by an ASGI server, or on WSGI servers with enough worker threads for a client of each open chart
+page.
+
+Messages have the form:
+
+    event: logs
+    data: {"rows": [[timestamp, value1, value2, ...], ...], "dropped": 0}
+
+where timestamp is the log's reception datetime as milliseconds since the Unix epoch and the values are the
+subscribed attributes' values (null if missing).
+"""
+
+import asyncio
+import json
+import re
+import select
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+
+from .models import Log
+
+# path of the streams (also routed to dev_attrs_log_stream in urls.py)
+STREAM_PATH = re.compile(r'^/iot/devices/stream/(?P<pk>\d+)/(?P<attributes>[^/]+)/$')
+
+# seconds between keepalive comments sent to idle clients
+KEEPALIVE_SECONDS = 15
+
+# database of the notifications (see the module's docstring)
+NOTIFY_DATABASE = 'default'
+
+# max size of a notification's payload (PostgreSQL limit: 8000 bytes), larger logs are read back by the listeners
+MAX_NOTIFY_PAYLOAD = 7900
+
+# seconds waited before reconnecting a failed listener
+LISTEN_RETRY_SECONDS = 5
+
+
+class Subscriber:
+    """A client subscribed to the logs of a device, with a bounded queue of pending points."""
+
+    def __init__(self, device_pk, attr_list, notify):
+        """
+        :param device_pk: Primary key of the device.
+        :param attr_list: List of names of the attributes to stream.
+        :param notify: Callable invoked (from any thread) when new points are pending.
+        """
+        self.device_pk = device_pk
+        self.attr_list = attr_list
+        self._notify = notify
+        self._lock = threading.Lock()
+        self._pending = deque(maxlen=getattr(settings, 'IOT_STREAM_MAX_PENDING', 100))
+        self._dropped = 0
+
+    def push(self, timestamp, log_file):
+        """Adds a point to the pending ones.
+
+        :param timestamp: The log's reception datetime as milliseconds since the Unix epoch.
+        :param log_file: The log's 'log_file' (dict).
+        """
+        point = [timestamp]
+        point.extend(log_file.get(attr) for attr in self.attr_list)
+
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self._dropped += 1
+            self._pending.append(point)
+
+        self._notify()
+
+    def drain_message(self):
+        """Returns the SSE message with all the pending points (None if there are none) and empties the queue."""
+        with self._lock:
+            if not self._pending:
+                return None
+            rows = list(self._pending)
+            dropped = self._dropped
+            self._pending.clear()
+            self._dropped = 0
+
+        data = json.dumps({'rows': rows, 'dropped': dropped}, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+        return f'event: logs\ndata: {data}\n\n'.encode()
+
+
+def enabled():
+    """Returns True if the live streams are enabled (see the module's docstring)."""
+    return getattr(settings, 'IOT_STREAM_ENABLED', False)
+
+
+def uses_notify():
+    """Returns True if the logs are published with PostgreSQL notifications (see the module's docstring)."""
+    return connections[NOTIFY_DATABASE].vendor == 'postgresql'
+
+
+class Broker:
+    """Thread-safe registry of the subscribers of each device."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._listener = None
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.setdefault(subscriber.device_pk, set()).add(subscriber)
+
+            if self._listener is None and uses_notify():
+                self._listener = threading.Thread(target=self._listen, name='livestream-listener', daemon=True)
+                self._listener.start()
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.device_pk, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(subscriber.device_pk, None)
+
+    def publish(self, logs):
+        """Publishes the logs to the subscribers of their devices (of all the processes on PostgreSQL, with a single
+        query for all the logs), without blocking."""
+        if not uses_notify():
+            for log in logs:
+                self.dispatch(log.device_id, int(log.reception_datetime.timestamp() * 1000), log.log_file)
+            return
+
+        payloads = []
+        for log in logs:
+            timestamp = int(log.reception_datetime.timestamp() * 1000)
+            payload = json.dumps({'device': log.device_id, 'timestamp': timestamp, 'log_file': log.log_file},
+                                 cls=DjangoJSONEncoder, separators=(',', ':'))
+            if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+                payload = json.dumps({'device': log.device_id, 'timestamp': timestamp, 'database': log._state.db,
+                                      'pk': log.pk})
+            payloads.append(payload)
+
+        if payloads:
+            with connections[NOTIFY_DATABASE].cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload',
+                               [self.channel(), payloads])
+
+    def dispatch(self, device_pk, timestamp, log_file):
+        """Pushes a log to the subscribers of its device in this process."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(device_pk, ()))
+
+        for subscriber in subscribers:
+            subscriber.push(timestamp, log_file)
+
+    @staticmethod
+    def channel():
+        return getattr(settings, 'IOT_STREAM_NOTIFY_CHANNEL', 'iot_logs')
+
+    def _dispatch_notification(self, payload):
+        message = json.loads(payload)
+        with self._lock:
+            if message['device'] not in self._subscribers:
+                return
+
+        log_file = message.get('log_file')
+        if log_file is None:
+            log = Log.objects.using(message['database']).only('log_file').filter(pk=message['pk']).first()
+            if log is None:
+                return
+            log_file = log.log_file
+
+        self.dispatch(message['device'], message['timestamp'], log_file)
+
+    def _listen(self):
+        # connections are per thread: the listener has its own connection, in autocommit mode
+        connection = connections[NOTIFY_DATABASE]
+
+        while True:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {connection.ops.quote_name(self.channel())}')
+
+                pg_connection = connection.connection
+                while True:
+                    if select.select([pg_connection], [], [], KEEPALIVE_SECONDS) == ([], [], []):
+                        continue
+
+                    pg_connection.poll()
+                    while pg_connection.notifies:
+                        self._dispatch_notification(pg_connection.notifies.pop(0).payload)
+
+            except Exception as e:
+                print(f"Live stream listener failed: {e!r}")
+                connection.close()
+                time.sleep(LISTEN_RETRY_SECONDS)
+
+
+broker = Broker()
+
+
+def publish(logs):
+    """Publishes saved Logs to the streams of their devices, if the streams are enabled (see enabled)."""
+    if enabled():
+        broker.publish(logs)
+
+
+def stream_events(device_pk, attr_list):
+    """Generator of the SSE messages for a device, to be used in a StreamingHttpResponse (blocks a thread).
+
+    :param device_pk: Primary key of the device.
+    :param attr_list: List of names of the attributes to stream.
+    """
+    wakeup = threading.Event()
+    subscriber = Subscriber(device_pk, attr_list, wakeup.set)
+    broker.subscribe(subscriber)
+
+    try:
+        yield b': connected\n\n'
+        while True:
+            if not wakeup.wait(KEEPALIVE_SECONDS):
+                yield b': keepalive\n\n'
+                continue
+
+            wakeup.clear()
+            message = subscriber.drain_message()
+            if message is not None:
+                yield message
+
+    finally:
+        # the server closes the generator when the client disconnects
+        broker.unsubscribe(subscriber)
+
+
+def asgi_application(django_application):
+    """Returns an ASGI application serving the streams (see STREAM_PATH) and passing other requests to Django (the
+    streams too if they are disabled, see enabled)."""
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and enabled():
+            match = STREAM_PATH.match(scope['path'])
+            if match:
+                return await _stream(receive, send, int(match['pk']), match['attributes'].split('&'))
+
+        return await django_application(scope, receive, send)
+
+    return application
+
+
+async def _stream(receive, send, device_pk, attr_list):
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    subscriber = Subscriber(device_pk, attr_list, lambda: loop.call_soon_threadsafe(wakeup.set))
+    disconnect = loop.create_task(_wait_disconnect(receive))
+    broker.subscribe(subscriber)
+
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')],
+        })
+        await send({'type': 'http.response.body', 'body': b': connected\n\n', 'more_body': True})
+
+        while not disconnect.done():
+            wait = loop.create_task(wakeup.wait())
+            await asyncio.wait({wait, disconnect}, timeout=KEEPALIVE_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+            wait.cancel()
+
+            if disconnect.done():
+                break
+
+            if not wakeup.is_set():
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+
+            wakeup.clear()
+            message = subscriber.drain_message()
+            if message is not None:
+                await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+
+    finally:
+        broker.unsubscribe(subscriber)
+        disconnect.cancel()
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -0,0 +1,68 @@
+"""Measures the cold start of a worker process, to be used as a regression guard on startup time and memory."""
+import json
+import statistics
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+# modules which must not be loaded by a worker on startup
+LAZY_MODULES = ('boto3', 'botocore', 'requests', 'debug_toolbar', 'numpy')
+
+# run in a fresh interpreter: loads the WSGI application and the url configuration (so all the views are imported)
+PROBE = f"""
+import json, resource, sys, time
+t0 = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(json.dumps({{
+    'seconds': time.perf_counter() - t0,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': [module for module in {LAZY_MODULES!r} if module in sys.modules],
+}}))
+"""
+
+
+class Command(BaseCommand):
+    help = ("Starts fresh worker processes with the current settings (use --settings=iot_server.settings_production) "
+            "and reports their startup time and memory, failing if they exceed the given budgets.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help="Number of processes started.")
+        parser.add_argument('--max-seconds', type=float, default=None, help="Budget for the median startup time.")
+        parser.add_argument('--max-rss-mb', type=float, default=None, help="Budget for the median max RSS.")
+        parser.add_argument('--allow-lazy-modules', action='store_true',
+                            help=f"Don't fail if any of {', '.join(LAZY_MODULES)} is imported on startup.")
+
+    def handle(self, *args, **options):
+        results = []
+        for i in range(options['runs']):
+            # the settings module is inherited through the DJANGO_SETTINGS_MODULE environment variable
+            process = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True)
+            if process.returncode != 0:
+                raise CommandError(f"Worker startup failed:\n{process.stderr}")
+
+            results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+        seconds = statistics.median(result['seconds'] for result in results)
+        rss_mb = statistics.median(result['maxrss_kb'] for result in results) / 1024
+        modules = sorted({module for result in results for module in result['modules']})
+
+        self.stdout.write(f'startup time (median of {len(results)}): {seconds:.3f} secs')
+        self.stdout.write(f'max RSS (median of {len(results)}): {rss_mb:.1f} MB')
+        self.stdout.write(f'modules imported on startup which should be lazy: {modules or "none"}')
+
+        errors = []
+        if options['max_seconds'] is not None and seconds > options['max_seconds']:
+            errors.append(f"startup time {seconds:.3f} secs exceeds the budget of {options['max_seconds']} secs")
+        if options['max_rss_mb'] is not None and rss_mb > options['max_rss_mb']:
+            errors.append(f"max RSS {rss_mb:.1f} MB exceeds the budget of {options['max_rss_mb']} MB")
+        if modules and not options['allow_lazy_modules']:
+            errors.append(f"modules {modules} are imported on startup")
+
+        if errors:
+            raise CommandError('; '.join(errors))
+
+        self.stdout.write(self.style.SUCCESS('Startup within budget.'))
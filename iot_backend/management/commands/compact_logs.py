@@ -0,0 +1,34 @@
+"""Strips the device identity keys from logs stored before compact log storage was enabled."""
+from django.core.management.base import BaseCommand
+
+from iot_backend.models import Log, compact_log_document
+from iot_backend.sharding import log_databases
+
+
+class Command(BaseCommand):
+    help = "Rewrites stored logs in compact form (without the keys identifying the sending device)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of logs updated per query.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        compacted = 0
+
+        for alias in log_databases():
+            while True:
+                # rows leave the filter once updated, so we always take the first batch
+                batch = Log.objects.using(alias).filter(compact=False).order_by('pk').only('pk', 'log_file')
+                batch = list(batch[:batch_size])
+                if not batch:
+                    break
+
+                for log in batch:
+                    log.log_file = compact_log_document(log.log_file)
+                    log.compact = True
+
+                Log.objects.using(alias).bulk_update(batch, ['log_file', 'compact'])
+                compacted += len(batch)
+                self.stdout.write(f'progress: {compacted} logs compacted')
+
+        self.stdout.write(self.style.SUCCESS(f'Compacted {compacted} logs.'))
@@ -0,0 +1,81 @@
+"""Runs the worker processes ingesting the logs written to the spool by the dispatcher (see spool.py)."""
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from iot_backend import spool
+
+
+def run_worker(worker_index, workers, batch_size, poll_seconds, once):
+    """Ingests the segments assigned to the worker, polling for new lines until stopped (or drained if 'once')."""
+    devices = {}
+
+    while True:
+        consumed = 0
+        for path in spool.list_segments(worker_index, workers):
+            try:
+                consumed += spool.consume_segment(path, batch_size, devices)
+
+            except Exception as e:
+                # ex. the database is not available: the segment is consumed again from its offset by the next scan
+                print(f"Failed to ingest segment {spool.segment_name(path)}: {e!r}")
+                devices.clear()
+                connections.close_all()
+
+        if consumed == 0:
+            if once:
+                return
+            time.sleep(poll_seconds)
+
+
+def start_worker(worker_index, worker_args):
+    process = multiprocessing.Process(target=run_worker, args=(worker_index,) + worker_args, daemon=True)
+    process.start()
+
+    return process
+
+
+class Command(BaseCommand):
+    help = "Runs a pool of worker processes saving the logs written to the spool (settings.IOT_SPOOL_DIR)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes.")
+        parser.add_argument('--batch-size', type=int, default=500, help="Max number of logs saved per transaction.")
+        parser.add_argument('--poll-seconds', type=float, default=1.0, help="Wait between scans of an idle spool.")
+        parser.add_argument('--once', action='store_true', help="Exit when the spool has been drained.")
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        worker_args = (workers, options['batch_size'], options['poll_seconds'], options['once'])
+
+        if workers == 1:
+            run_worker(0, *worker_args)
+            return
+
+        # forked processes must not share the parent's database connections
+        connections.close_all()
+
+        processes = {i: start_worker(i, worker_args) for i in range(workers)}
+        self.stdout.write(f'Started {workers} ingest workers.')
+
+        # the segments of a worker are read only by that worker: a dead worker is restarted
+        try:
+            while processes:
+                time.sleep(options['poll_seconds'])
+                for i, process in list(processes.items()):
+                    if process.is_alive():
+                        continue
+
+                    if options['once'] and process.exitcode == 0:
+                        del processes[i]
+                    else:
+                        self.stderr.write(f'Ingest worker {i} (pid {process.pid}) exited with code '
+                                          f'{process.exitcode}, restarting it.')
+                        processes[i] = start_worker(i, worker_args)
+
+        except KeyboardInterrupt:
+            for process in processes.values():
+                process.terminate()
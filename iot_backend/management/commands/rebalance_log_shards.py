@@ -0,0 +1,106 @@
+"""Moves the logs stored on a database other than the shard of their device (see iot_backend/sharding.py)."""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from iot_backend.models import Log, RuleEvent
+from iot_backend.sharding import PRIMARY, log_shards, shard_for
+
+
+def copy_logs(logs, target):
+    """Copies logs to the target database, the logs with a message identifier already copied are not copied again.
+
+    :param logs: List of Logs (of the same device) read from the source database.
+    :param target: Alias of the target database.
+    :return: A dictionary mapping the primary key of each log on the source to its primary key on the target.
+    """
+    device_pk = logs[0].device_id
+    message_ids = [log.message_id for log in logs if log.message_id is not None]
+    copied = dict(Log.objects.using(target).filter(device_id=device_pk, message_id__in=message_ids)
+                  .values_list('message_id', 'pk'))
+
+    new_pks = {}
+    new_logs = []
+    for log in logs:
+        if log.message_id in copied:
+            new_pks[log.pk] = copied[log.message_id]
+        else:
+            # primary keys are generated by each database, the copies get new ones
+            new_logs.append((log.pk, Log(device_id=log.device_id, reception_datetime=log.reception_datetime,
+                                         log_file=log.log_file, compact=log.compact, message_id=log.message_id)))
+
+    copies = [copy for pk, copy in new_logs]
+    if connections[target].features.can_return_rows_from_bulk_insert:
+        Log.objects.using(target).bulk_create(copies)
+    else:
+        for copy in copies:
+            copy.save(using=target)
+
+    new_pks.update((pk, copy.pk) for pk, copy in new_logs)
+
+    return new_pks
+
+
+def repoint_events(device_pk, new_pks):
+    """Makes the RuleEvents of a device refer to the copies of their logs.
+
+    :param device_pk: Primary key of the device (the log pks of the events of other devices refer to other databases).
+    :param new_pks: Dictionary mapping the old primary keys of the logs to the new ones.
+    """
+    events = list(RuleEvent.objects.filter(device_id=device_pk, log_id__in=list(new_pks)).only('pk', 'log_id'))
+    for event in events:
+        event.log_id = new_pks[event.log_id]
+    RuleEvent.objects.bulk_update(events, ['log'])
+
+
+class Command(BaseCommand):
+    help = ("Moves the logs to the shard of their device, after a change of IOT_LOG_SHARDS "
+            "(including the logs stored on the 'default' database before sharding was enabled).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of logs moved per transaction.")
+        parser.add_argument('--source', action='append', default=[],
+                            help="Alias of a database removed from IOT_LOG_SHARDS whose logs must be moved (repeatable).")
+        parser.add_argument('--dry-run', action='store_true', help="Only report the logs to move.")
+
+    def handle(self, *args, **options):
+        shards = log_shards()
+        if not shards:
+            raise CommandError("IOT_LOG_SHARDS is empty, logs are not sharded.")
+
+        batch_size = options['batch_size']
+        moved = 0
+
+        for source in dict.fromkeys([PRIMARY, *shards, *options['source']]):
+            device_pks = Log.objects.using(source).order_by().values_list('device_id', flat=True).distinct()
+
+            for device_pk in list(device_pks):
+                target = shard_for(device_pk)
+                if target == source:
+                    continue
+
+                if options['dry_run']:
+                    count = Log.objects.using(source).filter(device_id=device_pk).count()
+                    self.stdout.write(f'device {device_pk}: {count} logs to move from {source} to {target}')
+                    moved += count
+                    continue
+
+                while True:
+                    batch = list(Log.objects.using(source).filter(device_id=device_pk).order_by('pk')[:batch_size])
+                    if not batch:
+                        break
+
+                    # the target's transaction is committed first: a crash before the source's commit leaves the
+                    # batch on both databases (moved again by the next run), it is never lost
+                    with transaction.atomic(using=source), transaction.atomic(using=PRIMARY), \
+                            transaction.atomic(using=target):
+                        new_pks = copy_logs(batch, target)
+                        repoint_events(device_pk, new_pks)
+                        Log.objects.using(source).filter(pk__in=list(new_pks)).delete()
+
+                    moved += len(batch)
+                    self.stdout.write(f'progress: {moved} logs moved')
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'{moved} logs to move.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Moved {moved} logs.'))
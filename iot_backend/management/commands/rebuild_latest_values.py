@@ -0,0 +1,22 @@
+"""Rebuilds the latest values of all devices from their stored logs."""
+from django.core.management.base import BaseCommand
+
+from iot_backend.models import Device, DeviceLatestValues
+from iot_backend.sharding import device_logs
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the DeviceLatestValues table from the latest stored log of each device."
+
+    def handle(self, *args, **options):
+        rebuilt = 0
+
+        for device_pk in Device.objects.order_by('pk').values_list('pk', flat=True):
+            log = device_logs(device_pk).order_by('-reception_datetime').first()
+            if log is None:
+                continue
+
+            DeviceLatestValues.record(log)
+            rebuilt += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the latest values of {rebuilt} devices.'))
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-19 14:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0013_auto_20201106_0041'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='compact',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.1.2 on 2026-10-19 14:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0014_log_compact'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('attribute', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('threshold', 'Threshold'), ('rate', 'Rate of change'), ('zscore', 'Rolling z-score')], default='threshold', max_length=20)),
+                ('min_value', models.FloatField(blank=True, null=True)),
+                ('max_value', models.FloatField(blank=True, null=True)),
+                ('window', models.PositiveIntegerField(default=60)),
+                ('enabled', models.BooleanField(default=True)),
+                ('device_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='iot_backend.devicetype')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RuleState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.JSONField(default=dict)),
+                ('checkpoint_datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='iot_backend.device')),
+                ('rule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='iot_backend.rule')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RuleEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('value', models.FloatField()),
+                ('measure', models.FloatField()),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='iot_backend.device')),
+                ('log', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='iot_backend.log')),
+                ('rule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='iot_backend.rule')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rulestate',
+            constraint=models.UniqueConstraint(fields=('rule', 'device'), name='unique_rule_state'),
+        ),
+    ]
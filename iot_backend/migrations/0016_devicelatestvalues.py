@@ -0,0 +1,22 @@
+# Generated by Django 3.1.2 on 2026-10-19 14:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0015_auto_20261019_1455'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceLatestValues',
+            fields=[
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='iot_backend.device')),
+                ('reception_datetime', models.DateTimeField()),
+                ('values', models.JSONField()),
+            ],
+        ),
+    ]
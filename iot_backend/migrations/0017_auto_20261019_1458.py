@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-19 14:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0016_devicelatestvalues'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['reception_datetime'], name='log_reception_datetime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ruleevent',
+            index=models.Index(fields=['event_datetime'], name='ruleevent_event_datetime_idx'),
+        ),
+    ]
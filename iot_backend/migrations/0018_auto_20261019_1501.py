@@ -0,0 +1,17 @@
+# Generated by Django 3.1.2 on 2026-10-19 15:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0017_auto_20261019_1458'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['device', 'reception_datetime'], name='log_device_reception_idx'),
+        ),
+    ]
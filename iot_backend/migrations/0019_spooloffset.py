@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-19 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0018_auto_20261019_1501'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpoolOffset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(max_length=200, unique=True)),
+                ('offset', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
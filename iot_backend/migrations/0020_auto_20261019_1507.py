@@ -0,0 +1,24 @@
+# Generated by Django 3.1.2 on 2026-10-19 15:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0019_spooloffset'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='log',
+            name='device',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='iot_backend.device'),
+        ),
+        migrations.AlterField(
+            model_name='ruleevent',
+            name='log',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='iot_backend.log'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-19 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0020_auto_20261019_1507'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='shadow_version',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='stale_shadow_updates',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.2 on 2026-10-19 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0021_auto_20261019_1511'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='message_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='log',
+            constraint=models.UniqueConstraint(fields=('device', 'message_id'), name='unique_log_message'),
+        ),
+    ]
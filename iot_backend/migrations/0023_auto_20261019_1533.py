@@ -0,0 +1,19 @@
+# Generated by Django 3.1.2 on 2026-10-19 15:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iot_backend', '0022_auto_20261019_1517'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ruleevent',
+            name='log',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='iot_backend.log'),
+        ),
+    ]
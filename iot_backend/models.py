@@ -1,8 +1,15 @@
 """Models for iot devices"""
-from django.db import models
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+# Log file keys which identify the sending device, they are implied by 'Log.device' and can be left out of storage
+LOG_IDENTITY_KEYS = ('serial', 'kind', 'model', 'hw')
+
 
 class DeviceType(models.Model):
     kind = models.CharField(max_length=100, null=False, blank=False)
@@ -18,6 +25,16 @@ class DeviceType(models.Model):
     def __str__(self):
         return f'(pk:{self.pk}) {self.kind} Model:{self.model} HW:{self.hardware_version}'
 
+    def clean(self):
+        # the data format is used to validate the received logs (see validators.py)
+        from .validators import compile_validator
+
+        try:
+            compile_validator(self.data_format)
+
+        except ValueError as e:
+            raise ValidationError({'data_format': str(e)})
+
 
 class Device(models.Model):
     serial_number = models.CharField(max_length=100, null=False, blank=False)
@@ -27,6 +44,10 @@ class Device(models.Model):
     registration_datetime = models.DateTimeField(null=False, blank=False, default=timezone.now)
     aws_thing_name = models.CharField(max_length=100, unique=True, null=False, blank=False)
     state = models.JSONField(null=True, blank=True)
+    # version of the AWS shadow document saved in 'state' (see update_shadow)
+    shadow_version = models.BigIntegerField(null=True, blank=True)
+    # number of shadow updates discarded because a newer (or the same) version was already saved
+    stale_shadow_updates = models.PositiveIntegerField(null=False, blank=False, default=0)
 
     class Meta:
         constraints = [
@@ -36,12 +57,215 @@ class Device(models.Model):
     def __str__(self):
         return f'(pk:{self.pk}) Serial:{self.serial_number} ({self.type})'
 
+    @classmethod
+    def update_shadow(cls, pk, state, version):
+        """Saves the shadow state of a device, unless a newer (or the same) version has already been saved.
+
+        The version is checked by the same UPDATE statement which saves the state, so concurrent updates of the same
+        device need no lock and the newest version always wins, whatever the order they are applied.
+
+        :param pk: Primary key of the device.
+        :param state: The shadow document.
+        :param version: The version of the shadow document.
+        :return: True if the state has been saved, False if it has been discarded (and counted in
+        'stale_shadow_updates').
+        """
+        updated = cls.objects.filter(models.Q(shadow_version__isnull=True) | models.Q(shadow_version__lt=version),
+                                     pk=pk).update(state=state, shadow_version=version)
+
+        if not updated:
+            cls.objects.filter(pk=pk).update(stale_shadow_updates=models.F('stale_shadow_updates') + 1)
+
+        return bool(updated)
+
 
 class Log(models.Model):
-    device = models.ForeignKey(Device, null=False, blank=False, on_delete=models.CASCADE)
+    # no constraint in the database: logs may be stored on a shard (see sharding.py) while devices stay on 'default'
+    device = models.ForeignKey(Device, null=False, blank=False, on_delete=models.CASCADE, db_constraint=False)
     # Note: we pass the callable 'timezone.now' and NOT the fixed value 'timezone.now()'
     reception_datetime = models.DateTimeField(null=False, blank=False, default=timezone.now)
     log_file = models.JSONField(null=False, blank=False)
+    # True if the identity keys (see LOG_IDENTITY_KEYS) have been stripped from 'log_file' before storage
+    compact = models.BooleanField(null=False, blank=False, default=False)
+    # identifier of the device's message (see log_message_id), a message delivered again is not saved twice
+    message_id = models.CharField(max_length=100, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['reception_datetime'], name='log_reception_datetime_idx'),
+            models.Index(fields=['device', 'reception_datetime'], name='log_device_reception_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'message_id'], name='unique_log_message'),
+        ]
 
     def __str__(self):
         return f'(pk:{self.pk}) {self.reception_datetime} [{self.device}]'
+
+    @classmethod
+    def from_document(cls, device, document, **kwargs):
+        """Builds a new (unsaved) Log for the given device from a log document as sent by the device.
+
+        If settings.IOT_COMPACT_LOG_STORAGE is enabled the identity keys are stripped from the stored 'log_file',
+        the original document is still available through the 'document' property.
+        The message identifier is taken from the document (see log_message_id).
+
+        :param device: The Device which sent the log.
+        :param document: The log document (dict).
+        :param kwargs: Other Log fields (ex. reception_datetime).
+        :return: A Log instance.
+        """
+        kwargs.setdefault('message_id', log_message_id(document))
+
+        if getattr(settings, 'IOT_COMPACT_LOG_STORAGE', False):
+            document = compact_log_document(document)
+            kwargs['compact'] = True
+
+        return cls(device=device, log_file=document, **kwargs)
+
+    @property
+    def document(self):
+        """The original log document, with identity keys restored from the device if they were stripped."""
+        if not self.compact:
+            return self.log_file
+
+        device_type = self.device.type
+        document = {
+            'serial': self.device.serial_number,
+            'kind': device_type.kind,
+            'model': device_type.model,
+            'hw': device_type.hardware_version,
+        }
+        document.update(self.log_file)
+
+        return document
+
+
+class DeviceLatestValues(models.Model):
+    """Reception datetime and attributes' values of the latest log of a Device, updated on each log's reception."""
+    device = models.OneToOneField(Device, primary_key=True, null=False, blank=False, on_delete=models.CASCADE)
+    reception_datetime = models.DateTimeField(null=False, blank=False)
+    # the latest log file without the identity keys (see LOG_IDENTITY_KEYS)
+    values = models.JSONField(null=False, blank=False)
+
+    def __str__(self):
+        return f'{self.reception_datetime} [device pk:{self.device_id}]'
+
+    @classmethod
+    def record(cls, log):
+        """Updates the latest values of the log's device, unless a more recent log has already been recorded.
+
+        :param log: A saved Log.
+        """
+        fields = {'reception_datetime': log.reception_datetime, 'values': compact_log_document(log.log_file)}
+
+        updated = cls.objects.filter(device_id=log.device_id,
+                                     reception_datetime__lte=log.reception_datetime).update(**fields)
+
+        if not updated and not cls.objects.filter(device_id=log.device_id).exists():
+            try:
+                with transaction.atomic():
+                    cls.objects.create(device_id=log.device_id, **fields)
+
+            except IntegrityError:
+                # created concurrently by another log of the same device
+                cls.objects.filter(device_id=log.device_id,
+                                   reception_datetime__lte=log.reception_datetime).update(**fields)
+
+
+def compact_log_document(document):
+    """Returns a copy of the log document without the keys identifying the sending device."""
+    return {key: value for key, value in document.items() if key not in LOG_IDENTITY_KEYS}
+
+
+def log_message_id(document):
+    """Returns the identifier of the message of a log document, None if the device doesn't send one.
+
+    The identifier is the value of the first of settings.IOT_LOG_MESSAGE_ID_KEYS found in the document (ex. a message
+    ID, else the device's timestamp), prefixed by the key. Identifiers too long for the column are hashed.
+    """
+    for key in getattr(settings, 'IOT_LOG_MESSAGE_ID_KEYS', ()):
+        if document.get(key) is not None:
+            message_id = f'{key}:{document[key]}'
+            if len(message_id) > Log._meta.get_field('message_id').max_length:
+                message_id = f'{key}:sha1:{sha1(message_id.encode()).hexdigest()}'
+            return message_id
+
+    return None
+
+
+class Rule(models.Model):
+    """A rule evaluated on each log received from the devices of a DeviceType (see rules.py).
+
+    The rule's measure is computed on the numeric value of 'attribute':
+        threshold — the attribute's value.
+        rate — the attribute's rate of change per second since the previous log.
+        zscore — the attribute's z-score over a rolling window of about 'window' logs.
+    The rule is violated if the measure is lower than 'min_value' or greater than 'max_value' (when they are set).
+    """
+    THRESHOLD = 'threshold'
+    RATE = 'rate'
+    ZSCORE = 'zscore'
+    KIND_CHOICES = [
+        (THRESHOLD, 'Threshold'),
+        (RATE, 'Rate of change'),
+        (ZSCORE, 'Rolling z-score'),
+    ]
+
+    device_type = models.ForeignKey(DeviceType, null=False, blank=False, on_delete=models.CASCADE)
+    name = models.CharField(max_length=100, null=False, blank=False)
+    attribute = models.CharField(max_length=100, null=False, blank=False)
+    kind = models.CharField(max_length=20, null=False, blank=False, choices=KIND_CHOICES, default=THRESHOLD)
+    min_value = models.FloatField(null=True, blank=True)
+    max_value = models.FloatField(null=True, blank=True)
+    # number of logs of the rolling window (zscore rules only)
+    window = models.PositiveIntegerField(null=False, blank=False, default=60)
+    enabled = models.BooleanField(null=False, blank=False, default=True)
+
+    def __str__(self):
+        return f'(pk:{self.pk}) {self.name} [{self.kind} on {self.attribute}] ({self.device_type})'
+
+
+class RuleState(models.Model):
+    """Checkpoint of the rolling state of a Rule for a Device."""
+    rule = models.ForeignKey(Rule, null=False, blank=False, on_delete=models.CASCADE)
+    device = models.ForeignKey(Device, null=False, blank=False, on_delete=models.CASCADE)
+    state = models.JSONField(null=False, blank=False, default=dict)
+    checkpoint_datetime = models.DateTimeField(null=False, blank=False, default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['rule', 'device'], name="unique_rule_state"),
+        ]
+
+    def __str__(self):
+        return f'(pk:{self.pk}) {self.checkpoint_datetime} [{self.rule}] [{self.device}]'
+
+
+class RuleEvent(models.Model):
+    """A violation of a Rule by a Device, registered when the device's measure goes out of the rule's bounds."""
+    rule = models.ForeignKey(Rule, null=False, blank=False, on_delete=models.CASCADE)
+    device = models.ForeignKey(Device, null=False, blank=False, on_delete=models.CASCADE)
+    # the log may be stored on a shard (see sharding.py), where it is referred to by its pk on that database: deleting
+    # logs doesn't touch the events (the events of the same log pk on the other databases belong to other logs)
+    log = models.ForeignKey(Log, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False)
+    event_datetime = models.DateTimeField(null=False, blank=False, default=timezone.now)
+    value = models.FloatField(null=False, blank=False)
+    measure = models.FloatField(null=False, blank=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['event_datetime'], name='ruleevent_event_datetime_idx'),
+        ]
+
+    def __str__(self):
+        return f'(pk:{self.pk}) {self.event_datetime} {self.rule.name} measure:{self.measure} [{self.device}]'
+
+
+class SpoolOffset(models.Model):
+    """Offset (in bytes) up to which a spool segment has been ingested (see spool.py)."""
+    segment = models.CharField(max_length=200, unique=True, null=False, blank=False)
+    offset = models.BigIntegerField(null=False, blank=False, default=0)
+
+    def __str__(self):
+        return f'{self.segment} offset:{self.offset}'
@@ -0,0 +1,302 @@
+"""
+This module keeps in memory the recent numeric values of the devices, to answer the queries on recent windows
+(downsampled series, min/max/avg/percentiles) without reading and decoding the logs again.
+
+The cache is optional: it is enabled when numpy is installed and settings.IOT_RECENT_CACHE_DEVICES is greater than 0
+(numpy is imported by the first read, see load_numpy).
+Each process keeps the buffers of at most settings.IOT_RECENT_CACHE_DEVICES devices (the least recently used ones are
+evicted). A buffer is a ring of the last settings.IOT_RECENT_CACHE_POINTS logs of a device: their pks, reception
+timestamps and one float column for each numeric attribute (NaN where missing), so the memory used is bounded by
+devices * points * (numeric attributes + 2) * 8 bytes.
+
+A buffer is loaded from the logs the first time its device is read (warm up), then it is fed by save_device_log_data.
+The logs saved by other processes (other web workers, spool ingest workers) are fetched from the database when the
+buffer is read, at most every settings.IOT_RECENT_CACHE_SYNC_SECONDS: only the logs received after the last known
+one, with an overlap of SYNC_OVERLAP_SECONDS for the transactions committed late (duplicates are skipped by pk).
+
+A window can be answered by a buffer only if it holds all the logs received from the window's start on, otherwise
+the caller must read the logs from the database (see window).
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from math import inf
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+
+from . import sharding
+
+# numpy, imported on first use (see load_numpy)
+np = None
+_numpy_missing = False
+
+# seconds of logs fetched again at each synchronization, for the transactions committed after later ones
+SYNC_OVERLAP_SECONDS = 5
+
+# max number of attributes (columns) of each buffer
+MAX_ATTRIBUTES = 256
+
+
+def load_numpy():
+    """Imports numpy, returns True if it is installed.
+
+    numpy is imported on first use, it is slow to import and only needed by the recent data API.
+    """
+    global np, _numpy_missing
+
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            _numpy_missing = True
+        else:
+            np = numpy
+
+    return np is not None
+
+
+def is_enabled():
+    """Returns True if the cache is enabled (numpy is installed and settings.IOT_RECENT_CACHE_DEVICES > 0)."""
+    return getattr(settings, 'IOT_RECENT_CACHE_DEVICES', 0) > 0 and load_numpy()
+
+
+def numeric_values(document):
+    """Returns the numeric attributes of a log file as a dictionary of floats."""
+    return {attr: float(value) for attr, value in document.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+
+def _device_logs(device_pk):
+    # the buffers are synchronized from the primary (or the shard): a lagging replica could make them skip some logs
+    return sharding.device_logs(device_pk).using(sharding.shard_for(device_pk) or sharding.PRIMARY)
+
+
+class DeviceBuffer:
+    """Ring buffer of the numeric values of the last logs of a device."""
+
+    def __init__(self, device_pk, capacity):
+        self.device_pk = device_pk
+        self.capacity = capacity
+        self.lock = Lock()
+        self.pks = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.full(capacity, np.nan)
+        self.columns = {}
+        self.size = 0
+        self.next = 0  # index of the slot written by the next append
+        self.complete_since = inf  # the buffer holds all the logs received from this timestamp on
+        self.latest = -inf  # timestamp of the latest log
+        self.synced = None  # monotonic time of the last synchronization
+
+    def append(self, pk, timestamp, values):
+        """Appends a log, overwriting the oldest one if the buffer is full.
+
+        :param pk: Primary key of the log.
+        :param timestamp: Reception timestamp of the log (seconds since the Unix epoch).
+        :param values: Numeric values of the log (see numeric_values).
+        """
+        i = self.next
+        if self.size == self.capacity:
+            # the logs received up to the overwritten one may be no more in the buffer
+            self.complete_since = max(self.complete_since, np.nextafter(self.timestamps[i], inf))
+        else:
+            self.size += 1
+
+        self.pks[i] = pk
+        self.timestamps[i] = timestamp
+        for attr, column in self.columns.items():
+            column[i] = values.get(attr, np.nan)
+        for attr in values.keys() - self.columns.keys():
+            if len(self.columns) < MAX_ATTRIBUTES:
+                # the logs already in the buffer don't have the new attribute
+                column = self.columns[attr] = np.full(self.capacity, np.nan)
+                column[i] = values[attr]
+
+        self.next = (i + 1) % self.capacity
+        self.latest = max(self.latest, timestamp)
+
+    def warm_up(self):
+        """Loads the last logs of the device from the database."""
+        logs = _device_logs(self.device_pk).order_by('-reception_datetime')
+        logs = list(logs.values_list('pk', 'reception_datetime', 'log_file')[:self.capacity])
+
+        for pk, reception_datetime, log_file in reversed(logs):
+            self.append(pk, reception_datetime.timestamp(), numeric_values(log_file))
+
+        # with fewer logs than the capacity the buffer holds all of them, otherwise only the ones after the oldest
+        self.complete_since = -inf if len(logs) < self.capacity else np.nextafter(self.timestamps[0], inf)
+        self.synced = monotonic()
+
+    def sync(self):
+        """Appends the logs saved by the other processes since the last synchronization."""
+        logs = _device_logs(self.device_pk)
+        if self.latest > -inf:
+            since = self.latest - SYNC_OVERLAP_SECONDS
+            logs = logs.filter(reception_datetime__gte=datetime.fromtimestamp(since, timezone.utc))
+            known = set(self.pks[:self.size][self.timestamps[:self.size] >= since].tolist())
+        else:
+            known = set()
+
+        for pk, reception_datetime, log_file in logs.order_by('reception_datetime').values_list(
+                'pk', 'reception_datetime', 'log_file'):
+            if pk not in known:
+                self.append(pk, reception_datetime.timestamp(), numeric_values(log_file))
+
+        self.synced = monotonic()
+
+    def window(self, attr_list, start, end):
+        """Returns the logs received in a time range, sorted by reception timestamp.
+
+        :param attr_list: List of names of the attributes.
+        :param start: Start timestamp (included).
+        :param end: End timestamp (excluded).
+        :return: A tuple (timestamps, columns) of arrays, columns maps each attribute to its values (NaN where
+        missing); None if the buffer doesn't hold all the logs of the range.
+        """
+        if start < self.complete_since:
+            return None
+
+        timestamps = self.timestamps[:self.size]
+        mask = (timestamps >= start) & (timestamps < end)
+        order = np.argsort(timestamps[mask], kind='stable')
+        missing = np.full(self.size, np.nan)
+
+        return timestamps[mask][order], {attr: self.columns.get(attr, missing)[:self.size][mask][order]
+                                         for attr in attr_list}
+
+
+class RecentCache:
+    """Thread-safe LRU registry of the devices' buffers."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._buffers = OrderedDict()
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+
+    def _get(self, device_pk, create):
+        with self._lock:
+            buffer = self._buffers.get(device_pk)
+            if buffer is not None:
+                self._buffers.move_to_end(device_pk)
+            elif create:
+                buffer = self._buffers[device_pk] = DeviceBuffer(
+                    device_pk, getattr(settings, 'IOT_RECENT_CACHE_POINTS', 4096))
+                while len(self._buffers) > getattr(settings, 'IOT_RECENT_CACHE_DEVICES', 0):
+                    self._buffers.popitem(last=False)
+
+        return buffer
+
+    def record(self, log):
+        """Appends a saved Log to the buffer of its device, if the device is cached."""
+        buffer = self._get(log.device_id, create=False)
+        if buffer is not None:
+            with buffer.lock:
+                if buffer.synced is not None:
+                    buffer.append(log.pk, log.reception_datetime.timestamp(), numeric_values(log.log_file))
+
+    def window(self, device_pk, attr_list, start, end):
+        """Returns the logs of a device received in a time range (see DeviceBuffer.window), loading or synchronizing
+        its buffer if needed."""
+        buffer = self._get(device_pk, create=True)
+        with buffer.lock:
+            if buffer.synced is None:
+                buffer.warm_up()
+            elif monotonic() - buffer.synced >= getattr(settings, 'IOT_RECENT_CACHE_SYNC_SECONDS', 1):
+                buffer.sync()
+
+            return buffer.window(attr_list, start, end)
+
+
+cache = RecentCache()
+
+
+def record(log):
+    """Feeds a saved Log to the cache (does nothing if the cache is disabled)."""
+    # until numpy is imported by a read of the cache there are no buffers to feed
+    if np is not None and is_enabled():
+        cache.record(log)
+
+
+def window(device_pk, attr_list, start, end):
+    """Returns the logs of a device received in a time range from the cache.
+
+    :param device_pk: Primary key of the device.
+    :param attr_list: List of names of the attributes.
+    :param start: Start datetime (included).
+    :param end: End datetime (excluded).
+    :return: A tuple (timestamps, columns), see DeviceBuffer.window; None if the cache is disabled or doesn't hold
+    all the logs of the range.
+    """
+    if not is_enabled():
+        return None
+
+    return cache.window(device_pk, attr_list, start.timestamp(), end.timestamp())
+
+
+def from_rows(rows, attr_list):
+    """Returns the (timestamps, columns) arrays of rows (reception_datetime, value1, value2, ...) read from the logs."""
+    timestamps = np.array([row[0].timestamp() for row in rows], dtype=np.float64)
+    values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), len(attr_list))
+
+    return timestamps, {attr: values[:, i] for i, attr in enumerate(attr_list)}
+
+
+def downsample(timestamps, columns, max_points):
+    """Downsamples a series to at most max_points points, averaging the values of equal time intervals.
+
+    :param timestamps: Sorted array of timestamps.
+    :param columns: Dictionary of arrays of values aligned to the timestamps (NaN where missing).
+    :param max_points: Max number of points.
+    :return: A tuple (timestamps, columns) of the points (the mean timestamp of each non-empty interval), the series
+    itself if it has at most max_points points or all its timestamps are equal.
+    """
+    if len(timestamps) <= max_points:
+        return timestamps, columns
+
+    span = timestamps[-1] - timestamps[0]
+    if span == 0:
+        return timestamps, columns
+
+    buckets = np.minimum(((timestamps - timestamps[0]) * (max_points / span)).astype(np.int64), max_points - 1)
+    counts = np.bincount(buckets, minlength=max_points)
+    filled = counts > 0
+
+    points = np.bincount(buckets, weights=timestamps, minlength=max_points)[filled] / counts[filled]
+    point_columns = {}
+    for attr, values in columns.items():
+        valid = ~np.isnan(values)
+        sums = np.bincount(buckets, weights=np.where(valid, values, 0.0), minlength=max_points)[filled]
+        valid_counts = np.bincount(buckets, weights=valid, minlength=max_points)[filled]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            point_columns[attr] = np.where(valid_counts > 0, sums / valid_counts, np.nan)
+
+    return points, point_columns
+
+
+def statistics(columns, percentiles):
+    """Returns min, max, avg and the percentiles of each column, ignoring the missing values.
+
+    :param columns: Dictionary of arrays of values (NaN where missing).
+    :param percentiles: List of percentiles (between 0 and 100).
+    :return: A dictionary mapping each attribute to its statistics (None if it has no values), the percentiles are
+    named 'p<percentile>' (ex. p95).
+    """
+    result = {}
+    for attr, values in columns.items():
+        values = values[~np.isnan(values)]
+        if not values.size:
+            result[attr] = dict.fromkeys(['count', 'min', 'max', 'avg', *[f'p{p:g}' for p in percentiles]])
+            result[attr]['count'] = 0
+            continue
+
+        result[attr] = {'count': int(values.size), 'min': float(values.min()), 'max': float(values.max()),
+                        'avg': float(values.mean())}
+        if percentiles:
+            for p, value in zip(percentiles, np.percentile(values, percentiles)):
+                result[attr][f'p{p:g}'] = float(value)
+
+    return result
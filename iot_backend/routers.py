@@ -0,0 +1,149 @@
+"""
+Database routing of the logs to their shards (see sharding.py) and of the analytical views to the read replicas.
+
+The views decorated with use_read_replica read from one of the databases listed in settings.IOT_READ_REPLICAS
+(aliases of settings.DATABASES), every other read and all writes (ingest, registration) use the 'default' database.
+A replica is skipped while its replication lag is greater than settings.IOT_REPLICA_MAX_LAG_SECONDS or while it can't
+be reached, the lag is checked at most every settings.IOT_REPLICA_CHECK_SECONDS; if no replica is usable the reads go
+to the primary.
+"""
+
+from contextvars import ContextVar
+from functools import wraps
+from itertools import count
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+
+from .models import Device, Log
+from .sharding import log_shards, shard_for
+
+PRIMARY = 'default'
+
+# alias of the database chosen for the reads of the running view decorated with use_read_replica
+_read_replica = ContextVar('iot_read_replica', default=None)
+
+_lock = Lock()
+_checks = {}  # alias -> (check time, usable)
+_counter = count()
+
+
+def use_read_replica(view):
+    """Decorator routing the reads of the view to a read replica, the same one for all the queries of a request."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = _read_replica.set(choose_replica())
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _read_replica.reset(token)
+
+    return wrapper
+
+
+def replication_lag(alias):
+    """Returns the replication lag of a database in seconds (0 if it is not a PostgreSQL standby)."""
+    connection = connections[alias]
+    connection.ensure_connection()
+    if connection.vendor != 'postgresql':
+        return 0
+
+    with connection.cursor() as cursor:
+        # a standby which has replayed all the received WAL is up to date, even if the primary is idle
+        cursor.execute(
+            "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+def is_usable(alias):
+    """Returns True if the replica is reachable and its lag is within settings.IOT_REPLICA_MAX_LAG_SECONDS."""
+    with _lock:
+        checked = _checks.get(alias)
+    if checked is not None and monotonic() - checked[0] < getattr(settings, 'IOT_REPLICA_CHECK_SECONDS', 5):
+        return checked[1]
+
+    try:
+        usable = replication_lag(alias) <= getattr(settings, 'IOT_REPLICA_MAX_LAG_SECONDS', 30)
+    except DatabaseError as e:
+        print(f"Read replica '{alias}' is not usable: {e}")
+        usable = False
+
+    with _lock:
+        _checks[alias] = (monotonic(), usable)
+
+    return usable
+
+
+def choose_replica():
+    """Returns the alias of a usable replica (in turn), the primary's if there are none."""
+    replicas = getattr(settings, 'IOT_READ_REPLICAS', [])
+    start = next(_counter)
+    for i in range(len(replicas)):
+        alias = replicas[(start + i) % len(replicas)]
+        if is_usable(alias):
+            return alias
+
+    return PRIMARY
+
+
+class LogShardRouter:
+    """Routes the Logs to the shard of their device when settings.IOT_LOG_SHARDS is set (see sharding.py).
+
+    Only the queries with an instance hint (saving a Log, following a relation to a Log) can be routed, the other
+    queries on the logs must select their shard with sharding.device_logs or sharding.scatter_logs.
+    """
+
+    def _shard(self, model, hints):
+        instance = hints.get('instance')
+        if model is not Log or instance is None:
+            return None
+
+        device_pk = instance.pk if isinstance(instance, Device) else getattr(instance, 'device_id', None)
+
+        return shard_for(device_pk) if device_pk is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # logs reference their device (and rule events their log) across databases
+        shards = log_shards()
+        if obj1._state.db in shards or obj2._state.db in shards:
+            return True
+        return None
+
+
+class ReadReplicaRouter:
+    """Routes the reads of the views decorated with use_read_replica to the replica chosen for them."""
+
+    def db_for_read(self, model, **hints):
+        return _read_replica.get() or PRIMARY
+
+    def db_for_write(self, model, **hints):
+        # objects read from a replica are written to the primary, objects read from another database stay there
+        # (ex. the permissions created by 'migrate --database=shard1' before the shard is added to IOT_LOG_SHARDS)
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db not in (None, PRIMARY,
+                                                               *getattr(settings, 'IOT_READ_REPLICAS', [])):
+            return None
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data of the primary
+        databases = {PRIMARY, *getattr(settings, 'IOT_READ_REPLICAS', [])}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas are migrated through replication
+        if db in getattr(settings, 'IOT_READ_REPLICAS', []):
+            return False
+        return None
@@ -0,0 +1,259 @@
+"""
+This module evaluates the Rules of a DeviceType on each log received from its devices.
+
+The rolling state of each (rule, device) pair is kept in memory and has a constant size (the z-score uses an
+exponentially weighted mean and variance equivalent to a window of 'Rule.window' logs), so the cost of a log is
+proportional only to the number of rules of its DeviceType.
+States are loaded from the RuleState table the first time a device is seen and checkpointed back to it every
+settings.IOT_RULES_CHECKPOINT_SECONDS by a background thread (started by the first evaluation), not by the ingest
+requests. Rules are cached per DeviceType and reloaded every settings.IOT_RULES_RELOAD_SECONDS (or as soon as a Rule is
+changed in this process).
+
+The caches are guarded by a lock which is never held during a query: rules and states are read before taking it and
+the checkpoint copies the changed states while holding it, then writes the copies after releasing it.
+
+A RuleEvent is stored only when a device's measure goes out of the rule's bounds, not for every log while it stays
+out of them.
+
+The rolling states are kept by each process: when the logs of a device are received by several processes (web
+workers, 'ingest_spool' workers) each one computes its measures on the logs it has received only (ex. the rate of
+change since its own previous log, a z-score on its own window) and the state checkpointed last overwrites the others.
+The measures match the ones of a single process only if all the logs of a device are evaluated by the same process.
+
+Failures of the evaluation are printed and never fail the ingest of the log: the log is already saved, rejecting it
+would make the device send it again.
+"""
+
+from math import sqrt
+from threading import RLock, Thread
+from time import monotonic, sleep
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Rule, RuleState, RuleEvent
+
+_lock = RLock()
+
+# DeviceType pk -> list of enabled rules
+_rules = {}
+_rules_loaded = 0.0
+
+# (rule pk, device pk) -> RuleState, states changed since the last checkpoint are in _dirty
+_states = {}
+_dirty = set()
+
+# thread calling checkpoint periodically, started by the first evaluation
+_checkpointer = None
+
+
+@receiver(post_save, sender=Rule)
+@receiver(post_delete, sender=Rule)
+def _invalidate_rules(sender, **kwargs):
+    global _rules_loaded
+    _rules_loaded = 0.0
+
+
+def _get_rules(device_type_pk):
+    """Returns the enabled rules of the DeviceType, reloading all of them if the cache has expired."""
+    global _rules, _rules_loaded
+
+    if monotonic() - _rules_loaded > getattr(settings, 'IOT_RULES_RELOAD_SECONDS', 60):
+        loaded = monotonic()
+        rules = {}
+        for rule in Rule.objects.filter(enabled=True):
+            rules.setdefault(rule.device_type_id, []).append(rule)
+        enabled = {rule.pk for type_rules in rules.values() for rule in type_rules}
+
+        with _lock:
+            _rules = rules
+            _rules_loaded = loaded
+
+            # forget the states of deleted or disabled rules
+            for key in [key for key in _states if key[0] not in enabled]:
+                del _states[key]
+                _dirty.discard(key)
+
+    return _rules.get(device_type_pk, [])
+
+
+def _get_states(rules, device_pk):
+    """Returns the RuleStates of the device for the given rules, loading or creating the missing ones."""
+    with _lock:
+        missing = [rule.pk for rule in rules if (rule.pk, device_pk) not in _states]
+
+    if missing:
+        loaded = {rule_state.rule_id: rule_state
+                  for rule_state in RuleState.objects.filter(device_id=device_pk, rule_id__in=missing)}
+
+        with _lock:
+            # the states loaded by another thread in the meantime are kept, they may already be updated
+            for rule_pk in missing:
+                rule_state = loaded.get(rule_pk) or RuleState(rule_id=rule_pk, device_id=device_pk, state={})
+                _states.setdefault((rule_pk, device_pk), rule_state)
+
+    with _lock:
+        return [_states[(rule.pk, device_pk)] for rule in rules]
+
+
+def update_measure(rule, state, value, timestamp):
+    """Updates the rolling state of a rule with a new value and returns the rule's measure.
+
+    :param rule: The Rule.
+    :param state: The rolling state (dict) of the rule for a device, updated in place.
+    :param value: The attribute's value.
+    :param timestamp: The reception time of the value (POSIX timestamp).
+    :return: The measure, None if it can't be computed yet (ex. the first value of a rate rule).
+    """
+    measure = None
+
+    if rule.kind == Rule.THRESHOLD:
+        measure = value
+
+    elif rule.kind == Rule.RATE:
+        if 'last_value' in state and timestamp > state['last_time']:
+            measure = (value - state['last_value']) / (timestamp - state['last_time'])
+
+    elif rule.kind == Rule.ZSCORE:
+        count = state.get('count', 0)
+        mean = state.get('mean', value)
+        var = state.get('var', 0.0)
+
+        # the z-score is computed before adding the value, so an anomaly does not hide itself
+        if count >= rule.window and var > 0:
+            measure = (value - mean) / sqrt(var)
+
+        alpha = 2 / (rule.window + 1)
+        diff = value - mean
+        increment = alpha * diff
+        state['count'] = count + 1
+        state['mean'] = mean + increment
+        state['var'] = (1 - alpha) * (var + diff * increment)
+
+    state['last_value'] = value
+    state['last_time'] = timestamp
+
+    return measure
+
+
+def evaluate_log(log):
+    """Evaluates the rules of the log's DeviceType and stores a RuleEvent for each rule newly violated.
+
+    Errors are printed, not raised (the evaluation runs in a savepoint, the caller's transaction stays usable).
+
+    :param log: A saved Log.
+    :return: The list of stored RuleEvents.
+    """
+    _start_checkpointer()
+
+    try:
+        with transaction.atomic():
+            events = _evaluate_log(log)
+
+    except Exception as e:
+        print(f"Rules evaluation failed for log with pk={log.pk}: {e!r}")
+        return []
+
+    return events
+
+
+def _evaluate_log(log):
+    events = []
+
+    rules = _get_rules(log.device.type_id)
+    if not rules:
+        return events
+
+    rule_states = _get_states(rules, log.device_id)
+    timestamp = log.reception_datetime.timestamp()
+
+    with _lock:
+        for rule, rule_state in zip(rules, rule_states):
+            try:
+                value = float(log.log_file[rule.attribute])
+            except (KeyError, TypeError, ValueError):
+                continue
+
+            state = rule_state.state
+            measure = update_measure(rule, state, value, timestamp)
+            violated = measure is not None and (
+                (rule.min_value is not None and measure < rule.min_value) or
+                (rule.max_value is not None and measure > rule.max_value)
+            )
+
+            if violated and not state.get('violated', False):
+                events.append(RuleEvent(rule=rule, device_id=log.device_id, log=log,
+                                        event_datetime=log.reception_datetime, value=value, measure=measure))
+
+            state['violated'] = violated
+            _dirty.add((rule.pk, log.device_id))
+
+    if events:
+        RuleEvent.objects.bulk_create(events)
+
+    return events
+
+
+def checkpoint():
+    """Saves the rolling states changed since the last checkpoint.
+
+    The states stay dirty if saving them fails (the error is raised), they are saved by the next checkpoint.
+    """
+    with _lock:
+        dirty = [(_states[key], dict(_states[key].state)) for key in _dirty if key in _states]
+        _dirty.clear()
+
+    now = timezone.now()
+    created_pks = []
+    try:
+        with transaction.atomic():
+            # states are created one by one (only the first time a device is seen) to get back their primary keys,
+            # another process may have created the same state in the meantime: its row is overwritten
+            changed_states = []
+            for rule_state, state in dirty:
+                if rule_state.pk is None:
+                    saved, created = RuleState.objects.update_or_create(
+                        rule_id=rule_state.rule_id, device_id=rule_state.device_id,
+                        defaults={'state': state, 'checkpoint_datetime': now})
+                    created_pks.append((rule_state, saved.pk))
+                else:
+                    changed_states.append(RuleState(pk=rule_state.pk, state=state, checkpoint_datetime=now))
+            RuleState.objects.bulk_update(changed_states, ['state', 'checkpoint_datetime'])
+
+    except Exception:
+        with _lock:
+            _dirty.update((rule_state.rule_id, rule_state.device_id) for rule_state, state in dirty)
+        raise
+
+    for rule_state, pk in created_pks:
+        rule_state.pk = pk
+    for rule_state, state in dirty:
+        rule_state.checkpoint_datetime = now
+
+
+def _start_checkpointer():
+    global _checkpointer
+
+    with _lock:
+        if _checkpointer is None:
+            _checkpointer = Thread(target=_checkpoint_loop, name='rules-checkpointer', daemon=True)
+            _checkpointer.start()
+
+
+def _checkpoint_loop():
+    while True:
+        sleep(getattr(settings, 'IOT_RULES_CHECKPOINT_SECONDS', 60))
+
+        try:
+            checkpoint()
+
+        except Exception as e:
+            # the states stay dirty, they are saved by the next checkpoint
+            print(f"Rules checkpoint failed: {e!r}")
+
+        finally:
+            # the connections of this thread would stay open until the process exits
+            connections.close_all()
@@ -0,0 +1,112 @@
+"""
+Optional sharding of the Log table across several databases.
+
+When settings.IOT_LOG_SHARDS lists some aliases of settings.DATABASES, the logs of each device are stored in one of
+them, chosen by rendezvous hashing of the device's pk (so adding or removing a shard only moves the devices of that
+shard, see the 'rebalance_log_shards' management command). All the other tables stay on the 'default' database, the
+shards are migrated with the full schema but only their Log table is used.
+
+Saving a Log is routed to its shard by LogShardRouter (see routers.py). Queries on the logs of a device must be built
+with device_logs, queries on the logs of several devices with scatter_logs, which runs them on all the involved
+shards in parallel and gathers the results. Bulk operations without a device (ex. QuerySet.update) must be run on
+each of log_databases.
+"""
+
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .models import Device, Log
+from . import guardrails
+
+PRIMARY = 'default'
+
+
+def log_shards():
+    """Returns the aliases of the Log shards (empty if sharding is disabled)."""
+    return getattr(settings, 'IOT_LOG_SHARDS', [])
+
+
+def log_databases():
+    """Returns the aliases of the databases holding logs."""
+    return log_shards() or [PRIMARY]
+
+
+def shard_for(device_pk):
+    """Returns the alias of the shard storing the logs of a device (None if sharding is disabled)."""
+    shards = log_shards()
+    if not shards:
+        return None
+
+    return max(shards, key=lambda alias: zlib.crc32(f'{alias}:{device_pk}'.encode()))
+
+
+def device_logs(device_pk):
+    """Returns a QuerySet of the logs of a device, on its shard."""
+    logs = Log.objects.filter(device__pk=device_pk)
+    shard = shard_for(device_pk)
+
+    return logs.using(shard) if shard is not None else logs
+
+
+def group_by_shard(device_pks):
+    """Returns a dictionary mapping each shard's alias to the list of the given devices' pks stored in it."""
+    groups = {}
+    for device_pk in device_pks:
+        groups.setdefault(shard_for(device_pk), []).append(device_pk)
+
+    return groups
+
+
+def group_logs_by_database(logs):
+    """Returns a dictionary mapping the alias of each database to the list of the given (unsaved) Logs to store in it."""
+    groups = {}
+    for log in logs:
+        groups.setdefault(shard_for(log.device_id) or PRIMARY, []).append(log)
+
+    return groups
+
+
+def scatter_logs(device_pks, query):
+    """Runs a query on the logs of the given devices, in parallel on each shard, and returns all the resulting rows.
+
+    Each row must depend on the logs of a single device (ex. group by device), so the rows of different shards never
+    need to be merged.
+
+    :param device_pks: Primary keys of the devices.
+    :param query: A function taking a QuerySet of Logs and returning an iterable of rows.
+    :return: The list of rows of all the shards.
+    """
+    device_pks = list(device_pks)
+    if not log_shards():
+        return list(query(Log.objects.filter(device__pk__in=device_pks)))
+
+    def run(alias, shard_device_pks):
+        try:
+            with guardrails.statement_timeout(alias):
+                return list(query(Log.objects.using(alias).filter(device_id__in=shard_device_pks)))
+        finally:
+            # connections are per thread, the pool's threads must not keep them open
+            connections[alias].close()
+
+    groups = group_by_shard(device_pks)
+    with ThreadPoolExecutor(max_workers=len(groups) or 1) as executor:
+        # each query runs in a copy of the caller's context (ex. the statement timeout of the view)
+        futures = [executor.submit(copy_context().run, run, alias, shard_device_pks)
+                   for alias, shard_device_pks in groups.items()]
+        results = [future.result() for future in futures]
+
+    return [row for rows in results for row in rows]
+
+
+@receiver(pre_delete, sender=Device)
+def _delete_device_logs(sender, instance, **kwargs):
+    # deletions cascade only on the device's database, the logs on its shard are deleted here
+    shard = shard_for(instance.pk)
+    if shard is not None and shard != PRIMARY:
+        Log.objects.using(shard).filter(device_id=instance.pk).delete()
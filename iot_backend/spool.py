@@ -0,0 +1,357 @@
+"""
+This module implements the local spool used to ingest logs outside of the web workers.
+
+When settings.IOT_INGEST_MODE is 'spool', the dispatcher appends each received log to a spool segment instead of
+saving it: an append-only NDJSON file in settings.IOT_SPOOL_DIR, one line per log:
+
+    {"t": "<reception datetime, ISO 8601>", "log": {<log file>}}
+
+Each web process writes its own segments ('<host>-<pid>-<time>.ndjson.part'), a segment is closed (renamed without
+the '.part' suffix) when it exceeds settings.IOT_SPOOL_SEGMENT_BYTES or settings.IOT_SPOOL_SEGMENT_SECONDS (by a
+timer if the process stops appending to it) and when the process exits. The segments left open by a process which
+died are closed by the ingest workers (see close_abandoned).
+
+Segments are consumed by the workers started by the 'ingest_spool' management command. Each segment is assigned to
+a worker by hash of its name, the worker saves its logs in batches and stores the offset reached in the SpoolOffset
+table in the same transaction, so a crashed worker resumes exactly where the last committed batch ended (when the
+logs are sharded, see sharding.py, they are committed on their shards before the offset: a crash in between makes the
+batch be ingested again, its logs with a message identifier are then skipped, see dedup.py).
+Closed segments are deleted once fully ingested.
+
+A batch failing with an error other than an unavailable database is ingested again one line at a time: the lines
+which can't be ingested (and the ones which can't be parsed) are moved to the quarantine directory instead of
+blocking their segment forever (see quarantine).
+"""
+
+import atexit
+import json
+import os
+import socket
+import zlib
+from threading import Lock, Timer
+from time import monotonic, time, time_ns
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction, InterfaceError, OperationalError
+from django.utils.dateparse import parse_datetime
+
+from .models import Device, Log, SpoolOffset, LOG_IDENTITY_KEYS
+from . import dedup, ingest, sharding, validators
+
+OPEN_SUFFIX = '.ndjson.part'
+CLOSED_SUFFIX = '.ndjson'
+
+# max number of devices cached by each worker
+MAX_CACHED_DEVICES = 10000
+
+# subdirectory of settings.IOT_SPOOL_DIR where the lines which can't be ingested are moved (see quarantine)
+QUARANTINE_DIR = 'quarantine'
+
+# errors of an unavailable database: the lines are ingested again later instead of being quarantined
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+class SpoolWriter:
+    """Appends lines to the current segment of the process, rotating it when it gets too big or too old."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pid = None
+        self._fd = None
+        self._path = None
+        self._size = 0
+        self._opened = 0.0
+
+    def append(self, line):
+        with self._lock:
+            if (self._pid != os.getpid() or
+                    self._size >= getattr(settings, 'IOT_SPOOL_SEGMENT_BYTES', 64 * 1024 * 1024) or
+                    monotonic() - self._opened >= getattr(settings, 'IOT_SPOOL_SEGMENT_SECONDS', 60)):
+                self._rotate()
+
+            view = memoryview(line)
+            while view:
+                view = view[os.write(self._fd, view):]
+            self._size += len(line)
+
+            if getattr(settings, 'IOT_SPOOL_FSYNC', False):
+                os.fsync(self._fd)
+
+    def close(self, expired=False):
+        """Closes the current segment of the process (only if it is older than settings.IOT_SPOOL_SEGMENT_SECONDS
+        if 'expired'), the next append opens a new one."""
+        with self._lock:
+            if self._fd is None or self._pid != os.getpid():
+                return
+            if expired and monotonic() - self._opened < getattr(settings, 'IOT_SPOOL_SEGMENT_SECONDS', 60):
+                return
+
+            self._close()
+
+    def _rotate(self):
+        # after a fork the segment belongs to the parent process, it must not be closed by the child
+        if self._fd is not None and self._pid == os.getpid():
+            self._close()
+
+        spool_dir = settings.IOT_SPOOL_DIR
+        os.makedirs(spool_dir, exist_ok=True)
+
+        self._pid = os.getpid()
+        self._path = os.path.join(spool_dir, f'{socket.gethostname()}-{self._pid}-{time_ns()}{OPEN_SUFFIX}')
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._size = 0
+        self._opened = monotonic()
+
+        # a segment is closed when it gets too old even if the process stops appending to it
+        timer = Timer(getattr(settings, 'IOT_SPOOL_SEGMENT_SECONDS', 60), self.close, kwargs={'expired': True})
+        timer.daemon = True
+        timer.start()
+
+    def _close(self):
+        os.close(self._fd)
+        self._fd = None
+        try:
+            os.rename(self._path, self._path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+        except FileNotFoundError:
+            # closed by an ingest worker as abandoned (see close_abandoned)
+            pass
+
+
+writer = SpoolWriter()
+atexit.register(writer.close)
+
+
+def append(document, reception_datetime):
+    """Appends a received log to the spool.
+
+    :param document: The log file (dict).
+    :param reception_datetime: The reception datetime of the log.
+    """
+    line = json.dumps({'t': reception_datetime, 'log': document}, cls=DjangoJSONEncoder, separators=(',', ':'))
+    writer.append(f'{line}\n'.encode())
+
+
+def list_segments(worker_index=0, workers=1):
+    """Returns the paths of the spool segments assigned to a worker, in order of creation.
+
+    :param worker_index: Index of the worker (from 0 to workers - 1).
+    :param workers: Number of workers.
+    """
+    spool_dir = settings.IOT_SPOOL_DIR
+    if not os.path.isdir(spool_dir):
+        return []
+
+    segments = []
+    for name in os.listdir(spool_dir):
+        if (name.endswith(OPEN_SUFFIX) or name.endswith(CLOSED_SUFFIX)) and \
+                zlib.crc32(segment_name(name).encode()) % workers == worker_index:
+            segments.append(name)
+
+    # names start with the host and pid of the writer, followed by the creation time
+    segments.sort(key=lambda name: int(segment_name(name).rsplit('-', 1)[1]))
+
+    return [os.path.join(spool_dir, name) for name in segments]
+
+
+def segment_name(path):
+    """Returns the name of a segment, which does not change when the segment is closed."""
+    name = os.path.basename(path)
+
+    return name[:-len(OPEN_SUFFIX)] if name.endswith(OPEN_SUFFIX) else name[:-len(CLOSED_SUFFIX)]
+
+
+def consume_segment(path, batch_size, devices):
+    """Ingests the lines of a segment not yet ingested, in batches, and deletes the segment if it is closed and done.
+
+    :param path: Path of the segment.
+    :param batch_size: Max number of lines saved in each transaction.
+    :param devices: Cache of the devices (dict) by identity keys' values, shared by the calls of a worker.
+    :return: The number of lines read.
+    """
+    name = segment_name(path)
+    if path.endswith(OPEN_SUFFIX):
+        path = close_abandoned(path)
+    closed = path.endswith(CLOSED_SUFFIX)
+    spool_offset, created = SpoolOffset.objects.get_or_create(segment=name)
+    consumed = 0
+
+    try:
+        segment = open(path, 'rb')
+    except FileNotFoundError:
+        # closed (renamed) by its writer in the meantime, it will be consumed with its new name
+        return 0
+
+    with segment:
+        segment.seek(spool_offset.offset)
+
+        while True:
+            lines = []
+            offset = spool_offset.offset
+            while len(lines) < batch_size:
+                line = segment.readline()
+                if not line.endswith(b'\n'):
+                    # a line without its newline is still being written, unless the segment is closed: its writer
+                    # crashed while writing it (the truncated line is quarantined)
+                    if line and closed:
+                        lines.append(line)
+                        offset += len(line)
+                    break
+                lines.append(line)
+                offset += len(line)
+
+            if not lines:
+                break
+
+            try:
+                with transaction.atomic():
+                    ingest_lines(lines, devices, name)
+                    _save_offset(spool_offset, offset)
+
+            except TRANSIENT_ERRORS:
+                raise
+
+            except Exception as e:
+                # a line makes the whole batch fail: the lines are ingested again one by one to quarantine it
+                print(f"Failed to ingest a batch of segment {name} ({e!r}), retrying its lines one by one")
+                for line in lines:
+                    ingest_line_or_quarantine(line, devices, name, spool_offset)
+
+            consumed += len(lines)
+
+    if closed and spool_offset.offset >= os.path.getsize(path):
+        os.remove(path)
+        spool_offset.delete()
+
+    return consumed
+
+
+def _save_offset(spool_offset, offset):
+    previous = spool_offset.offset
+    spool_offset.offset = offset
+    try:
+        spool_offset.save(update_fields=['offset'])
+    except Exception:
+        spool_offset.offset = previous
+        raise
+
+
+def ingest_line_or_quarantine(line, devices, segment, spool_offset):
+    """Ingests a single line and advances the offset past it, quarantining the line if it can't be ingested.
+
+    :raise TRANSIENT_ERRORS: If the database is not available (the line is not quarantined).
+    """
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                ingest_lines([line], devices, segment)
+
+        except TRANSIENT_ERRORS:
+            raise
+
+        except Exception as e:
+            quarantine(segment, line, repr(e))
+
+        _save_offset(spool_offset, spool_offset.offset + len(line))
+
+
+def quarantine(segment, line, reason):
+    """Moves a line which can't be ingested to the quarantine of its segment (see QUARANTINE_DIR).
+
+    The quarantine files are segments themselves: once fixed they can be moved back to the spool directory.
+    The line is written when the transaction advancing the offset past it commits (a rolled back batch is ingested
+    again, its lines must not be quarantined twice).
+    """
+    def write():
+        print(f"Quarantined a line of segment {segment} ({reason}): {line[:200]}")
+
+        quarantine_dir = os.path.join(settings.IOT_SPOOL_DIR, QUARANTINE_DIR)
+        os.makedirs(quarantine_dir, exist_ok=True)
+        with open(os.path.join(quarantine_dir, f'{segment}{CLOSED_SUFFIX}'), 'ab') as quarantine_file:
+            quarantine_file.write(line if line.endswith(b'\n') else line + b'\n')
+
+    transaction.on_commit(write)
+
+
+def close_abandoned(path):
+    """Closes an open segment if it has been abandoned by its writer (ex. the writer process died).
+
+    Writers close their segments after settings.IOT_SPOOL_SEGMENT_SECONDS even when idle, so an open segment not
+    modified for twice as long has no writer anymore.
+
+    :return: The path of the segment, closed or not.
+    """
+    try:
+        idle_seconds = time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return path
+
+    if idle_seconds < 2 * getattr(settings, 'IOT_SPOOL_SEGMENT_SECONDS', 60):
+        return path
+
+    closed_path = path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX
+    try:
+        os.rename(path, closed_path)
+    except FileNotFoundError:
+        # closed by its writer in the meantime
+        return path
+
+    print(f"Closed the abandoned segment {segment_name(path)}")
+
+    return closed_path
+
+
+def ingest_lines(lines, devices, segment=None):
+    """Saves the logs of a batch of spool lines, skipping (and printing) the invalid ones.
+
+    The lines which can't be parsed are quarantined (see quarantine) if the segment is given.
+
+    The same steps of save_device_log_data are applied: device identification, validation, deduplication and the
+    steps following the save (see ingest.process_saved_logs).
+
+    :param lines: List of spool lines (bytes).
+    :param devices: Cache of the devices (dict) by identity keys' values.
+    :param segment: Name of the segment of the lines.
+    :return: The list of saved Logs.
+    """
+    logs = []
+    for line in lines:
+        try:
+            message = json.loads(line)
+            document = message['log']
+            reception_datetime = parse_datetime(message['t'])
+            key = tuple(document[identity_key] for identity_key in LOG_IDENTITY_KEYS)
+
+        except (ValueError, KeyError, TypeError) as e:
+            if segment is None:
+                print(f"Invalid spool line ({e!r}): {line[:200]}")
+            else:
+                quarantine(segment, line, repr(e))
+            continue
+
+        device = devices.get(key)
+        if device is None:
+            device = Device.objects.filter(serial_number=key[0], type__kind=key[1], type__model=key[2],
+                                           type__hardware_version=key[3]).first()
+            if device is None:
+                print(f"No Device matching the log file's identity keys: {key}")
+                continue
+
+            if len(devices) >= MAX_CACHED_DEVICES:
+                devices.clear()
+            devices[key] = device
+
+        errors = validators.validate_log(device.type_id, document)
+        if errors:
+            print(f"Invalid log file from device with pk={device.pk}: {errors}")
+            continue
+
+        logs.append(Log.from_document(device, document, reception_datetime=reception_datetime))
+
+    # logs delivered again (or ingested again after a crash) are skipped
+    logs = [log for alias, shard_logs in sharding.group_logs_by_database(logs).items()
+            for log in dedup.save_logs(shard_logs, alias)]
+
+    ingest.process_saved_logs(logs)
+
+    return logs
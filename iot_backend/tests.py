@@ -1,3 +1,1100 @@
-from django.test import TestCase
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from contextvars import copy_context
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connections, IntegrityError
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import pytz
+
+from .admin import LogAdmin
+from .models import DeviceType, Device, Log, DeviceLatestValues, Rule, RuleState, RuleEvent, SpoolOffset
+from . import (dedup, guardrails, livestream, recentcache, routers, rules, sharding, spool, timebuckets, validators,
+               views)
+
+LOG_DOCUMENT = {
+    'serial': '1234567890',
+    'kind': 'coffee machine',
+    'model': 'modelA',
+    'hw': 'ABC001',
+    'fw': '20201001',
+    'ta0': 45.0,
+    'tb0': 25.3,
+}
+
+
+class DevicesMixin:
+    """Creates a DeviceType and three of its devices for each test."""
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.device_type = DeviceType.objects.create(kind='coffee machine', model='modelA',
+                                                     hardware_version='ABC001', data_format={})
+        self.devices = [Device.objects.create(serial_number=str(i), type=self.device_type, aws_thing_name=f'thing{i}',
+                                              owner=self.owner) for i in range(3)]
+
+    def post_log(self, device, **values):
+        """Posts a log of the device (LOG_DOCUMENT with the given values) to the ingest endpoint."""
+        document = dict(LOG_DOCUMENT, serial=device.serial_number, **values)
+        return self.client.post('/iot/devices/', json.dumps(document), content_type='application/json', HTTP_LOG='1')
+
+    def create_log(self, device, reception_datetime, **values):
+        """Saves a log of the device (LOG_DOCUMENT with the given values) received at the given datetime."""
+        log = Log.from_document(device, dict(LOG_DOCUMENT, serial=device.serial_number, **values),
+                                reception_datetime=reception_datetime)
+        log.save()
+        return log
+
+
+class IotTestCase(DevicesMixin, TestCase):
+    """Base test case with a DeviceType and three of its devices."""
+
+
+def utc(*args):
+    """Returns an aware UTC datetime."""
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class CompactLogStorageTests(IotTestCase):
+
+    @override_settings(IOT_COMPACT_LOG_STORAGE=True)
+    def test_identity_keys_are_stripped(self):
+        self.assertEqual(self.post_log(self.devices[0], ta0=1.0).status_code, 201)
+
+        log = Log.objects.get()
+        self.assertTrue(log.compact)
+        self.assertFalse(set(log.log_file) & {'serial', 'kind', 'model', 'hw'})
+        self.assertEqual(log.document, dict(LOG_DOCUMENT, serial='0', ta0=1.0))
+
+    @override_settings(IOT_COMPACT_LOG_STORAGE=False)
+    def test_compact_logs_command(self):
+        self.post_log(self.devices[0])
+        self.assertFalse(Log.objects.get().compact)
+
+        call_command('compact_logs', stdout=StringIO())
+
+        log = Log.objects.get()
+        self.assertTrue(log.compact)
+        self.assertNotIn('serial', log.log_file)
+        self.assertEqual(log.document, dict(LOG_DOCUMENT, serial='0'))
+
+
+class CompareDevicesTests(IotTestCase):
+
+    def test_series_share_the_time_axis(self):
+        self.create_log(self.devices[0], utc(2020, 10, 1, 10, 5), ta0=1.0)
+        self.create_log(self.devices[0], utc(2020, 10, 1, 10, 40), ta0=3.0)
+        self.create_log(self.devices[1], utc(2020, 10, 1, 12, 10), ta0=5.0)
+
+        pks = f'{self.devices[0].pk}&{self.devices[1].pk}'
+        response = self.client.get(f'/iot/devices/comparedata/hour/avg/{pks}/ta0/')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['axis'], ['2020-10-01T10:00:00Z', '2020-10-01T12:00:00Z'])
+        self.assertEqual(data['series'], {
+            str(self.devices[0].pk): {'ta0': [2.0, None]},
+            str(self.devices[1].pk): {'ta0': [None, 5.0]},
+        })
+
+    def test_chart(self):
+        self.create_log(self.devices[0], utc(2020, 10, 1, 10, 5))
+
+        response = self.client.get(f'/iot/devices/comparechart/day/max/{self.devices[0].pk}/ta0&tb0/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'chart-data')
+
+    def test_time_range(self):
+        for hour in (9, 10, 11):
+            self.create_log(self.devices[0], utc(2020, 10, 1, hour), ta0=float(hour))
+
+        response = self.client.get(f'/iot/devices/comparedata/hour/max/{self.devices[0].pk}/ta0/',
+                                   {'start': '2020-10-01T10:00:00Z', 'end': '2020-10-01T11:00:00Z'})
+
+        self.assertEqual(response.json()['axis'], ['2020-10-01T10:00:00Z'])
+        self.assertEqual(response.json()['series'], {str(self.devices[0].pk): {'ta0': [10.0]}})
+        response = self.client.get(f'/iot/devices/comparedata/hour/max/{self.devices[0].pk}/ta0/', {'start': 'bad'})
+        self.assertEqual(response.status_code, 404)
+
+    @mock.patch.object(timebuckets, 'MAX_BUCKETS', 2)
+    def test_too_many_buckets(self):
+        for hour in (9, 10, 11):
+            self.create_log(self.devices[0], utc(2020, 10, 1, hour), ta0=float(hour))
+            self.create_log(self.devices[1], utc(2020, 10, 1, hour), ta0=float(hour))
+        pks = f'{self.devices[0].pk}&{self.devices[1].pk}'
+
+        self.assertEqual(self.client.get(f'/iot/devices/comparedata/hour/max/{pks}/ta0/').status_code, 404)
+        self.assertEqual(self.client.get(f'/iot/devices/comparedata/day/max/{pks}/ta0/').status_code, 200)
+
+    def test_unknown_device(self):
+        response = self.client.get(f'/iot/devices/comparedata/day/avg/{self.devices[0].pk}&999/ta0/')
+
+        self.assertEqual(response.status_code, 404)
+
+
+class FleetAggregateTests(IotTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i, device in enumerate(self.devices):
+            self.create_log(device, utc(2020, 10, 1), ta0=float(i))
+            self.create_log(device, utc(2020, 10, 2), ta0=float(i + 10))
+
+    def test_whole_fleet(self):
+        response = self.client.get('/iot/devices/fleetaggregatedata/min&max&avg/ta0/?kind=coffee%20machine')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [{'logs': 6, 'ta0': {'min': 0.0, 'max': 12.0, 'avg': 6.0}}])
+
+    def test_group_by_device_and_time_range(self):
+        response = self.client.get('/iot/devices/fleetaggregatedata/avg/ta0/'
+                                   '?model=modelA&group_by=device&start=2020-10-02')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {'device': device.pk, 'logs': 1, 'ta0': {'avg': float(i + 10)}} for i, device in enumerate(self.devices)
+        ])
+
+    def test_bad_parameters(self):
+        # the devices must be selected by their type
+        self.assertEqual(self.client.get('/iot/devices/fleetaggregatedata/avg/ta0/').status_code, 400)
+        self.assertEqual(self.client.get('/iot/devices/fleetaggregatedata/avg/ta0/?kind=x&group_by=x').status_code, 400)
+        self.assertEqual(self.client.get('/iot/devices/fleetaggregatedata/sum/ta0/?kind=x').status_code, 404)
+
+
+class RulesTests(IotTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the rolling states are kept by the process (see rules.py)
+        rules._states.clear()
+        rules._dirty.clear()
+        self.rule = Rule.objects.create(device_type=self.device_type, name='hot', attribute='ta0',
+                                        kind=Rule.THRESHOLD, max_value=50)
+
+    def test_events_on_violations_only(self):
+        for value in (10, 60, 70, 10, 60):
+            self.assertEqual(self.post_log(self.devices[0], ta0=value).status_code, 201)
+
+        self.assertEqual([event.value for event in RuleEvent.objects.order_by('pk')], [60.0, 60.0])
+        event = RuleEvent.objects.first()
+        self.assertEqual(event.device, self.devices[0])
+        self.assertEqual(event.log.log_file['ta0'], 60)
+
+    def test_rate_and_zscore_measures(self):
+        rate = Rule(kind=Rule.RATE)
+        state = {}
+        self.assertIsNone(rules.update_measure(rate, state, 10.0, 100.0))
+        self.assertEqual(rules.update_measure(rate, state, 20.0, 105.0), 2.0)
+
+        zscore = Rule(kind=Rule.ZSCORE, window=3)
+        state = {}
+        measures = [rules.update_measure(zscore, state, value, i) for i, value in enumerate([1, 2, 1, 2, 100])]
+        self.assertEqual(measures[:3], [None, None, None])
+        self.assertGreater(measures[-1], 3)
+
+    def test_checkpoint_overwrites_concurrent_states(self):
+        self.post_log(self.devices[0], ta0=60)
+        # another process has checkpointed the same state in the meantime
+        RuleState.objects.create(rule=self.rule, device=self.devices[0], state={'violated': False})
+
+        rules.checkpoint()
+
+        rule_state = RuleState.objects.get()
+        self.assertTrue(rule_state.state['violated'])
+        self.assertEqual(rules._states[(self.rule.pk, self.devices[0].pk)].pk, rule_state.pk)
+
+    def test_checkpoint_writes_without_holding_the_lock(self):
+        self.post_log(self.devices[0], ta0=60)
+
+        def lock_is_free():
+            acquired = rules._lock.acquire(blocking=False)
+            if acquired:
+                rules._lock.release()
+            return acquired
+
+        def write(*args, **kwargs):
+            with ThreadPoolExecutor(1) as executor:
+                self.assertTrue(executor.submit(lock_is_free).result())
+            raise IntegrityError
+
+        with mock.patch.object(RuleState.objects, 'update_or_create', side_effect=write):
+            with self.assertRaises(IntegrityError):
+                rules.checkpoint()
+
+        # the states not saved stay dirty
+        self.assertEqual(rules._dirty, {(self.rule.pk, self.devices[0].pk)})
+        self.assertIsNone(rules._states[(self.rule.pk, self.devices[0].pk)].pk)
+        rules.checkpoint()
+        self.assertTrue(RuleState.objects.get().state['violated'])
+        self.assertFalse(rules._dirty)
+
+    def test_failures_do_not_fail_ingest(self):
+        with mock.patch.object(rules, '_evaluate_log', side_effect=RuntimeError), redirect_stdout(StringIO()):
+            self.assertEqual(self.post_log(self.devices[0], ta0=60).status_code, 201)
+
+        self.assertEqual(Log.objects.count(), 1)
+        self.assertFalse(RuleEvent.objects.exists())
+
+
+def timestamp_ms(value):
+    """Returns a datetime as milliseconds since the Unix epoch (the first value of the rows of the chart series)."""
+    return int(value.timestamp() * 1000)
+
+
+class TimeBucketsTests(IotTestCase):
+
+    def test_parse_timeframe(self):
+        self.assertEqual(timebuckets.parse_timeframe('hour'), 'hour')
+        self.assertEqual(timebuckets.parse_timeframe('15m'), 900)
+        self.assertEqual(timebuckets.parse_timeframe('2d'), 172800)
+        self.assertEqual(timebuckets.parse_timeframe('PT30M'), 1800)
+        for timeframe in ('bad', '0s', 'P0D'):
+            with self.assertRaises(ValueError):
+                timebuckets.parse_timeframe(timeframe)
+
+    def test_fill_gaps(self):
+        buckets = [utc(2020, 10, 1, 10), utc(2020, 10, 1, 13)]
+
+        self.assertEqual(timebuckets.fill_gaps(buckets, 'hour', timezone.utc),
+                         [utc(2020, 10, 1, hour) for hour in range(10, 14)])
+        self.assertEqual(timebuckets.fill_gaps(buckets, 5400, timezone.utc),
+                         [utc(2020, 10, 1, 10), utc(2020, 10, 1, 11, 30), utc(2020, 10, 1, 13)])
+
+    def test_fixed_width_buckets(self):
+        device = self.devices[0]
+        for minute, value in ((5, 1.0), (10, 3.0), (20, 5.0)):
+            self.create_log(device, utc(2020, 10, 1, 10, minute), ta0=value)
+
+        response = self.client.get(f'/iot/devices/columnseries/15m/avg/{device.pk}/ta0/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['rows'], [[timestamp_ms(utc(2020, 10, 1, 10)), 2.0],
+                                                   [timestamp_ms(utc(2020, 10, 1, 10, 15)), 5.0]])
+
+    def test_buckets_start_at_local_midnight(self):
+        device = self.devices[0]
+        self.create_log(device, utc(2020, 10, 1, 10), ta0=1.0)
+        self.create_log(device, utc(2020, 10, 1, 20), ta0=2.0)  # the next day in India (UTC+5:30)
+
+        response = self.client.get(f'/iot/devices/columnseries/1d/max/{device.pk}/ta0/?tz=Asia/Kolkata')
+
+        kolkata = pytz.timezone('Asia/Kolkata')
+        self.assertEqual(response.json()['rows'], [[timestamp_ms(kolkata.localize(datetime(2020, 10, 1))), 1.0],
+                                                   [timestamp_ms(kolkata.localize(datetime(2020, 10, 2))), 2.0]])
+
+    def test_day_buckets_follow_daylight_saving_time(self):
+        device = self.devices[0]
+        rome = pytz.timezone('Europe/Rome')
+        self.create_log(device, utc(2020, 1, 15, 23, 30), ta0=1.0)  # 00:30 in Rome (UTC+1)
+        self.create_log(device, utc(2020, 3, 29, 0, 30), ta0=2.0)  # 01:30, before the change to UTC+2 at 02:00
+        self.create_log(device, utc(2020, 3, 29, 22, 30), ta0=3.0)  # 00:30 the next day (UTC+2)
+
+        response = self.client.get(f'/iot/devices/columnseries/1d/max/{device.pk}/ta0/?tz=Europe/Rome')
+
+        self.assertEqual(response.json()['rows'], [[timestamp_ms(rome.localize(datetime(2020, 1, 16))), 1.0],
+                                                   [timestamp_ms(rome.localize(datetime(2020, 3, 29))), 2.0],
+                                                   [timestamp_ms(rome.localize(datetime(2020, 3, 30))), 3.0]])
+        self.assertEqual(timebuckets.fill_gaps([rome.localize(datetime(2020, 3, 28)),
+                                                rome.localize(datetime(2020, 3, 31))], 86400, rome),
+                         [rome.localize(datetime(2020, 3, day)) for day in range(28, 32)])
+
+    def test_column_chart(self):
+        device = self.devices[0]
+        self.create_log(device, timezone.now() - timedelta(minutes=20))
+        self.create_log(device, timezone.now())
+
+        self.assertEqual(self.client.get(f'/iot/devices/columnchart/15m/avg/{device.pk}/ta0/').status_code, 200)
+        self.assertEqual(self.client.get(f'/iot/devices/columnchart/bad/avg/{device.pk}/ta0/').status_code, 404)
+        self.assertEqual(self.client.get(f'/iot/devices/columnchart/day/avg/{device.pk}/ta0/?tz=Nope').status_code,
+                         404)
+
+
+class LatestValuesTests(IotTestCase):
+
+    def test_latest_log_is_recorded(self):
+        self.post_log(self.devices[0], ta0=1.0)
+        self.post_log(self.devices[0], ta0=2.0)
+        self.post_log(self.devices[1], ta0=3.0)
+
+        response = self.client.get('/iot/devices/latest/?kind=coffee%20machine&attributes=ta0%26tb0')
+
+        self.assertEqual(response.status_code, 200)
+        devices = response.json()['devices']
+        self.assertEqual(list(devices), [str(self.devices[0].pk), str(self.devices[1].pk)])
+        self.assertEqual(devices[str(self.devices[0].pk)]['values'], {'ta0': 2.0, 'tb0': 25.3})
+        self.assertEqual(devices[str(self.devices[1].pk)]['values'], {'ta0': 3.0, 'tb0': 25.3})
+
+    def test_older_logs_do_not_overwrite(self):
+        newer = self.create_log(self.devices[0], utc(2020, 10, 2), ta0=2.0)
+        older = self.create_log(self.devices[0], utc(2020, 10, 1), ta0=1.0)
+
+        DeviceLatestValues.record(newer)
+        DeviceLatestValues.record(older)
+
+        latest = DeviceLatestValues.objects.get(device=self.devices[0])
+        self.assertEqual(latest.reception_datetime, utc(2020, 10, 2))
+        self.assertEqual(latest.values['ta0'], 2.0)
+        self.assertNotIn('serial', latest.values)
+
+    def test_rebuild_latest_values(self):
+        self.create_log(self.devices[0], utc(2020, 10, 1), ta0=1.0)
+        self.create_log(self.devices[0], utc(2020, 10, 2), ta0=2.0)
+
+        call_command('rebuild_latest_values', stdout=StringIO())
+
+        self.assertEqual(DeviceLatestValues.objects.get().values['ta0'], 2.0)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get('/iot/devices/latest/').status_code, 400)
+        self.assertEqual(self.client.get('/iot/devices/latest/?pks=1%26x').status_code, 400)
+
+
+class KeysetAdminTests(IotTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.logs = [self.create_log(self.devices[0], utc(2020, 10, 1, hour)) for hour in range(5)]
+
+    def test_pages_by_primary_key(self):
+        pages = []
+        query_string = ''
+        with mock.patch.object(LogAdmin, 'list_per_page', 2):
+            while query_string is not None:
+                response = self.client.get(f'/admin/iot_backend/log/{query_string}')
+                self.assertEqual(response.status_code, 200)
+                changelist = response.context['cl']
+                pages.append([log.pk for log in changelist.result_list])
+                query_string = changelist.next_page_url
+
+        pks = [log.pk for log in reversed(self.logs)]
+        self.assertEqual(pages, [pks[0:2], pks[2:4], pks[4:]])
+        self.assertIsNotNone(changelist.first_page_url)
+
+    def test_device_admin(self):
+        response = self.client.get('/admin/iot_backend/device/', {'q': self.devices[1].serial_number})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['cl'].result_list), [self.devices[1]])
+
+
+def chart_data(response):
+    """Returns the chart's table embedded in a chart page (see views.chart_json_script)."""
+    match = re.search(r'<script id="chart-data" type="application/json">(.*?)</script>', response.content.decode(),
+                      re.DOTALL)
+    return json.loads(match.group(1))
+
+
+class ChartPayloadTests(IotTestCase):
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_chart_json_script(self):
+        script = views.chart_json_script(['Date', 'ta0'], [[utc(2020, 10, 1), 1.5], [utc(2020, 10, 2), None]])
+
+        self.assertIn('id="chart-data"', script)
+        self.assertEqual(json.loads(re.search(r'>(.*)<', script).group(1)), {
+            'header': ['Date', 'ta0'],
+            'rows': [[timestamp_ms(utc(2020, 10, 1)), 1.5], [timestamp_ms(utc(2020, 10, 2)), None]],
+        })
+
+    def test_line_chart_payload(self):
+        device = self.devices[0]
+        self.create_log(device, utc(2020, 10, 1, 10), ta0=1.0, tb0=2.0)
+        self.create_log(device, utc(2020, 10, 1, 11), ta0=3.0, tb0=4.0)
+
+        response = self.client.get(f'/iot/devices/linechart/{device.pk}/ta0&tb0/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(chart_data(response), {
+            'header': ['Date', 'ta0', 'tb0'],
+            'rows': [[timestamp_ms(utc(2020, 10, 1, 10)), 1.0, 2.0], [timestamp_ms(utc(2020, 10, 1, 11)), 3.0, 4.0]],
+        })
+
+    def test_line_chart_points_do_not_depend_on_estimated_count(self):
+        device = self.devices[0]
+        for minute in range(300):
+            self.create_log(device, utc(2020, 10, 1) + timedelta(minutes=minute), ta0=float(minute))
+        url = f'/iot/devices/linechart/{device.pk}/ta0/'
+
+        for estimate in [10, 10 ** 6]:
+            with self.subTest(estimate=estimate), \
+                    mock.patch.object(guardrails, 'estimated_count', return_value=estimate):
+                rows = chart_data(self.client.get(f'{url}?estimate={estimate}'))['rows']
+
+                self.assertGreater(len(rows), 90)
+                self.assertLessEqual(len(rows), 101)
+                self.assertEqual(rows[0], [timestamp_ms(utc(2020, 10, 1)), 1.0])
+
+    @override_settings(IOT_CHART_CACHE_SECONDS=60)
+    def test_cached_chart(self):
+        device = self.devices[0]
+        self.create_log(device, utc(2020, 10, 1, 10))
+        url = f'/iot/devices/linechart/{device.pk}/ta0/'
+        first = self.client.get(url)
+
+        self.create_log(device, utc(2020, 10, 1, 11))
+
+        self.assertEqual(self.client.get(url).content, first.content)
+        self.assertEqual(len(chart_data(self.client.get(f'{url}?v=2'))['rows']), 2)
+
+
+class StartupTests(TestCase):
+
+    def test_production_settings(self):
+        from iot_server import settings_production
+
+        self.assertFalse(settings_production.DEBUG)
+        self.assertNotIn('debug_toolbar', settings_production.INSTALLED_APPS)
+        self.assertFalse([middleware for middleware in settings_production.MIDDLEWARE if 'debug_toolbar' in middleware])
+
+    def test_lazy_modules_are_not_imported_on_startup(self):
+        out = StringIO()
+        # the debug toolbar is imported by the development (and test) settings only
+        call_command('bench_startup', runs=1, allow_lazy_modules=True, stdout=out)
+
+        modules = re.search(r'should be lazy: (.*)', out.getvalue()).group(1)
+        self.assertIn(modules, ['none', "['debug_toolbar']"])
+
+
+class LiveStreamTests(IotTestCase):
+
+    def test_pending_points_are_bounded(self):
+        notified = []
+        with override_settings(IOT_STREAM_MAX_PENDING=2):
+            subscriber = livestream.Subscriber(self.devices[0].pk, ['ta0', 'xx'], lambda: notified.append(True))
+        for i in range(3):
+            subscriber.push(i, {'ta0': i})
+
+        self.assertEqual(len(notified), 3)
+        message = subscriber.drain_message().decode()
+        self.assertTrue(message.startswith('event: logs\ndata: '))
+        self.assertEqual(json.loads(message.split('data: ')[1]), {'rows': [[1, 1, None], [2, 2, None]], 'dropped': 1})
+        self.assertIsNone(subscriber.drain_message())
+
+    @override_settings(IOT_STREAM_ENABLED=True)
+    def test_stream_receives_the_device_logs(self):
+        events = livestream.stream_events(self.devices[0].pk, ['ta0'])
+        self.assertEqual(next(events), b': connected\n\n')
+
+        self.post_log(self.devices[1], ta0=1.0)
+        self.post_log(self.devices[0], ta0=2.0)
+        log = Log.objects.get(device=self.devices[0])
+
+        self.assertEqual(json.loads(next(events).decode().split('data: ')[1]),
+                         {'rows': [[timestamp_ms(log.reception_datetime), 2.0]], 'dropped': 0})
+
+        events.close()
+        self.assertNotIn(self.devices[0].pk, livestream.broker._subscribers)
+
+    def test_streams_are_disabled_by_default(self):
+        device = self.devices[0]
+        self.create_log(device, utc(2020, 10, 1), ta0=1.0)
+
+        self.assertNotContains(self.client.get(f'/iot/devices/linechart/{device.pk}/ta0/'), 'EventSource')
+        self.assertEqual(self.client.get(f'/iot/devices/stream/{device.pk}/ta0/').status_code, 404)
+
+    @override_settings(IOT_STREAM_ENABLED=True)
+    def test_stream_view_does_not_hold_database_connections(self):
+        device = self.devices[0]
+        self.create_log(device, utc(2020, 10, 1), ta0=1.0)
+
+        self.assertContains(self.client.get(f'/iot/devices/linechart/{device.pk}/ta0/'), 'EventSource')
+        with mock.patch.object(views.connections, 'close_all') as close_all:
+            response = self.client.get(f'/iot/devices/stream/{device.pk}/ta0/')
+
+        self.assertEqual(response.status_code, 200)
+        close_all.assert_called_once_with()
+        response.close()
+
+    def test_logs_are_not_published_while_streams_are_disabled(self):
+        with mock.patch.object(livestream.broker, 'publish') as publish:
+            self.post_log(self.devices[0], ta0=1.0)
+            with override_settings(IOT_STREAM_ENABLED=True):
+                self.post_log(self.devices[0], ta0=2.0)
+
+        publish.assert_called_once()
+
+    def test_notifications_of_a_batch_are_sent_with_a_single_query(self):
+        logs = [self.create_log(self.devices[i], utc(2020, 10, 1), ta0=float(i)) for i in range(2)]
+        logs.append(self.create_log(self.devices[2], utc(2020, 10, 1), ta0='x' * livestream.MAX_NOTIFY_PAYLOAD))
+        database = mock.MagicMock()
+
+        with mock.patch.object(livestream, 'uses_notify', return_value=True), \
+                mock.patch.object(livestream, 'connections', {'default': database}):
+            livestream.broker.publish(logs)
+
+        cursor = database.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once()
+        channel, payloads = cursor.execute.call_args[0][1]
+        self.assertEqual(channel, 'iot_logs')
+        self.assertEqual([json.loads(payload) for payload in payloads], [
+            {'device': self.devices[0].pk, 'timestamp': timestamp_ms(utc(2020, 10, 1)), 'log_file': logs[0].log_file},
+            {'device': self.devices[1].pk, 'timestamp': timestamp_ms(utc(2020, 10, 1)), 'log_file': logs[1].log_file},
+            {'device': self.devices[2].pk, 'timestamp': timestamp_ms(utc(2020, 10, 1)), 'database': 'default',
+             'pk': logs[2].pk},
+        ])
+
+    def test_notifications_are_dispatched(self):
+        # the payloads sent through PostgreSQL notifications, with the log or a reference to it
+        subscriber = livestream.Subscriber(self.devices[0].pk, ['ta0'], lambda: None)
+        livestream.broker.subscribe(subscriber)
+        self.addCleanup(livestream.broker.unsubscribe, subscriber)
+        log = self.create_log(self.devices[0], utc(2020, 10, 1), ta0=3.0)
+
+        livestream.broker._dispatch_notification(json.dumps({'device': self.devices[0].pk, 'timestamp': 1,
+                                                             'log_file': {'ta0': 1.0}}))
+        livestream.broker._dispatch_notification(json.dumps({'device': self.devices[1].pk, 'timestamp': 2,
+                                                             'log_file': {'ta0': 2.0}}))
+        livestream.broker._dispatch_notification(json.dumps({'device': self.devices[0].pk, 'timestamp': 3,
+                                                             'database': 'default', 'pk': log.pk}))
+
+        self.assertEqual(json.loads(subscriber.drain_message().decode().split('data: ')[1]),
+                         {'rows': [[1, 1.0], [3, 3.0]], 'dropped': 0})
+
+
+class IncrementalSeriesTests(IotTestCase):
+
+    def series(self, attributes='ta0', **params):
+        response = self.client.get(f'/iot/devices/lineseries/{self.devices[0].pk}/{attributes}/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    @override_settings(IOT_SERIES_MAX_ROWS=2)
+    def test_pages_through_logs_received_at_the_same_datetime(self):
+        logs = [self.create_log(self.devices[0], utc(2020, 10, 1), ta0=float(i)) for i in range(5)]
+
+        ids = []
+        data = self.series()
+        while True:
+            ids += data['ids']
+            if not data['more']:
+                break
+            data = self.series(since=data['cursor'])
+
+        self.assertEqual(ids, [log.pk for log in logs])
+        self.assertEqual(self.series(since=data['cursor'])['ids'], [])
+
+    def test_overlap_returns_the_logs_saved_late(self):
+        first = self.create_log(self.devices[0], utc(2020, 10, 1, 10), ta0=1.0)
+        cursor = self.series()['cursor']
+        late = self.create_log(self.devices[0], utc(2020, 10, 1, 9, 59), ta0=2.0)
+        new = self.create_log(self.devices[0], utc(2020, 10, 1, 10, 1), ta0=3.0)
+
+        self.assertEqual(self.series(since=cursor)['ids'], [new.pk])
+        # the logs already received (first) are returned again too, the client skips them by pk
+        self.assertEqual(self.series(since=cursor, overlap=120)['ids'], [late.pk, first.pk, new.pk])
+
+    def test_rows_and_bad_cursors(self):
+        log = self.create_log(self.devices[0], utc(2020, 10, 1), ta0=1.0)
+
+        self.assertEqual(self.series('ta0&xx')['rows'], [[timestamp_ms(log.reception_datetime), 1.0, None]])
+        self.assertEqual(self.series(since='2020-10-02')['rows'], [])
+        for since in ('yesterday', '2020-10-01T00:00:00Z_x'):
+            response = self.client.get(f'/iot/devices/lineseries/{self.devices[0].pk}/ta0/', {'since': since})
+            self.assertEqual(response.status_code, 404)
+
+    def test_column_series_returns_the_changed_buckets(self):
+        device = self.devices[0]
+        self.create_log(device, utc(2020, 10, 1, 10, 10), ta0=1.0)
+        self.create_log(device, utc(2020, 10, 1, 11, 10), ta0=3.0)
+        url = f'/iot/devices/columnseries/hour/max/{device.pk}/ta0/'
+        cursor = self.client.get(url).json()['cursor']
+
+        self.create_log(device, utc(2020, 10, 1, 11, 20), ta0=5.0)
+
+        data = self.client.get(url, {'since': cursor}).json()
+        self.assertEqual(data['rows'], [[timestamp_ms(utc(2020, 10, 1, 11)), 5.0]])
+
+
+class ValidatorsTests(IotTestCase):
+
+    DATA_FORMAT = {
+        'ta0': {'type': 'number', 'min': -50, 'max': 150},
+        'fw': {'type': 'string', 'required': False},
+        'count': 'integer',
+    }
+
+    def test_errors(self):
+        validate = validators.compile_validator(self.DATA_FORMAT)
+
+        self.assertEqual(validate({'ta0': 20, 'count': 1, 'fw': 'x', 'other': None}), [])
+        self.assertEqual(validate({'ta0': 20}), ["missing attribute 'count'"])
+        self.assertEqual(validate({'ta0': 200, 'count': 1.5}), [
+            "attribute 'ta0' is greater than 150: 200",
+            "invalid type of attribute 'count': 1.5",
+        ])
+        # values of the wrong type are never compared with the bounds
+        self.assertEqual(validate({'ta0': '20', 'count': True}), [
+            "invalid type of attribute 'ta0': '20'",
+            "invalid type of attribute 'count': True",
+        ])
+
+    def test_invalid_data_formats(self):
+        for data_format in ([], {'ta0': 'float'}, {'fw': {'type': 'string', 'min': 'a'}},
+                            {'ta0': {'type': 'any', 'max': 10}}, {'ta0': {'type': 'number', 'min': '0'}}):
+            with self.assertRaises(ValueError):
+                validators.compile_validator(data_format)
+
+            with self.assertRaises(ValidationError):
+                DeviceType(kind='k', model='m', hardware_version='h', data_format=data_format).full_clean()
+
+    def test_invalid_logs_are_rejected(self):
+        self.device_type.data_format = self.DATA_FORMAT
+        self.device_type.save()
+
+        with redirect_stdout(StringIO()):
+            self.assertEqual(self.post_log(self.devices[0], ta0=500, count=1).status_code, 400)
+        self.assertEqual(self.post_log(self.devices[0], ta0=50, count=1).status_code, 201)
+        self.assertEqual(Log.objects.count(), 1)
+
+
+class SpoolTests(DevicesMixin, TransactionTestCase):
+    # the quarantined lines are written when their transaction commits
+
+    def setUp(self):
+        super().setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        settings_override = override_settings(IOT_SPOOL_DIR=self.spool_dir, IOT_INGEST_MODE='spool')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(spool.writer.close)
+
+    def write_segment(self, name, lines):
+        path = os.path.join(self.spool_dir, name)
+        with open(path, 'wb') as segment:
+            segment.write(b''.join(lines))
+        return path
+
+    def spool_line(self, device, reception_datetime='2020-10-01T00:00:00Z', **values):
+        document = dict(LOG_DOCUMENT, serial=device.serial_number, **values)
+        return f'{json.dumps({"t": reception_datetime, "log": document})}\n'.encode()
+
+    def quarantined_lines(self, segment):
+        with open(os.path.join(self.spool_dir, spool.QUARANTINE_DIR, f'{segment}.ndjson'), 'rb') as quarantine:
+            return quarantine.readlines()
+
+    def test_spooled_logs_are_ingested(self):
+        for value in (1.0, 2.0, 3.0):
+            self.assertEqual(self.post_log(self.devices[0], ta0=value).status_code, 202)
+        self.assertFalse(Log.objects.exists())
+        spool.writer.close()
+
+        call_command('ingest_spool', workers=1, once=True)
+
+        self.assertEqual(sorted(log.log_file['ta0'] for log in Log.objects.all()), [1.0, 2.0, 3.0])
+        # the steps following the save are the same of the direct ingest
+        self.assertEqual(DeviceLatestValues.objects.get().values['ta0'], 3.0)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        self.assertFalse(SpoolOffset.objects.exists())
+
+    def test_poison_lines_are_quarantined(self):
+        bad_lines = [b'not json\n', self.spool_line(self.devices[0], reception_datetime='bad')]
+        path = self.write_segment('host-1-1.ndjson', [self.spool_line(self.devices[0]), *bad_lines,
+                                                      self.spool_line(self.devices[1])])
+
+        with redirect_stdout(StringIO()):
+            self.assertEqual(spool.consume_segment(path, 10, {}), 4)
+
+        self.assertEqual(Log.objects.count(), 2)
+        self.assertEqual(self.quarantined_lines('host-1-1'), bad_lines)
+        self.assertFalse(os.path.exists(path))
+
+    def test_abandoned_segments_are_closed(self):
+        truncated = self.spool_line(self.devices[0])[:20]
+        path = self.write_segment('host-1-1.ndjson.part', [self.spool_line(self.devices[0]), truncated])
+
+        # a segment still written is left open
+        self.assertEqual(spool.consume_segment(path, 10, {}), 1)
+        self.assertTrue(os.path.exists(path))
+
+        old = time.time() - 3600
+        os.utime(path, (old, old))
+        with redirect_stdout(StringIO()):
+            spool.consume_segment(path, 10, {})
+
+        self.assertEqual(Log.objects.count(), 1)
+        self.assertEqual(self.quarantined_lines('host-1-1'), [truncated + b'\n'])
+        self.assertEqual(os.listdir(self.spool_dir), [spool.QUARANTINE_DIR])
+
+    def test_writer_rotates_segments(self):
+        with override_settings(IOT_SPOOL_SEGMENT_BYTES=1):
+            spool.append({'a': 1}, utc(2020, 10, 1))
+            spool.append({'a': 2}, utc(2020, 10, 1))
+
+        # the first segment has been closed, the second one is too young to expire
+        spool.writer.close(expired=True)
+        self.assertEqual([name.endswith('.part') for name in sorted(os.listdir(self.spool_dir))], [False, True])
+
+        spool.writer.close()
+        self.assertEqual(len(spool.list_segments()), 2)
+        self.assertFalse([path for path in spool.list_segments() if path.endswith('.part')])
+
+
+class ReadReplicaRouterTests(DevicesMixin, TransactionTestCase):
+    # the test replica is a second connection to the test database (SQLite locks the tables written by a transaction)
+    databases = {'default', 'replica1'}
+
+    def setUp(self):
+        super().setUp()
+        routers._checks.clear()
+
+    def test_no_replicas(self):
+        self.assertEqual(routers.choose_replica(), 'default')
+        self.assertEqual(Device.objects.all().db, 'default')
+
+    @override_settings(IOT_READ_REPLICAS=['replica1'])
+    def test_reads_of_the_views_go_to_the_replica(self):
+        @routers.use_read_replica
+        def view():
+            # the queries run by other threads of the view (ex. sharding.scatter_logs) are routed the same way
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                thread_db = executor.submit(copy_context().run, lambda: Device.objects.all().db).result()
+            return Device.objects.all().db, thread_db, routers.ReadReplicaRouter().db_for_write(Device)
+
+        self.assertEqual(view(), ('replica1', 'replica1', 'default'))
+        # the override ends with the view
+        self.assertEqual(Device.objects.all().db, 'default')
+
+    @override_settings(IOT_READ_REPLICAS=['replica1'])
+    def test_lagging_replicas_are_skipped(self):
+        with mock.patch.object(routers, 'replication_lag', return_value=60.0):
+            self.assertEqual(routers.choose_replica(), 'default')
+
+        # the result of the check is cached for IOT_REPLICA_CHECK_SECONDS
+        with mock.patch.object(routers, 'replication_lag', return_value=0.0):
+            self.assertEqual(routers.choose_replica(), 'default')
+            routers._checks.clear()
+            self.assertEqual(routers.choose_replica(), 'replica1')
+
+    @override_settings(IOT_READ_REPLICAS=['replica1'])
+    def test_views_read_from_the_replica(self):
+        self.create_log(self.devices[0], utc(2020, 10, 1), ta0=1.0)
+
+        with CaptureQueriesContext(connections['default']) as primary_queries, \
+                CaptureQueriesContext(connections['replica1']) as replica_queries:
+            response = self.client.get(f'/iot/devices/lineseries/{self.devices[0].pk}/ta0/')
+
+        self.assertEqual(response.json()['rows'], [[timestamp_ms(utc(2020, 10, 1)), 1.0]])
+        self.assertTrue(replica_queries.captured_queries)
+        self.assertFalse(primary_queries.captured_queries)
+
+
+@override_settings(IOT_LOG_SHARDS=['shard1', 'shard2'])
+class ShardingTests(DevicesMixin, TransactionTestCase):
+    # the shards are queried by other threads (see sharding.scatter_logs), they must see the committed data
+    databases = {'default', 'shard1', 'shard2'}
+
+    def shard_logs(self):
+        """Returns the pks of the devices of the logs stored on each database."""
+        return {alias: sorted(Log.objects.using(alias).values_list('device_id', flat=True))
+                for alias in ('default', 'shard1', 'shard2')}
+
+    def test_shard_for_is_stable(self):
+        pks = range(1, 201)
+        shards = {pk: sharding.shard_for(pk) for pk in pks}
+
+        self.assertEqual(shards, {pk: sharding.shard_for(pk) for pk in pks})
+        self.assertEqual(set(shards.values()), {'shard1', 'shard2'})
+        # adding a shard only moves devices to the new shard
+        with override_settings(IOT_LOG_SHARDS=['shard1', 'shard2', 'shard3']):
+            moved = {pk for pk in pks if sharding.shard_for(pk) != shards[pk]}
+            self.assertTrue(moved)
+            self.assertEqual({sharding.shard_for(pk) for pk in moved}, {'shard3'})
+        with override_settings(IOT_LOG_SHARDS=[]):
+            self.assertIsNone(sharding.shard_for(1))
+
+    def test_logs_are_saved_on_the_device_shard(self):
+        for device in self.devices:
+            self.assertEqual(self.post_log(device).status_code, 201)
+
+        expected = {'default': [], 'shard1': [], 'shard2': []}
+        for device in self.devices:
+            expected[sharding.shard_for(device.pk)].append(device.pk)
+            self.assertEqual(sharding.device_logs(device.pk).count(), 1)
+        self.assertEqual(self.shard_logs(), expected)
+
+    def test_scatter_gather(self):
+        for i, device in enumerate(self.devices):
+            for value in range(i + 1):
+                self.create_log(device, utc(2020, 10, 1, value), ta0=float(value))
+
+        rows = sharding.scatter_logs([device.pk for device in self.devices],
+                                     lambda logs: logs.values_list('device_id').annotate(count=Count('pk')))
+
+        self.assertEqual(sorted(rows), [(device.pk, i + 1) for i, device in enumerate(self.devices)])
+        response = self.client.get('/iot/devices/fleetaggregatedata/max&avg/ta0/?kind=coffee%20machine')
+        self.assertEqual(response.json()['results'], [{'logs': 6, 'ta0': {'max': 2.0, 'avg': 4 / 6}}])
+
+    def test_device_delete_cascades_to_its_shard(self):
+        for device in self.devices:
+            self.create_log(device, utc(2020, 10, 1))
+
+        self.devices[0].delete()
+
+        self.assertEqual(sorted(pk for pks in self.shard_logs().values() for pk in pks),
+                         [self.devices[1].pk, self.devices[2].pk])
+
+    def test_rebalance(self):
+        # logs stored before sharding was enabled, one of them violating a rule
+        with override_settings(IOT_LOG_SHARDS=[]):
+            logs = [self.create_log(device, utc(2020, 10, 1), ta0=float(i)) for i, device in enumerate(self.devices)]
+        rule = Rule.objects.create(device_type=self.device_type, name='hot', attribute='ta0', max_value=1)
+        RuleEvent.objects.create(rule=rule, device=self.devices[2], log_id=logs[2].pk, value=2, measure=2)
+
+        call_command('rebalance_log_shards', batch_size=1, stdout=StringIO())
+
+        self.assertEqual(self.shard_logs()['default'], [])
+        for i, device in enumerate(self.devices):
+            self.assertEqual([log.log_file['ta0'] for log in sharding.device_logs(device.pk)], [float(i)])
+        event = RuleEvent.objects.get()
+        self.assertEqual(sharding.device_logs(event.device_id).get(pk=event.log_id).log_file['ta0'], 2.0)
+
+
+@skipUnless(recentcache.load_numpy(), "numpy is not installed")
+class RecentCacheTests(IotTestCase):
+
+    def setUp(self):
+        super().setUp()
+        recentcache.cache.clear()
+        self.addCleanup(recentcache.cache.clear)
+
+    def test_ring_buffer(self):
+        buffer = recentcache.DeviceBuffer(self.devices[0].pk, 3)
+        buffer.warm_up()
+        for i in range(5):
+            buffer.append(i, 100.0 + i, {'ta0': float(i)} if i != 3 else {})
+
+        # the first two logs have been overwritten
+        self.assertIsNone(buffer.window(['ta0'], 101.0, 200.0))
+        timestamps, columns = buffer.window(['ta0', 'xx'], 102.0, 104.0)
+        self.assertEqual(timestamps.tolist(), [102.0, 103.0])
+        self.assertEqual(columns['ta0'][:1].tolist(), [2.0])
+        self.assertTrue(recentcache.np.isnan(columns['ta0'][1]))
+        self.assertTrue(recentcache.np.isnan(columns['xx']).all())
+
+    def test_downsample_and_statistics(self):
+        np = recentcache.np
+        timestamps = np.array([0.0, 1.0, 2.0, 3.0])
+        columns = {'ta0': np.array([1.0, 3.0, np.nan, 5.0])}
+
+        points, point_columns = recentcache.downsample(timestamps, columns, 2)
+        self.assertEqual(points.tolist(), [0.5, 2.5])
+        self.assertEqual(point_columns['ta0'].tolist(), [2.0, 5.0])
+        # all the logs received at the same time
+        same_time = np.zeros(4)
+        self.assertIs(recentcache.downsample(same_time, columns, 2)[0], same_time)
+
+        stats = recentcache.statistics(columns, [50])
+        self.assertEqual(stats['ta0'], {'count': 3, 'min': 1.0, 'max': 5.0, 'avg': 3.0, 'p50': 3.0})
+
+    def test_recent_data(self):
+        device = self.devices[0]
+        url = f'/iot/devices/recentdata/{device.pk}/ta0/?percentiles=50'
+        self.post_log(device, ta0=1.0)
+
+        data = self.client.get(url).json()
+        self.assertEqual(data['source'], 'cache')
+        self.assertEqual(data['stats']['ta0']['max'], 1.0)
+
+        # the logs saved by this process are appended to the cached buffer
+        self.post_log(device, ta0=3.0)
+        data = self.client.get(url).json()
+        self.assertEqual(data['stats']['ta0'], {'count': 2, 'min': 1.0, 'max': 3.0, 'avg': 2.0, 'p50': 2.0})
+
+        with override_settings(IOT_RECENT_CACHE_DEVICES=0):
+            data = self.client.get(url).json()
+        self.assertEqual(data['source'], 'database')
+        self.assertEqual(data['stats']['ta0']['count'], 2)
+
+
+class ShadowTests(IotTestCase):
+
+    def post_shadow(self, serial_number, version, thing='thing0', **reported):
+        shadow = {
+            'thing': thing,
+            'version': version,
+            'state': {'reported': {'info': {'serial': serial_number, 'kind': 'coffee machine', 'model': 'modelA',
+                                            'hw': 'ABC001'}, **reported}},
+        }
+        with redirect_stdout(StringIO()):
+            return self.client.post('/iot/devices/', json.dumps(shadow), content_type='application/json',
+                                    HTTP_SHADOW='1')
+
+    def test_only_newer_versions_are_saved(self):
+        self.assertEqual(self.post_shadow('0', 5, power='on').status_code, 200)
+        self.assertEqual(self.post_shadow('0', 4, power='off').status_code, 200)
+        self.assertEqual(self.post_shadow('0', 5, power='off').status_code, 200)
+
+        device = Device.objects.get(pk=self.devices[0].pk)
+        self.assertEqual(device.shadow_version, 5)
+        self.assertEqual(device.state['state']['reported']['power'], 'on')
+        self.assertEqual(device.stale_shadow_updates, 2)
+
+        self.assertEqual(self.post_shadow('0', 6, power='off').status_code, 200)
+        device.refresh_from_db()
+        self.assertEqual((device.shadow_version, device.state['state']['reported']['power']), (6, 'off'))
+
+    def test_new_devices_are_registered(self):
+        self.assertEqual(self.post_shadow('new', 1, thing='new-thing').status_code, 201)
+
+        device = Device.objects.get(serial_number='new')
+        self.assertEqual((device.type, device.aws_thing_name, device.shadow_version),
+                         (self.device_type, 'new-thing', 1))
+
+    def test_bad_shadows(self):
+        self.assertEqual(self.post_shadow('0', 'x').status_code, 400)
+        self.assertEqual(self.post_shadow('0', None).status_code, 400)
+        with redirect_stdout(StringIO()):
+            response = self.client.post('/iot/devices/', json.dumps({'thing': 'thing0', 'version': 1}),
+                                        content_type='application/json', HTTP_SHADOW='1')
+        self.assertEqual(response.status_code, 400)
+
+
+class GuardrailsTests(IotTestCase):
+
+    def create_logs(self, devices, count):
+        """Saves count logs, from each of the devices in turn."""
+        Log.objects.bulk_create(Log(device=devices[i % len(devices)], reception_datetime=utc(2020, 10, 1),
+                                    log_file={'ta0': float(i)}) for i in range(count))
+
+    def get(self, url):
+        with redirect_stdout(StringIO()):
+            return self.client.get(url)
+
+    @override_settings(IOT_QUERY_MAX_ATTRIBUTES=2, IOT_QUERY_MAX_DEVICES=2, IOT_LATEST_MAX_DEVICES=3)
+    def test_attributes_and_devices_limits(self):
+        device = self.devices[0]
+        self.assertEqual(self.get(f'/iot/devices/lineseries/{device.pk}/ta0&tb0/').status_code, 200)
+        self.assertEqual(self.get(f'/iot/devices/lineseries/{device.pk}/ta0&tb0&tc0/').status_code, 400)
+
+        pks = '&'.join(str(device.pk) for device in self.devices)
+        self.assertEqual(self.get(f'/iot/devices/comparedata/day/avg/{pks}/ta0/').status_code, 400)
+        # the latest values have their own, higher, limit
+        self.assertEqual(self.get(f'/iot/devices/latest/?pks={pks.replace("&", "%26")}').status_code, 200)
+        self.assertEqual(self.get(f'/iot/devices/latest/?pks={pks.replace("&", "%26")}%26999').status_code, 400)
+
+    @override_settings(IOT_QUERY_COST_BUDGET=100, IOT_QUERY_MAX_SAMPLING=5)
+    def test_sampling_rate(self):
+        self.assertEqual(guardrails.sampling_rate(100, 1), 1)
+        self.assertEqual(guardrails.sampling_rate(101, 1), 2)
+        self.assertEqual(guardrails.sampling_rate(100, 2, passes=2), 4)
+        with self.assertRaises(guardrails.QueryTooExpensive):
+            guardrails.sampling_rate(100, 6)
+
+    def test_sample_logs(self):
+        self.create_logs(self.devices[:2], 2000)
+
+        logs = Log.objects.all()
+        self.assertIs(guardrails.sample_logs(logs, 1), logs)
+
+        # each device keeps about 1 every rate of its logs, even if their pks alternate
+        sample = guardrails.sample_logs(logs, 4)
+        for device in self.devices[:2]:
+            self.assertTrue(150 < sample.filter(device=device).count() < 350)
+
+    @override_settings(IOT_QUERY_COST_BUDGET=200, IOT_QUERY_MAX_SAMPLING=10)
+    def test_views_sample_or_reject_expensive_queries(self):
+        self.create_logs(self.devices[:1], 1000)
+        device = self.devices[0]
+
+        data = self.get(f'/iot/devices/columnseries/year/max/{device.pk}/ta0/').json()
+        self.assertEqual(data['sampling'], 5)
+        response = self.get(f'/iot/devices/aggregatedata/min/{device.pk}/ta0/')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.get(f'/iot/devices/columnseries/year/max/{device.pk}/ta0&tb0&tc0/').status_code, 400)
+
+
+class DeduplicationTests(IotTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the filter is kept by the process (see dedup.py)
+        dedup.recent_messages.clear()
+        self.addCleanup(dedup.recent_messages.clear)
+
+    def new_log(self, device, **values):
+        return Log.from_document(device, dict(LOG_DOCUMENT, serial=device.serial_number, **values),
+                                 reception_datetime=utc(2020, 10, 1))
+
+    def test_bloom_filter(self):
+        bloom = dedup.BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f'key{i}')
+
+        self.assertTrue(all(f'key{i}' in bloom for i in range(1000)))
+        false_positives = sum(f'other{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    @override_settings(IOT_DEDUP_CAPACITY=2)
+    def test_filter_generations(self):
+        recent_messages = dedup.RecentMessages()
+        self.assertFalse(recent_messages.seen('a'))
+        self.assertTrue(recent_messages.seen('a'))
+
+        # 'a' is remembered by the previous generation, then forgotten
+        recent_messages.seen('b')
+        recent_messages.seen('c')
+        self.assertTrue(recent_messages.seen('a'))
+        recent_messages.seen('d')
+        recent_messages.seen('e')
+        self.assertFalse(recent_messages.seen('a'))
+
+    def test_messages_are_saved_once(self):
+        self.assertEqual(self.post_log(self.devices[0], msg_id='m1').status_code, 201)
+        with redirect_stdout(StringIO()):
+            self.assertEqual(self.post_log(self.devices[0], msg_id='m1').status_code, 200)
+        self.assertEqual(self.post_log(self.devices[1], msg_id='m1').status_code, 201)
+        # logs without a message identifier are never duplicates
+        self.assertEqual(self.post_log(self.devices[2]).status_code, 201)
+        self.assertEqual(self.post_log(self.devices[2]).status_code, 201)
+
+        self.assertEqual(sorted(Log.objects.values_list('device_id', 'message_id')), [
+            (self.devices[0].pk, 'msg_id:m1'), (self.devices[1].pk, 'msg_id:m1'),
+            (self.devices[2].pk, None), (self.devices[2].pk, None),
+        ])
+
+    def test_duplicates_of_a_batch(self):
+        device = self.devices[0]
+        dedup.save_logs([self.new_log(device, msg_id='m1')], 'default')
+
+        saved = dedup.save_logs([self.new_log(device, msg_id='m1'), self.new_log(device, msg_id='m2'),
+                                 self.new_log(device, msg_id='m2'), self.new_log(device, ts=1)], 'default')
+
+        self.assertEqual([log.message_id for log in saved], ['msg_id:m2', 'ts:1'])
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_only_duplicates_are_skipped(self):
+        device = self.devices[0]
+        dedup.save_logs([self.new_log(device, msg_id='m1')], 'default')
+        # saved by another process: not in the filter of this one, rejected by the unique index
+        dedup.recent_messages.clear()
+
+        with redirect_stdout(StringIO()):
+            saved = dedup.save_logs([self.new_log(device, msg_id='m1'), self.new_log(device, msg_id='m2')], 'default')
+        self.assertEqual([log.message_id for log in saved], ['msg_id:m2'])
+
+        invalid = self.new_log(device, msg_id='m3')
+        invalid.reception_datetime = None
+        with self.assertRaises(IntegrityError):
+            dedup.save_logs([invalid], 'default')
@@ -0,0 +1,170 @@
+"""
+This module computes time buckets of log reception datetimes in the database.
+
+A timeframe is either the name of a calendar unit (see CALENDAR_TIMEFRAMES), which is truncated in the given timezone,
+or a fixed width, written as a number followed by a unit (ex. '5m', '15min', '1h', '2d', '1w') or as an ISO 8601
+duration (ex. 'PT5M'). Fixed widths of whole days are counted in local days (truncated in the given timezone, like the
+'day' unit), so their buckets start at local midnight whatever the UTC offset on each bucket's date (daylight saving
+time included) and a day bucket lasts 23 or 25 hours across a change of offset. Other fixed widths are aligned to the
+Unix epoch in UTC, whatever the timezone (ex. '1h' buckets start at half past the hour in a UTC+5:30 timezone).
+"""
+
+import re
+from datetime import datetime, timedelta
+
+from django.db.models import FloatField, Func, Value
+from django.db.models.functions import Floor, Trunc
+from django.utils import timezone
+from django.utils.dateparse import parse_duration
+
+# calendar units, they are passed to the database's date truncation
+CALENDAR_TIMEFRAMES = ['year', 'month', 'week', 'day', 'hour', 'minute']
+
+# max number of buckets returned by fill_gaps
+MAX_BUCKETS = 10000
+
+# seconds of a day, fixed widths multiple of it are counted in local days
+DAY_SECONDS = 86400
+
+# local midnight of the Unix epoch, the origin of the local days
+_EPOCH = datetime(1970, 1, 1)
+
+_WIDTH_RE = re.compile(r'^(\d+)(s|m|min|h|d|w)$')
+_WIDTH_UNITS = {
+    's': 1,
+    'm': 60,
+    'min': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+}
+
+
+class Epoch(Func):
+    """Seconds since the Unix epoch of a datetime expression."""
+    template = 'EXTRACT(EPOCH FROM %(expressions)s)'
+    output_field = FloatField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # '%%%%' becomes a single '%' once formatted by Func and by the sqlite cursor
+        return self.as_sql(compiler, connection, template="CAST(strftime('%%%%s', %(expressions)s) AS REAL)",
+                           **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='UNIX_TIMESTAMP(%(expressions)s)', **extra_context)
+
+
+def parse_timeframe(timeframe):
+    """Returns the timeframe's calendar unit name or its width in seconds.
+
+    :param timeframe: A calendar unit name, a width like '5m' or an ISO 8601 duration.
+    :return: A string (calendar unit) or an int (width in seconds).
+    :raise ValueError: If the timeframe is not valid.
+    """
+    if timeframe in CALENDAR_TIMEFRAMES:
+        return timeframe
+
+    match = _WIDTH_RE.match(timeframe)
+    if match:
+        width = int(match.group(1)) * _WIDTH_UNITS[match.group(2)]
+    else:
+        duration = parse_duration(timeframe)
+        if duration is None:
+            raise ValueError(f"Invalid timeframe: '{timeframe}'")
+        width = int(duration.total_seconds())
+
+    if width < 1:
+        raise ValueError(f"Invalid timeframe: '{timeframe}' (the minimum width is 1 second)")
+
+    return width
+
+
+def bucket_expression(timeframe, tz, field='reception_datetime'):
+    """Returns an expression computing the bucket of a datetime field.
+
+    :param timeframe: A parsed timeframe (see parse_timeframe).
+    :param tz: The timezone of the buckets.
+    :param field: Name of the datetime field.
+    :return: A Trunc expression (calendar units) or an expression computing the bucket's start as seconds since the
+    Unix epoch (fixed widths, in local time for whole days). Use bucket_datetime to convert the values returned by the
+    database.
+    """
+    if isinstance(timeframe, str):
+        return Trunc(field, timeframe, tzinfo=tz)
+
+    width = Value(float(timeframe), output_field=FloatField())
+    if _whole_days(timeframe):
+        # the local midnight of the datetime's day, as seconds since the local midnight of the Unix epoch
+        return Floor(Epoch(Trunc(field, 'day', tzinfo=tz)) / width) * width
+
+    return Floor(Epoch(field) / width) * width
+
+
+def bucket_datetime(value, timeframe, tz):
+    """Converts a bucket value returned by the database to an aware datetime in the given timezone.
+
+    :param value: A value of a bucket_expression.
+    :param timeframe: The parsed timeframe of the bucket_expression (see parse_timeframe).
+    :param tz: The timezone of the buckets.
+    """
+    if isinstance(value, datetime):
+        return timezone.localtime(value, tz)
+
+    if _whole_days(timeframe):
+        return timezone.make_aware(_EPOCH + timedelta(seconds=value), tz, is_dst=False)
+
+    return datetime.fromtimestamp(value, tz)
+
+
+def fill_gaps(buckets, timeframe, tz):
+    """Returns all buckets from the first to the last of the given ones, filling gaps in between.
+
+    :param buckets: Ordered list of buckets' datetimes (see bucket_datetime).
+    :param timeframe: A parsed timeframe (see parse_timeframe).
+    :param tz: The timezone of the buckets.
+    :return: Ordered list of buckets' datetimes.
+    :raise ValueError: If more than MAX_BUCKETS buckets would be returned.
+    """
+    if not buckets:
+        return []
+
+    filled = set(buckets)
+    bucket = buckets[0]
+    while bucket < buckets[-1]:
+        bucket = _next_bucket(bucket, timeframe, tz)
+        filled.add(bucket)
+
+        if len(filled) > MAX_BUCKETS:
+            raise ValueError(f"Too many buckets (the maximum is {MAX_BUCKETS}), choose a wider timeframe")
+
+    return sorted(b for b in filled if b <= buckets[-1])
+
+
+def _next_bucket(bucket, timeframe, tz):
+    if isinstance(timeframe, int) and not _whole_days(timeframe):
+        return bucket + timedelta(seconds=timeframe)
+
+    if timeframe == 'minute':
+        return bucket + timedelta(minutes=1)
+
+    if timeframe == 'hour':
+        return bucket + timedelta(hours=1)
+
+    # calendar days, weeks, months, years and widths of whole days are stepped in local time
+    local = timezone.make_naive(bucket, tz)
+    if isinstance(timeframe, int):
+        local += timedelta(seconds=timeframe)
+    elif timeframe == 'day':
+        local += timedelta(days=1)
+    elif timeframe == 'week':
+        local += timedelta(weeks=1)
+    elif timeframe == 'month':
+        local = local.replace(year=local.year + local.month // 12, month=local.month % 12 + 1)
+    elif timeframe == 'year':
+        local = local.replace(year=local.year + 1)
+
+    return timezone.make_aware(local, tz, is_dst=False)
+
+
+def _whole_days(timeframe):
+    return isinstance(timeframe, int) and timeframe % DAY_SECONDS == 0
@@ -7,6 +7,14 @@ urlpatterns = [
     path('', views.confirm_destination_aws),  # endpoint
     path('devices/', views.device_data_dispatcher),  # endpoint
     path('devices/linechart/<int:pk>/<str:attributes>/', views.dev_attrs_line_chart),  # view
+    path('devices/lineseries/<int:pk>/<str:attributes>/', views.dev_attrs_line_series),  # api
+    path('devices/recentdata/<int:pk>/<str:attributes>/', views.dev_attrs_recent_data),  # api
+    path('devices/columnseries/<str:timeframe>/<str:action>/<int:pk>/<str:attributes>/', views.dev_attrs_aggregate_series),  # api
+    path('devices/stream/<int:pk>/<str:attributes>/', views.dev_attrs_log_stream),  # stream (see livestream.py)
     path('devices/columnchart/<str:timeframe>/<str:action>/<int:pk>/<str:attributes>/', views.dev_attrs_aggregate_data_column_chart),  # view
     path('devices/aggregatedata/<str:actions>/<str:pks>/<str:attributes>/', views.devs_attrs_aggregate_data),  # view
+    path('devices/comparechart/<str:timeframe>/<str:action>/<str:pks>/<str:attributes>/', views.devs_attrs_compare_line_chart),  # view
+    path('devices/comparedata/<str:timeframe>/<str:action>/<str:pks>/<str:attributes>/', views.devs_attrs_compare_data),  # api
+    path('devices/fleetaggregatedata/<str:actions>/<str:attributes>/', views.fleet_attrs_aggregate_data),  # api
+    path('devices/latest/', views.devs_latest_values),  # api
 ]
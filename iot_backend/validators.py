@@ -0,0 +1,146 @@
+"""
+This module validates the log files received from the devices against the data format of their DeviceType.
+
+A data format maps each attribute name to its type name or to a dictionary with the type and some constraints:
+
+    {
+        "ta0": "number",
+        "fw": {"type": "string", "required": false},
+        "tb0": {"type": "number", "min": -50, "max": 150}
+    }
+
+Supported types: any, number, integer, string, boolean, object, array ("min" and "max" are allowed only with number
+and integer, the bounds must be numbers). Attributes are required unless "required" is false, attributes not in the
+data format are accepted. The identity keys (see LOG_IDENTITY_KEYS) are not validated here because they are needed to
+identify the device in the first place.
+
+Data formats are compiled once into a list of checks, cached per DeviceType and reloaded every
+settings.IOT_VALIDATORS_RELOAD_SECONDS (or as soon as a DeviceType is changed in this process), so validating a log
+is a single pass over its data format.
+"""
+
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import DeviceType, LOG_IDENTITY_KEYS
+
+TYPE_CHECKS = {
+    'any': lambda value: True,
+    'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'integer': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'string': lambda value: isinstance(value, str),
+    'boolean': lambda value: isinstance(value, bool),
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, list),
+}
+
+# types allowing the 'min' and 'max' constraints
+NUMERIC_TYPES = ('number', 'integer')
+
+_lock = Lock()
+
+# DeviceType pk -> (compile time, validator)
+_validators = {}
+
+
+@receiver(post_save, sender=DeviceType)
+@receiver(post_delete, sender=DeviceType)
+def _invalidate_validator(sender, instance, **kwargs):
+    with _lock:
+        _validators.pop(instance.pk, None)
+
+
+def compile_validator(data_format):
+    """Compiles a data format into a validator.
+
+    :param data_format: A data format (see module documentation).
+    :return: A function taking a log file (dict) and returning the list of its errors (empty if the log is valid).
+    :raise ValueError: If the data format is not valid.
+    """
+    if not isinstance(data_format, dict):
+        raise ValueError("The data format must be an object mapping attributes' names to their types")
+
+    checks = []
+    for attr, spec in data_format.items():
+        if attr in LOG_IDENTITY_KEYS:
+            continue
+
+        if isinstance(spec, str):
+            spec = {'type': spec}
+
+        if not isinstance(spec, dict) or spec.get('type', 'any') not in TYPE_CHECKS:
+            raise ValueError(f"Invalid type for attribute '{attr}': {spec} (supported: {', '.join(TYPE_CHECKS)})")
+
+        # bounds are compared with the values only after their type check, so they need a numeric type
+        for bound in ('min', 'max'):
+            if spec.get(bound) is not None:
+                if spec.get('type') not in NUMERIC_TYPES:
+                    raise ValueError(f"Invalid '{bound}' for attribute '{attr}': only allowed with the types "
+                                     f"{', '.join(NUMERIC_TYPES)}")
+                if not TYPE_CHECKS['number'](spec[bound]):
+                    raise ValueError(f"Invalid '{bound}' for attribute '{attr}': {spec[bound]!r} is not a number")
+
+        checks.append((attr, spec.get('required', True), TYPE_CHECKS[spec.get('type', 'any')],
+                       spec.get('min'), spec.get('max')))
+
+    def validate(document):
+        errors = []
+        for attr, required, type_check, minimum, maximum in checks:
+            if attr not in document:
+                if required:
+                    errors.append(f"missing attribute '{attr}'")
+                continue
+
+            value = document[attr]
+            if not type_check(value):
+                errors.append(f"invalid type of attribute '{attr}': {value!r}")
+            elif minimum is not None and value < minimum:
+                errors.append(f"attribute '{attr}' is lower than {minimum}: {value!r}")
+            elif maximum is not None and value > maximum:
+                errors.append(f"attribute '{attr}' is greater than {maximum}: {value!r}")
+
+        return errors
+
+    return validate
+
+
+def _accept_all(document):
+    return []
+
+
+def get_validator(device_type_pk):
+    """Returns the compiled validator of a DeviceType (see compile_validator), from the cache if possible.
+
+    Invalid data formats accept every log (the error is printed when they are compiled).
+    """
+    with _lock:
+        cached = _validators.get(device_type_pk)
+    if cached is not None and monotonic() - cached[0] <= getattr(settings, 'IOT_VALIDATORS_RELOAD_SECONDS', 60):
+        return cached[1]
+
+    data_format = DeviceType.objects.filter(pk=device_type_pk).values_list('data_format', flat=True).first()
+    try:
+        validator = compile_validator(data_format) if data_format else _accept_all
+
+    except ValueError as e:
+        print(f"Invalid data format of DeviceType with pk={device_type_pk}, logs won't be validated: {e}")
+        validator = _accept_all
+
+    with _lock:
+        _validators[device_type_pk] = (monotonic(), validator)
+
+    return validator
+
+
+def validate_log(device_type_pk, document):
+    """Validates a log file against the data format of a DeviceType.
+
+    :param device_type_pk: Primary key of the DeviceType.
+    :param document: The log file (dict).
+    :return: The list of errors (empty if the log is valid).
+    """
+    return get_validator(device_type_pk)(document)
@@ -1,18 +1,196 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
-from django.db.models import FloatField, Avg, Max, Min, Sum, Count
+from django.utils.dateparse import parse_date, parse_datetime
+from django.db import connections, transaction, IntegrityError
+from django.db.models import FloatField, Avg, Max, Min, Sum, Count, Q
 from django.db.models.functions import Cast
 from django.db.models.fields.json import KeyTextTransform
+from django.utils.html import json_script
 import json
-import requests
-from math import floor
+import pytz
+from math import ceil
 from time import time
-from datetime import datetime
-import boto3
+from datetime import datetime, timedelta
+from functools import wraps
+from hashlib import md5
+
+from .models import DeviceType, Device, Log, DeviceLatestValues, LOG_IDENTITY_KEYS
+from . import dedup, guardrails, ingest, livestream, recentcache, sharding, spool, timebuckets, validators
+from .guardrails import query_guardrails
+from .routers import use_read_replica
+
+# aggregate functions selectable through the 'action' url parameters
+AGGREGATE_FUNCTIONS = {
+    'min': Min,
+    'max': Max,
+    'avg': Avg,
+}
+
+# fields available to group the fleet aggregate data, by name of the 'group_by' GET parameter
+FLEET_GROUP_BY = {
+    'device': 'device__pk',
+    'owner': 'device__owner__pk',
+}
+
+# max seconds of logs returned again by each call of the incremental line series api (see dev_attrs_line_series)
+MAX_SERIES_OVERLAP_SECONDS = 3600
+
+
+def log_attr_value(attr):
+    """Returns an expression extracting the numeric value of a log file attribute."""
+    return Cast(KeyTextTransform(attr, 'log_file'), output_field=FloatField())
+
+
+def aggregate_buckets(logs, bucket_timeframe, tz, action, attr_list):
+    """Computes the aggregate data of the specified attributes for each bucket of the logs, in a single query.
+
+    :param logs: A QuerySet of Logs.
+    :param bucket_timeframe: A parsed timeframe (see timebuckets.parse_timeframe).
+    :param tz: The timezone of the buckets.
+    :param action: Name of action. Currently supported: min, max, avg.
+    :param attr_list: List of names of attributes.
+    :return: A dictionary mapping each bucket's datetime to the tuple of the attributes' aggregate values.
+    """
+    aggregate = AGGREGATE_FUNCTIONS[action]
+    logs = logs.annotate(bucket=timebuckets.bucket_expression(bucket_timeframe, tz))
+    logs = logs.values_list('bucket')
+    logs = logs.order_by('bucket')
+    logs = logs.annotate(**{f'attr_{i}': aggregate(log_attr_value(attr)) for i, attr in enumerate(attr_list)})
+
+    return {timebuckets.bucket_datetime(t[0], bucket_timeframe, tz): t[1:] for t in logs}
+
+
+def format_cursor(value):
+    """Formats a reception datetime as a 'since' cursor (UTC ISO 8601 with microseconds, ex. 2020-10-01T12:00:00.123456Z)."""
+    return timezone.localtime(value, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def format_keyset_cursor(reception_datetime, pk):
+    """Formats the position of a log as a 'since' cursor: its reception datetime (see format_cursor) and its primary
+    key, which orders the logs received at the same datetime (ex. 2020-10-01T12:00:00.123456Z_1234)."""
+    return f'{format_cursor(reception_datetime)}_{pk}'
+
+
+def get_cursor_param(request, name):
+    """Returns the cursor passed as GET parameter 'name' (see format_keyset_cursor) or a datetime (see
+    get_datetime_param).
+
+    :return: A tuple (datetime, pk), pk is None if the parameter is a datetime; (None, None) if not passed.
+    :raise ValueError: If the parameter is not a valid cursor.
+    """
+    value = request.GET.get(name)
+    if value is None or '_' not in value:
+        return get_datetime_param(request, name), None
+
+    value, pk = value.rsplit('_', 1)
+    value_datetime = parse_datetime(value)
+    if value_datetime is None or timezone.is_naive(value_datetime) or not pk.isdigit():
+        raise ValueError(f"Invalid cursor for parameter '{name}': '{request.GET[name]}'")
+
+    return value_datetime, int(pk)
+
+
+def chart_json_script(chart_header, chart_points):
+    """Serializes a chart's table in a JSON script element (id 'chart-data') to be parsed by the chart template.
+
+    The payload has the form {"header": [...], "rows": [[timestamp, value1, ...], ...]}, where the first value of each
+    row is the point's datetime as milliseconds since the Unix epoch (the Date constructor argument in javascript).
+
+    :param chart_header: List of columns' names.
+    :param chart_points: List of points, each one a sequence starting with a datetime.
+    :return: A safe string containing the script element.
+    """
+    rows = [[int(point[0].timestamp() * 1000)] + list(point[1:]) for point in chart_points]
+
+    return json_script({'header': chart_header, 'rows': rows}, 'chart-data')
+
+
+def cached_chart(view):
+    """Decorator caching the chart pages rendered by the view, keyed by the requested url (path and query string).
+
+    Pages are cached for settings.IOT_CHART_CACHE_SECONDS, caching is disabled if it is 0.
+    Only successful GET responses are cached.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        timeout = getattr(settings, 'IOT_CHART_CACHE_SECONDS', 0)
+        if request.method != 'GET' or not timeout:
+            return view(request, *args, **kwargs)
+
+        key = f'iot_chart:{md5(request.get_full_path().encode()).hexdigest()}'
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content)
+
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.content, timeout)
+
+        return response
+
+    return wrapper
+
+
+def get_datetime_param(request, name):
+    """Returns the datetime passed as GET parameter 'name' (ISO 8601 datetime or date), None if not passed.
+
+    Naive datetimes are interpreted in the current timezone.
+
+    :param request: An http GET request.
+    :param name: Name of the GET parameter.
+    :return: An aware datetime or None.
+    :raise ValueError: If the parameter is not a valid datetime.
+    """
+    value = request.GET.get(name)
+    if value is None:
+        return None
 
-from .models import DeviceType, Device, Log
+    value_datetime = parse_datetime(value)
+    if value_datetime is None:
+        value_date = parse_date(value)
+        if value_date is None:
+            raise ValueError(f"Invalid datetime for parameter '{name}': '{value}'")
+        value_datetime = datetime(value_date.year, value_date.month, value_date.day)
+
+    if timezone.is_naive(value_datetime):
+        value_datetime = timezone.make_aware(value_datetime)
+
+    return value_datetime
+
+
+def get_device_type_filter(request, prefix=''):
+    """Returns the filter selecting devices by the DeviceType fields passed as GET parameters 'kind', 'model', 'hw'.
+
+    :param request: An http GET request.
+    :param prefix: Prefix of the lookups, the path to Device (ex. 'device__').
+    :return: A dictionary of lookups (empty if none of the parameters is passed).
+    """
+    return {f'{prefix}type__{field}': request.GET[param]
+            for param, field in (('kind', 'kind'), ('model', 'model'), ('hw', 'hardware_version'))
+            if param in request.GET}
+
+
+def get_timezone_param(request, name='tz'):
+    """Returns the timezone named by the GET parameter 'name' (ex. Europe/Rome), the current timezone if not passed.
+
+    :param request: An http GET request.
+    :param name: Name of the GET parameter.
+    :return: A tzinfo.
+    :raise ValueError: If the timezone is unknown.
+    """
+    value = request.GET.get(name)
+    if value is None:
+        return timezone.get_current_timezone()
+
+    try:
+        return pytz.timezone(value)
+
+    except pytz.UnknownTimeZoneError:
+        raise ValueError(f"Unknown timezone for parameter '{name}': '{value}'")
 
 
 @csrf_exempt
@@ -25,6 +203,9 @@ def confirm_destination_aws(request):
     body = json.loads(request.body)
 
     if 'confirmationToken' in body:
+        # boto3 is imported on first use, it is slow to import and only needed by this endpoint
+        import boto3
+
         client = boto3.client('iot')
         client.confirm_topic_rule_destination(confirmationToken=body['confirmationToken'])
         client.update_topic_rule_destination(
@@ -48,6 +229,9 @@ def device_data_dispatcher(request):
     headers = request.headers
 
     if 'log' in headers:
+        if getattr(settings, 'IOT_INGEST_MODE', 'direct') == 'spool':
+            return spool_device_log_data(request)
+
         return save_device_log_data(request)
 
     elif 'shadow' in headers:
@@ -60,6 +244,8 @@ def device_data_dispatcher(request):
 def save_device_log_data(request):
     """Registers a new device log in the database.
 
+    A log already registered (same device and message identifier, see dedup.py) is acknowledged but not saved again.
+
     :param request: A request containing (in its body) a set of key fields which uniquely identifies a Device's entry
     and other arbitrary log fields to be saved in the database.
     :return: HttpResponse.
@@ -81,17 +267,50 @@ def save_device_log_data(request):
         device = get_object_or_404(Device, serial_number=device_serial, type__kind=device_kind,
                                    type__model=device_model, type__hardware_version=device_hw)
 
-        Log.objects.create(device=device, reception_datetime=timezone.now(), log_file=body)
+        # reject logs not matching the data format of the device's type
+        errors = validators.validate_log(device.type_id, body)
+        if errors:
+            print(f"Invalid log file from device with pk={device.pk}: {errors}")
+            return HttpResponse(status=400)  # 400 Bad Request
+
+        log = Log.from_document(device, body, reception_datetime=timezone.now())
+        if not dedup.save_logs([log], sharding.shard_for(device.pk) or sharding.PRIMARY):
+            print(f"Duplicate log from device with pk={device.pk}: {log.message_id}")
+            return HttpResponse(status=200)  # 200 OK, the Log entry already exists
+
+        # keep the device's latest values up to date, evaluate the alerting rules of the device's type
+        # and push the log to the live charts
+        ingest.process_saved_logs([log])
 
     return HttpResponse(status=201)  # 201 Created new Log entry
 
 
+def spool_device_log_data(request):
+    """Appends a new device log to the spool, it will be saved by the 'ingest_spool' workers (see spool.py).
+
+    :param request: A request containing (in its body) a set of key fields which uniquely identifies a Device's entry
+    and other arbitrary log fields to be saved in the database.
+    :return: HttpResponse.
+    """
+    body = json.loads(request.body)
+
+    missing = [key for key in LOG_IDENTITY_KEYS if key not in body] if isinstance(body, dict) else LOG_IDENTITY_KEYS
+    if missing:
+        print(f"Missing keys in log file: {missing}")
+        return HttpResponse(status=400)  # 400 Bad Request
+
+    spool.append(body, timezone.now())
+
+    return HttpResponse(status=202)  # 202 Accepted, the Log entry will be created by the ingest workers
+
+
 def update_device_shadow_data(request):
     """Updates/Creates device's (shadow) entry.
 
     This function will first validate the input parameters,
     then it will search for the device's entry identified by the request's parameters,
-    if the entry is found then it will be updated to the new parameters,
+    if the entry is found then it will be updated to the new parameters (only if the shadow's version is newer than
+    the saved one, see Device.update_shadow, so retried or reordered updates never overwrite a newer state),
     if the device entry is not already in the database it will be created according to the parameters in the request.
 
     :param request: A request containing a device's shadow data in its body.
@@ -107,47 +326,65 @@ def update_device_shadow_data(request):
         device_model = device_info['model']
         device_hw = device_info['hw']
         thing_name = body['thing']
+        shadow_version = int(body['version'])
 
     except KeyError as e:
         print(f"Missing keys in shadow value: {e}")
         return HttpResponse(status=400)  # 400 Bad Request
 
-    else:
-        try:
-            # Check if the Device specified exists in database
-            device = get_object_or_404(Device, serial_number=device_serial, type__kind=device_kind,
-                                       type__model=device_model, type__hardware_version=device_hw)
+    except (TypeError, ValueError) as e:
+        print(f"Invalid shadow version: {e}")
+        return HttpResponse(status=400)  # 400 Bad Request
 
-            # Update entry
-            device.state = body
-            device.save()
+    device_filter = {'serial_number': device_serial, 'type__kind': device_kind, 'type__model': device_model,
+                     'type__hardware_version': device_hw}
 
-            return HttpResponse(status=200)  # 200 OK Entry updated
+    # Check if the Device specified exists in database
+    device_pk = Device.objects.filter(**device_filter).values_list('pk', flat=True).first()
+
+    if device_pk is None:
+        try:
+            # Check if the DeviceType specified exists in database
+            device_type = get_object_or_404(DeviceType, kind=device_kind, model=device_model,
+                                            hardware_version=device_hw)
 
         except Http404:
-            try:
-                # Check if the DeviceType specified exists in database
-                device_type = get_object_or_404(DeviceType, kind=device_kind, model=device_model,
-                                                hardware_version=device_hw)
+            # Write a log and return an http 404 response
+            print(f"A device with aws thing name '{thing_name}' sent a shadow update but there was not a Device"
+                  f" entry nor a DeviceType matching the request parameters")
+            raise
+
+        try:
+            # Create a new Device entry for that DeviceType
+            with transaction.atomic():
+                Device.objects.create(serial_number=device_serial, type=device_type,
+                                      registration_datetime=timezone.now(), aws_thing_name=thing_name, state=body,
+                                      shadow_version=shadow_version)
 
-                # Create a new Device entry for that DeviceType
-                Device.objects.create(serial_number=device_serial, type=device_type, registration_datetime=timezone.now(),
-                                      aws_thing_name=thing_name, state=body)
+            return HttpResponse(status=201)  # 201 Created new Device entry
 
-                return HttpResponse(status=201)  # 201 Created new Device entry
+        except IntegrityError as e:
+            # created concurrently by another update of the same shadow, which is updated below
+            device_pk = Device.objects.filter(**device_filter).values_list('pk', flat=True).first()
+            if device_pk is None:
+                print(f"Can't create a Device for aws thing name '{thing_name}': {e}")
+                return HttpResponse(status=400)  # 400 Bad Request
 
-            except Http404:
-                # Write a log and return an http 404 response
-                print(f"A device with aws thing name '{thing_name}' sent a shadow update but there was not a Device"
-                      f" entry nor a DeviceType matching the request parameters")
-                raise
+    # Update entry (a stale update is not an error, the sender must not retry it)
+    if not Device.update_shadow(device_pk, body, shadow_version):
+        print(f"Discarded stale shadow update (version {shadow_version}) of device with pk={device_pk}")
 
+    return HttpResponse(status=200)  # 200 OK Entry updated
 
+
+@cached_chart
+@use_read_replica
+@query_guardrails
 def dev_attrs_line_chart(request, pk, attributes):
     """Returns a rendered google charts template displaying attributes variations for a given device.
 
-    This view will search for all logs of a given device(pk), then it will search in each log file to collect the
-    specified attributes to fill the google charts template.
+    This view will search for all logs of a given device(pk), then it will average the specified attributes of the log
+    files in at most about 100 points of equal time width to fill the google charts template.
 
     :param request: An http GET request.
     :param pk: Primary key of the device.
@@ -163,14 +400,14 @@ def dev_attrs_line_chart(request, pk, attributes):
     t0 = time()  # get start time
 
     # select all logs of the specified device
-    logs = Log.objects.filter(device__pk=pk)
+    logs = sharding.device_logs(pk)
 
     # check if there are some logs
     if not logs.exists():
         raise Http404(f"No logs found for device with pk={pk}")
 
     # get list of attributes to display
-    attr_list = attributes.split('&')
+    attr_list = guardrails.split_attributes(attributes)
 
     # header to specify columns' names
     chart_header = ['Date']
@@ -179,52 +416,289 @@ def dev_attrs_line_chart(request, pk, attributes):
     # max number of points to display in graph
     max_points = 100
 
-    # generate input list with points for the chart template
-    chart_points = []
-    logs = logs.order_by('reception_datetime')
-    step = floor(logs.count() / max_points)
-    i = step
-    for log in logs:
-        if i == step:
-            # add point(s)
-            point = [log.reception_datetime]
-            for attr in attr_list:
-                try:
-                    point.append(log.log_file[attr])
-
-                except KeyError as e:
-                    raise Http404(f"Missing attribute {e} in log file.  "
-                                  f"LOG: '{log}'  "
-                                  f"DEVICE: {log.device}  "
-                                  )
-
-            chart_points.append(point)
-            i = 0
+    # read a sample of the logs if reading all of them would exceed the query budget (see guardrails.py), the number
+    # of logs is estimated (an exact count would scan all the device's logs before applying the budget)
+    logs_count = guardrails.estimated_count(logs)
+    sampling = guardrails.sampling_rate(logs_count, len(attr_list))
+    span = logs.aggregate(first=Min('reception_datetime'), last=Max('reception_datetime'))  # before sampling the logs
+    logs = guardrails.sample_logs(logs, sampling)
 
-        else:
-            i += 1
+    # generate input list with points for the chart template: the logs are averaged in at most max_points (+1) buckets
+    # of equal width spanning the device's logs, so that the number of points does not depend on the estimated count
+    bucket_width = max(ceil((span['last'] - span['first']).total_seconds() / max_points), 1)
+    buckets = aggregate_buckets(logs, bucket_width, timezone.utc, 'avg', attr_list)
+    chart_points = [[bucket, *values] for bucket, values in sorted(buckets.items())]
 
     t1 = time()  # get end time
-    query_performance_report.append(f'Total number of logs for this device: {logs.count()}')
+    query_performance_report.append(f'Estimated number of logs for this device: {logs_count}')
+    if sampling > 1:
+        query_performance_report.append(f'Sampled 1 every {sampling} logs')
     query_performance_report.append(f'TOTAL TIME: {t1 - t0} secs')
 
     # return the rendered webpage
     return render(request, 'iot_backend/line_chart.html', {
-        'chart_header': chart_header,
-        'chart_points': chart_points,
+        'chart_data': chart_json_script(chart_header, chart_points),
         'device_id': Device.objects.get(pk=pk),
+        'stream_url': f'/iot/devices/stream/{pk}/{attributes}/' if livestream.enabled() else None,
         'query_performance_report': query_performance_report,
     })
 
 
+def dev_attrs_log_stream(request, pk, attributes):
+    """Streams the new logs of a device as Server-Sent Events (see livestream.py).
+
+    This view serves the streams on WSGI servers, holding a worker thread for each client (but no database
+    connection). On ASGI servers the streams are served by livestream.asgi_application instead (see
+    iot_server/asgi.py). Streams are disabled unless settings.IOT_STREAM_ENABLED is True.
+
+    :param request: An http GET request.
+    :param pk: Primary key of the device.
+    :param attributes: Names of attributes to be streamed separated by '&' (ex. attr1&attr2&attr3).
+    :return: A StreamingHttpResponse of the events.
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    if not livestream.enabled():
+        raise Http404("Live streams are disabled")
+
+    get_object_or_404(Device, pk=pk)
+    # the stream may stay open for hours: don't hold the connections (only closed by Django when the response ends)
+    connections.close_all()
+
+    response = StreamingHttpResponse(livestream.stream_events(pk, attributes.split('&')),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+
+    return response
+
+
+@use_read_replica
+@query_guardrails
+def dev_attrs_line_series(request, pk, attributes):
+    """Returns the logs of a device received after a given time, to update a line chart incrementally.
+
+    The GET parameter 'since' is the cursor returned by the previous call (or any ISO 8601 datetime), only logs
+    received after it are returned. The cursor is the position of the last log returned (reception datetime and
+    primary key), so the logs received at the same datetime are never skipped between two calls. At most
+    settings.IOT_SERIES_MAX_ROWS logs are returned for each call, 'more' is true if there are other logs after them.
+
+    Logs can be saved after logs received later (ex. in spool ingest mode, see spool.py, the reception datetime is the
+    time the log is spooled): the GET parameter 'overlap' (seconds, default 0) returns again the logs received up to
+    that long before the cursor (at most settings.IOT_SERIES_MAX_ROWS), including the ones saved late. The clients
+    skip the logs already received by their primary key ('ids').
+
+    :param request: An http GET request.
+    :param pk: Primary key of the device.
+    :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
+    :return: JsonResponse with 'header', 'rows' (as in chart_json_script, values are null for missing attributes),
+    'ids' (the primary keys of the rows' logs), 'cursor' and 'more'.
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    try:
+        since, since_pk = get_cursor_param(request, 'since')
+        overlap = float(request.GET.get('overlap', 0))
+        if not 0 <= overlap <= MAX_SERIES_OVERLAP_SECONDS:
+            raise ValueError(f"Invalid overlap: {overlap} (max {MAX_SERIES_OVERLAP_SECONDS} seconds)")
+
+    except ValueError as e:
+        raise Http404(e)
+
+    get_object_or_404(Device, pk=pk)
+    attr_list = guardrails.split_attributes(attributes)
+    max_rows = getattr(settings, 'IOT_SERIES_MAX_ROWS', 1000)
+
+    # read only the required attributes of the logs (through the device and reception datetime index)
+    logs = sharding.device_logs(pk)
+    logs = logs.annotate(**{f'attr_{i}': log_attr_value(attr) for i, attr in enumerate(attr_list)})
+    logs = logs.values_list('pk', 'reception_datetime', *[f'attr_{i}' for i in range(len(attr_list))])
+    logs = logs.order_by('reception_datetime', 'pk')
+
+    points = []
+    new_logs = logs
+    if since is not None:
+        after_cursor = Q(reception_datetime__gt=since)
+        if since_pk is not None:
+            after_cursor |= Q(reception_datetime=since, pk__gt=since_pk)
+        new_logs = logs.filter(after_cursor)
+
+        if overlap:
+            points = list(logs.filter(~after_cursor, reception_datetime__gte=since - timedelta(seconds=overlap))
+                          [:max_rows])
+
+    new_points = list(new_logs[:max_rows + 1])
+    more = len(new_points) > max_rows
+    new_points = new_points[:max_rows]
+    points += new_points
+
+    cursor = None
+    if new_points:
+        cursor = format_keyset_cursor(new_points[-1][1], new_points[-1][0])
+    elif since is not None:
+        cursor = format_cursor(since) if since_pk is None else format_keyset_cursor(since, since_pk)
+
+    return JsonResponse({
+        'header': ['Date'] + attr_list,
+        'rows': [[int(point[1].timestamp() * 1000)] + list(point[2:]) for point in points],
+        'ids': [point[0] for point in points],
+        'cursor': cursor,
+        'more': more,
+    })
+
+
+@use_read_replica
+@query_guardrails
+def dev_attrs_recent_data(request, pk, attributes):
+    """Returns the downsampled series and the statistics (min, max, avg, percentiles) of attributes of a device over
+    a recent window, computed with numpy from the in-memory cache of the recent values (see recentcache.py).
+
+    GET parameters: 'window' is the width of the window ending now (ex. 24h, 7d, default 24h), 'points' the max number
+    of points of the series (default 100), 'percentiles' the percentiles to compute separated by '&' (to be url encoded
+    as %26, default 50&95&99). If the cache is disabled or doesn't hold the whole window, the values are read from the
+    logs.
+
+    Example: /iot/devices/recentdata/1/ta0&tb0/?window=7d&percentiles=5%2695
+
+    :param request: An http GET request.
+    :param pk: Primary key of the device.
+    :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
+    :return: JsonResponse with 'header', 'rows' (as in chart_json_script, values are null where missing), 'stats'
+    (by attribute), 'source' (cache or database) and 'sampling' (1 every n logs read, see guardrails.py).
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    if not recentcache.load_numpy():
+        print("The recent data API requires numpy")
+        return HttpResponse(status=501)  # 501 Not Implemented
+
+    try:
+        window = timebuckets.parse_timeframe(request.GET.get('window', '24h'))
+        if not isinstance(window, int):
+            raise ValueError(f"Invalid window: '{window}' (it must be a width, ex. 24h)")
+
+        max_points = int(request.GET.get('points', 100))
+        percentiles = [float(p) for p in request.GET.get('percentiles', '50&95&99').split('&') if p]
+        if max_points < 1 or any(not 0 <= p <= 100 for p in percentiles):
+            raise ValueError("Invalid points or percentiles")
+
+    except ValueError as e:
+        raise Http404(e)
+
+    get_object_or_404(Device, pk=pk)
+    attr_list = guardrails.split_attributes(attributes)
+    end = timezone.now()
+    start = end - timedelta(seconds=window)
+
+    source = 'cache'
+    sampling = 1
+    data = recentcache.window(pk, attr_list, start, end)
+    if data is None:
+        source = 'database'
+        logs = sharding.device_logs(pk).filter(reception_datetime__gte=start, reception_datetime__lt=end)
+        sampling = guardrails.sampling_rate(guardrails.estimated_count(logs), len(attr_list))
+        logs = guardrails.sample_logs(logs, sampling)
+        logs = logs.annotate(**{f'attr_{i}': log_attr_value(attr) for i, attr in enumerate(attr_list)})
+        logs = logs.values_list('reception_datetime', *[f'attr_{i}' for i in range(len(attr_list))])
+        data = recentcache.from_rows(list(logs.order_by('reception_datetime')), attr_list)
+
+    timestamps, columns = data
+    points, point_columns = recentcache.downsample(timestamps, columns, max_points)
+    rows = zip((points * 1000).astype('int64').tolist(), *[point_columns[attr].tolist() for attr in attr_list])
+
+    return JsonResponse({
+        'header': ['Date'] + attr_list,
+        'rows': [[row[0]] + [None if value != value else value for value in row[1:]] for row in rows],  # NaN -> null
+        'stats': recentcache.statistics(columns, percentiles),
+        'source': source,
+        'sampling': sampling,
+    })
+
+
+@use_read_replica
+@query_guardrails
+def dev_attrs_aggregate_series(request, timeframe, action, pk, attributes):
+    """Returns the aggregate data of the buckets changed after a given time, to update a column chart incrementally.
+
+    The GET parameter 'since' is the cursor returned by the previous call (or any ISO 8601 datetime), only the buckets
+    containing logs received after it are returned (recomputed on all their logs), so the client can replace them.
+    Without 'since' all buckets are returned. The GET parameter 'tz' is the timezone used for bucketing.
+
+    :param request: An http GET request.
+    :param timeframe: The desired timeframe (see dev_attrs_aggregate_data_column_chart).
+    :param action: Names of action. Currently supported: min, max, avg.
+    :param pk: Primary key of the device.
+    :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
+    :return: JsonResponse with 'header', 'rows' (as in chart_json_script), 'cursor' and 'sampling' (1 every n logs
+    aggregated, see guardrails.py).
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    try:
+        bucket_timeframe = timebuckets.parse_timeframe(timeframe)
+        tz = get_timezone_param(request)
+        since = get_datetime_param(request, 'since')
+
+    except ValueError as e:
+        raise Http404(e)
+
+    if action not in AGGREGATE_FUNCTIONS:
+        raise Http404()
+
+    get_object_or_404(Device, pk=pk)
+    attr_list = guardrails.split_attributes(attributes)
+    logs = sharding.device_logs(pk)
+    header = [timeframe] + [f'{action} {attr}' for attr in attr_list]
+    cursor = logs.aggregate(cursor=Max('reception_datetime'))['cursor']
+
+    if since is not None:
+        # find the bucket of the first new log, the buckets from it on are the changed ones
+        first = logs.filter(reception_datetime__gt=since).order_by('reception_datetime')
+        first = first.annotate(bucket=timebuckets.bucket_expression(bucket_timeframe, tz))
+        first = first.values_list('bucket', flat=True).first()
+
+        if first is None:
+            return JsonResponse({
+                'header': header,
+                'rows': [],
+                'cursor': format_cursor(since),
+            })
+
+        logs = logs.filter(reception_datetime__gte=timebuckets.bucket_datetime(first, bucket_timeframe, tz))
+
+    sampling = guardrails.sampling_rate(guardrails.estimated_count(logs), len(attr_list))
+    values = aggregate_buckets(guardrails.sample_logs(logs, sampling), bucket_timeframe, tz, action, attr_list)
+
+    return JsonResponse({
+        'header': header,
+        'rows': [[int(bucket.timestamp() * 1000)] + list(values[bucket]) for bucket in sorted(values)],
+        'cursor': format_cursor(cursor) if cursor is not None else None,
+        'sampling': sampling,
+    })
+
+
+@cached_chart
+@use_read_replica
+@query_guardrails
 def dev_attrs_aggregate_data_column_chart(request, timeframe, action, pk, attributes):
     """Displays attributes' aggregate data variations for a given device on a given timeframe.
 
     This view returns a rendered google charts' column chart template displaying attributes' aggregate data variations
     of the specified action for a given device on a given timeframe.
+    Buckets are computed by the database, empty buckets between the first and the last one are filled with nulls.
+    Optional GET parameters: 'start' (included) and 'end' (excluded) restrict the logs to a time range,
+    'tz' is the timezone name used for bucketing (ex. Europe/Rome, default is the server's timezone).
 
     :param request: An http GET request.
-    :param timeframe: The desired timeframe name. Currently supported: year, month, day.
+    :param timeframe: The desired timeframe. Currently supported: year, month, week, day, hour, minute or a fixed
+    width (ex. 5m, 1h, 1w or an ISO 8601 duration like PT5M), see timebuckets.py.
     :param action: Names of action. Currently supported: min, max, avg.
     :param pk: Primary key of the device.
     :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
@@ -235,75 +709,67 @@ def dev_attrs_aggregate_data_column_chart(request, timeframe, action, pk, attrib
         return HttpResponse(status=405)  # 405 Method Not Allowed
 
     # validate parameters passed
-    if ((timeframe not in ['year', 'month', 'day']) or
-            (action not in ['min', 'max', 'avg']) or
-            not (Log.objects.filter(device__pk=pk).exists())):
+    try:
+        bucket_timeframe = timebuckets.parse_timeframe(timeframe)
+        tz = get_timezone_param(request)
+        start = get_datetime_param(request, 'start')
+        end = get_datetime_param(request, 'end')
 
+    except ValueError as e:
+        raise Http404(e)
+
+    if (action not in AGGREGATE_FUNCTIONS) or not (sharding.device_logs(pk).exists()):
         raise Http404()
 
     # get list of attributes to compare
-    attr_list = attributes.split('&')
+    attr_list = guardrails.split_attributes(attributes)
+
+    # get logs from specified device (in the specified time range)
+    logs = sharding.device_logs(pk)
+    if start is not None:
+        logs = logs.filter(reception_datetime__gte=start)
+    if end is not None:
+        logs = logs.filter(reception_datetime__lt=end)
 
-    # get all logs from specified device
-    logs = Log.objects.filter(device__pk=pk)
+    # aggregate a sample of the logs if aggregating all of them would exceed the query budget (see guardrails.py)
+    logs_num = guardrails.estimated_count(logs)
+    sampling = guardrails.sampling_rate(logs_num, len(attr_list))
+    logs = guardrails.sample_logs(logs, sampling)
 
     # create chart description
     chart_title = f"Statistics for device: '{get_object_or_404(Device, pk=pk)}'."
     chart_subtitle = f"Showing variation of {action} values for {attr_list} attributes per {timeframe}."
+    if sampling > 1:
+        chart_subtitle += f" Sampled 1 every {sampling} logs."
 
     # create chart header
     chart_header = [timeframe]
     attr_list_for_header = [f'{action} {attr}' for attr in attr_list]
     chart_header.extend(attr_list_for_header)
 
-    # group and order by specified timeframe
-    if timeframe == 'year':
-        logs = logs.values_list('reception_datetime__year')
-        logs = logs.order_by('reception_datetime__year')
-
-    elif timeframe == 'month':
-        logs = logs.values_list('reception_datetime__year', 'reception_datetime__month')
-        logs = logs.order_by('reception_datetime__year', 'reception_datetime__month')
-
-    elif timeframe == 'day':
-        logs = logs.values_list('reception_datetime__year', 'reception_datetime__month', 'reception_datetime__day')
-        logs = logs.order_by('reception_datetime__year', 'reception_datetime__month', 'reception_datetime__day')
+    # group and order by the bucket of the specified timeframe and get aggregate data of specified attributes
+    values = aggregate_buckets(logs, bucket_timeframe, tz, action, attr_list)
 
-    # get aggregate data of specified attributes (on specified timeframe defined above)
-    for attr in attr_list:
-        if action == 'min':
-            logs = logs.annotate(**{f'minimum_{attr}': Min(Cast(KeyTextTransform(attr, 'log_file'), output_field=FloatField()))})
-
-        elif action == 'max':
-            logs = logs.annotate(**{f'maximum_{attr}': Max(Cast(KeyTextTransform(attr, 'log_file'), output_field=FloatField()))})
-
-        elif action == 'avg':
-            logs = logs.annotate(**{f'average_{attr}': Avg(Cast(KeyTextTransform(attr, 'log_file'), output_field=FloatField()))})
-
-    # adjust logs' QuerySet tuples for the chart template
-    chart_points = []
-    for t in logs:
-        if timeframe == 'year':
-            new_t = (datetime(t[0], 1, 1),) + t[1:]
-
-        if timeframe == 'month':
-            new_t = (datetime(t[0], t[1], 1),) + t[2:]
-
-        elif timeframe == 'day':
-            new_t = (datetime(t[0], t[1], t[2]),) + t[3:]
+    # adjust buckets for the chart template, filling the empty ones
+    try:
+        buckets = timebuckets.fill_gaps(sorted(values), bucket_timeframe, tz)
+    except ValueError as e:
+        raise Http404(e)
 
-        chart_points.append(new_t)
+    empty = (None,) * len(attr_list)
+    chart_points = [(bucket,) + values.get(bucket, empty) for bucket in buckets]
 
     # return the rendered webpage
     return render(request, 'iot_backend/column_chart.html', {
         'chart_title': chart_title,
         'chart_subtitle': chart_subtitle,
-        'chart_header': chart_header,
-        'chart_points': chart_points,
-        'logs_num': Log.objects.filter(device__pk=pk).count(),  # this query impacts performances and it is here only for testing purposes
+        'chart_data': chart_json_script(chart_header, chart_points),
+        'logs_num': logs_num,
     })
 
 
+@use_read_replica
+@query_guardrails
 def devs_attrs_aggregate_data(request, actions, pks, attributes):
     """Returns aggregate data based of specified action, devices, attributes.
 
@@ -324,10 +790,13 @@ def devs_attrs_aggregate_data(request, actions, pks, attributes):
     dev_report = {}
 
     # get list of devices' pks as strings and convert them to integer
-    pk_list = [int(pk) for pk in pks.split('&')]
+    try:
+        pk_list = guardrails.split_pks(pks)
+    except ValueError:
+        raise Http404(f"Invalid device pks: '{pks}'")
 
     # get list of attributes
-    attr_list = attributes.split('&')
+    attr_list = guardrails.split_attributes(attributes)
 
     # get list of actions
     act_list = actions.split('&')
@@ -335,8 +804,16 @@ def devs_attrs_aggregate_data(request, actions, pks, attributes):
     # compile report for each device specified
     for pk in pk_list:
         dev_report[pk] = [str(get_object_or_404(Device, pk=pk))]
-        dev_logs = Log.objects.filter(device__pk=int(pk))
-        dev_report[pk].append(f"This device has: {dev_logs.count()} logs")
+        dev_logs = sharding.device_logs(pk)
+        dev_logs_count = guardrails.estimated_count(dev_logs)
+        dev_report[pk].append(f"This device has about: {dev_logs_count} logs")
+
+        # each action of each attribute reads all the logs, a sample is read if they exceed the query budget
+        sampling = guardrails.sampling_rate(dev_logs_count, len(attr_list), len(act_list))
+        dev_logs = guardrails.sample_logs(dev_logs, sampling)
+        if sampling > 1:
+            dev_report[pk].append(f"Sampled 1 every {sampling} logs")
+
         dev_report[pk].append(f"These are the statistics for the attributes {attr_list}:")
 
         # compute aggregate data for each attribute specified
@@ -362,3 +839,350 @@ def devs_attrs_aggregate_data(request, actions, pks, attributes):
     return render(request, 'iot_backend/aggregate_data.html', {
         'dev_report': dev_report,
     })
+
+
+def compare_devs_attrs(request, timeframe, action, pks, attributes):
+    """Computes the aggregate series of the specified attributes for each device on a shared time axis.
+
+    All devices are aggregated by a single query grouped by device and bucket of reception datetime.
+    The GET parameter 'tz' selects the timezone used for bucketing (see get_timezone_param), the logs can be restricted
+    to a time range with the GET parameters 'start' (included) and 'end' (excluded). The axis has at most
+    timebuckets.MAX_BUCKETS buckets.
+
+    :param request: An http GET request.
+    :param timeframe: The bucket width. Currently supported: see timebuckets.py.
+    :param action: Name of action. Currently supported: min, max, avg.
+    :param pks: Primary keys of devices separated by '&' (ex. pk1&pk2&pk3).
+    :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
+    :return: A tuple (devices, attr_list, axis, series, sampling) where 'axis' is the ordered list of buckets'
+    datetimes, 'series' maps each device's pk to a dictionary of attributes' values lists aligned to the axis (None
+    where a device has no logs in a bucket) and 'sampling' is the sampling rate of the logs (see guardrails.py).
+    """
+
+    try:
+        bucket_timeframe = timebuckets.parse_timeframe(timeframe)
+        tz = get_timezone_param(request)
+        start = get_datetime_param(request, 'start')
+        end = get_datetime_param(request, 'end')
+
+    except ValueError as e:
+        raise Http404(e)
+
+    if action not in AGGREGATE_FUNCTIONS:
+        raise Http404()
+
+    # filter logs by time range (start included, end excluded)
+    log_filter = {}
+    if start is not None:
+        log_filter['reception_datetime__gte'] = start
+    if end is not None:
+        log_filter['reception_datetime__lt'] = end
+
+    try:
+        pk_list = guardrails.split_pks(pks)
+    except ValueError:
+        raise Http404(f"Invalid device pks: '{pks}'")
+
+    attr_list = guardrails.split_attributes(attributes)
+
+    # check that all the devices exist
+    devices = Device.objects.select_related('type').in_bulk(pk_list)
+    if len(devices) != len(set(pk_list)):
+        raise Http404(f"No devices found for pks={set(pk_list) - set(devices)}")
+
+    # aggregate a sample of the logs if aggregating all of them would exceed the query budget
+    sampling = guardrails.sampling_rate(guardrails.estimate_rows(set(pk_list), log_filter), len(attr_list))
+
+    # group by device and bucket, aggregating all attributes in the same query
+    aggregate = AGGREGATE_FUNCTIONS[action]
+    # a shard's rows have at most a row per device for each bucket: the first (MAX_BUCKETS + 1) * devices rows are
+    # enough to tell if the axis would be too long
+    max_rows = (timebuckets.MAX_BUCKETS + 1) * len(set(pk_list))
+
+    def device_buckets(logs):
+        rows = guardrails.sample_logs(logs.filter(**log_filter), sampling)
+        rows = rows.annotate(bucket=timebuckets.bucket_expression(bucket_timeframe, tz))
+        rows = rows.values_list('device__pk', 'bucket')
+        rows = rows.annotate(**{f'attr_{i}': aggregate(log_attr_value(attr)) for i, attr in enumerate(attr_list)})
+        return rows.order_by('bucket', 'device__pk')[:max_rows]
+
+    # the logs of each device are on a single shard (see sharding.py), so the rows of the shards are just merged
+    rows = sharding.scatter_logs(set(pk_list), device_buckets)
+    rows = [(row[0], timebuckets.bucket_datetime(row[1], bucket_timeframe, tz)) + row[2:] for row in rows]
+
+    # build the shared time axis and align each device's values to it
+    axis = sorted({row[1] for row in rows})
+    if len(axis) > timebuckets.MAX_BUCKETS:
+        raise Http404(f"Too many buckets (the maximum is {timebuckets.MAX_BUCKETS}), choose a wider timeframe or a "
+                      f"shorter time range")
+    axis_index = {bucket: i for i, bucket in enumerate(axis)}
+    series = {pk: {attr: [None] * len(axis) for attr in attr_list} for pk in pk_list}
+    for row in rows:
+        i = axis_index[row[1]]
+        for attr, value in zip(attr_list, row[2:]):
+            series[row[0]][attr][i] = value
+
+    return devices, attr_list, axis, series, sampling
+
+
+@cached_chart
+@use_read_replica
+@query_guardrails
+def devs_attrs_compare_line_chart(request, timeframe, action, pks, attributes):
+    """Displays attributes' aggregate data of several devices on a shared time axis.
+
+    :param request: An http GET request.
+    :param timeframe: The desired bucket width. Currently supported: see timebuckets.py.
+    :param action: Name of action. Currently supported: min, max, avg.
+    :param pks: Primary keys of devices separated by '&' (ex. pk1&pk2&pk3).
+    :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
+    :return: A rendered google charts' line chart with one line for each device's attribute.
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    devices, attr_list, axis, series, sampling = compare_devs_attrs(request, timeframe, action, pks, attributes)
+
+    # create chart header, one column for each (device, attribute)
+    chart_header = [timeframe]
+    columns = []
+    for pk in series:
+        for attr in attr_list:
+            chart_header.append(f'{action} {attr} [pk:{pk} {devices[pk].serial_number}]')
+            columns.append(series[pk][attr])
+
+    # one row for each bucket of the shared axis
+    chart_points = [[bucket] + [column[i] for column in columns] for i, bucket in enumerate(axis)]
+
+    chart_title = f"Comparison of {action} values for {attr_list} attributes per {timeframe}."
+    if sampling > 1:
+        chart_title += f" Sampled 1 every {sampling} logs."
+
+    # return the rendered webpage
+    return render(request, 'iot_backend/compare_chart.html', {
+        'chart_title': chart_title,
+        'chart_data': chart_json_script(chart_header, chart_points),
+    })
+
+
+@use_read_replica
+@query_guardrails
+def devs_attrs_compare_data(request, timeframe, action, pks, attributes):
+    """Returns attributes' aggregate data of several devices on a shared time axis as JSON.
+
+    :param request: An http GET request.
+    :param timeframe: The desired bucket width. Currently supported: see timebuckets.py.
+    :param action: Name of action. Currently supported: min, max, avg.
+    :param pks: Primary keys of devices separated by '&' (ex. pk1&pk2&pk3).
+    :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
+    :return: JsonResponse with the shared 'axis', the 'series' of values of each device (by pk) and the 'sampling'
+    rate of the logs (see guardrails.py).
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    devices, attr_list, axis, series, sampling = compare_devs_attrs(request, timeframe, action, pks, attributes)
+
+    return JsonResponse({
+        'timeframe': timeframe,
+        'action': action,
+        'attributes': attr_list,
+        'devices': {pk: str(device) for pk, device in devices.items()},
+        'axis': axis,
+        'series': series,
+        'sampling': sampling,
+    })
+
+
+def sharded_fleet_rows(owners, log_filter, group_by, attr_list, sampling):
+    """Computes the rows of fleet_attrs_aggregate_data when the logs are sharded (see sharding.py).
+
+    The shards compute in parallel the partial aggregates (min, max, sum and count) of each attribute per device,
+    which are combined here per group: the logs of a device are all on the same shard.
+
+    :param owners: Dictionary mapping the pk of each device of the fleet to the pk of its owner.
+    :param log_filter: Dictionary of the filters of the logs (time range).
+    :param group_by: Name of the grouping (see FLEET_GROUP_BY) or None.
+    :param attr_list: List of names of the attributes.
+    :param sampling: Sampling rate of the logs (see guardrails.py).
+    :return: The list of rows, with the same keys of the rows computed on a single database.
+    """
+
+    partials = {'logs': Count('pk')}
+    for i, attr in enumerate(attr_list):
+        value = log_attr_value(attr)
+        partials.update({f'min_{i}': Min(value), f'max_{i}': Max(value),
+                         f'sum_{i}': Sum(value), f'count_{i}': Count(value)})
+
+    def device_partials(logs):
+        logs = guardrails.sample_logs(logs.filter(**log_filter), sampling)
+        return logs.values('device__pk').annotate(**partials).order_by()
+
+    device_rows = sharding.scatter_logs(owners, device_partials)
+
+    # without grouping there is always a single row, even if there are no logs
+    groups = {None: []} if group_by is None else {}
+    for device_row in device_rows:
+        device_pk = device_row['device__pk']
+        key = {'device': device_pk, 'owner': owners[device_pk]}.get(group_by)
+        groups.setdefault(key, []).append(device_row)
+
+    rows = []
+    for key in sorted(groups, key=lambda key: (key is None, key)):
+        group_rows = groups[key]
+        row = {FLEET_GROUP_BY[group_by]: key} if group_by is not None else {}
+        row['logs'] = sum(group_row['logs'] for group_row in group_rows)
+        for i in range(len(attr_list)):
+            count = sum(group_row[f'count_{i}'] for group_row in group_rows)
+            row[f'min_{i}'] = min((r[f'min_{i}'] for r in group_rows if r[f'min_{i}'] is not None), default=None)
+            row[f'max_{i}'] = max((r[f'max_{i}'] for r in group_rows if r[f'max_{i}'] is not None), default=None)
+            row[f'avg_{i}'] = sum(r[f'sum_{i}'] or 0 for r in group_rows) / count if count else None
+        rows.append(row)
+
+    return rows
+
+
+@use_read_replica
+@query_guardrails
+def fleet_attrs_aggregate_data(request, actions, attributes):
+    """Returns aggregate data of the specified attributes over all devices of a DeviceType (or a set of them).
+
+    The devices are selected by the GET parameters 'kind', 'model' and 'hw' (at least one of them is required),
+    the logs can be restricted to a time range with the GET parameters 'start' (included) and 'end' (excluded).
+    Results can be grouped per device or per owner with the GET parameter 'group_by' (device, owner).
+    All the statistics are computed by a single query (which PostgreSQL can run with parallel workers), or by one
+    query per shard run in parallel when the logs are sharded (see sharded_fleet_rows).
+
+    Example: /iot/devices/fleetaggregatedata/avg/ta0/?kind=coffee%20machine&model=modelA&start=2020-10-01
+
+    :param request: An http GET request.
+    :param actions: Names of actions separated by '&' (ex. act1&act2&act3). Currently supported: min, max, avg.
+    :param attributes: Names of attributes separated by '&' (ex. attr1&attr2&attr3).
+    :return: JsonResponse with a list of results (a single one if not grouped) and the 'sampling' rate of the logs
+    (see guardrails.py).
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    # get lists of actions and attributes
+    act_list = actions.split('&')
+    attr_list = guardrails.split_attributes(attributes)
+
+    if any(act not in AGGREGATE_FUNCTIONS for act in act_list):
+        raise Http404()
+
+    # validate query parameters
+    group_by = request.GET.get('group_by')
+    type_filter = get_device_type_filter(request, 'device__')
+
+    try:
+        start = get_datetime_param(request, 'start')
+        end = get_datetime_param(request, 'end')
+
+    except ValueError as e:
+        print(e)
+        return HttpResponse(status=400)  # 400 Bad Request
+
+    if not type_filter or (group_by is not None and group_by not in FLEET_GROUP_BY):
+        return HttpResponse(status=400)  # 400 Bad Request
+
+    # select the logs of the fleet
+    log_filter = {}
+    if start is not None:
+        log_filter['reception_datetime__gte'] = start
+    if end is not None:
+        log_filter['reception_datetime__lt'] = end
+    logs = Log.objects.filter(**type_filter, **log_filter)
+
+    # all statistics of all attributes are computed by the same query
+    aggregates = {'logs': Count('pk')}
+    for i, attr in enumerate(attr_list):
+        for act in act_list:
+            aggregates[f'{act}_{i}'] = AGGREGATE_FUNCTIONS[act](log_attr_value(attr))
+
+    # aggregate a sample of the logs if aggregating all of them would exceed the query budget
+    if sharding.log_shards():
+        owners = dict(Device.objects.filter(**get_device_type_filter(request)).values_list('pk', 'owner__pk'))
+        sampling = guardrails.sampling_rate(guardrails.estimate_rows(owners, log_filter), len(attr_list))
+        rows = sharded_fleet_rows(owners, log_filter, group_by, attr_list, sampling)
+
+    else:
+        sampling = guardrails.sampling_rate(guardrails.estimated_count(logs), len(attr_list))
+        logs = guardrails.sample_logs(logs, sampling)
+
+        if group_by is None:
+            rows = [logs.aggregate(**aggregates)]
+        else:
+            group_field = FLEET_GROUP_BY[group_by]
+            rows = logs.values(group_field).annotate(**aggregates).order_by(group_field)
+
+    results = []
+    for row in rows:
+        result = {group_by: row[FLEET_GROUP_BY[group_by]]} if group_by is not None else {}
+        result['logs'] = row['logs']
+        for i, attr in enumerate(attr_list):
+            result[attr] = {act: row[f'{act}_{i}'] for act in act_list}
+        results.append(result)
+
+    return JsonResponse({
+        'type': {param: request.GET[param] for param in ('kind', 'model', 'hw') if param in request.GET},
+        'start': start,
+        'end': end,
+        'group_by': group_by,
+        'sampling': sampling,
+        'results': results,
+    })
+
+
+@use_read_replica
+@query_guardrails
+def devs_latest_values(request):
+    """Returns the latest values of a set of devices, read from the DeviceLatestValues table in a single query.
+
+    The devices are selected by the GET parameters 'kind', 'model', 'hw' (see get_device_type_filter) and/or 'pks'
+    (primary keys separated by '&', to be url encoded as %26, at most settings.IOT_LATEST_MAX_DEVICES), at least one of
+    them is required.
+    The optional GET parameter 'attributes' (separated by '&') restricts the returned values.
+
+    Example: /iot/devices/latest/?kind=coffee%20machine&attributes=ta0%26tb0
+
+    :param request: An http GET request.
+    :return: JsonResponse mapping each device's pk to its latest reception datetime and values.
+    """
+
+    if request.method != 'GET':
+        return HttpResponse(status=405)  # 405 Method Not Allowed
+
+    latest_filter = get_device_type_filter(request, 'device__')
+
+    try:
+        if 'pks' in request.GET:
+            # a single indexed lookup for each device, not bounded by the limit of the analytical views
+            max_devices = getattr(settings, 'IOT_LATEST_MAX_DEVICES', 10000)
+            latest_filter['device__pk__in'] = guardrails.split_pks(request.GET['pks'], max_devices)
+
+    except ValueError:
+        return HttpResponse(status=400)  # 400 Bad Request
+
+    if not latest_filter:
+        return HttpResponse(status=400)  # 400 Bad Request
+
+    attr_list = guardrails.split_attributes(request.GET['attributes']) if 'attributes' in request.GET else None
+
+    devices = {}
+    for latest in DeviceLatestValues.objects.filter(**latest_filter).order_by('device_id'):
+        values = latest.values
+        if attr_list is not None:
+            values = {attr: values.get(attr) for attr in attr_list}
+
+        devices[latest.device_id] = {
+            'reception_datetime': latest.reception_datetime,
+            'values': values,
+        }
+
+    return JsonResponse({
+        'devices': devices,
+    })
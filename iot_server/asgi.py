@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iot_server.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# the live log streams (Server-Sent Events) are served without going through Django's request handling
+from iot_backend.livestream import asgi_application  # noqa: E402 (needs the apps to be loaded)
+
+application = asgi_application(django_application)
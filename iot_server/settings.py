@@ -91,9 +91,36 @@ DATABASES = {
         'PASSWORD': 'password',
         'HOST': 'localhost',
         'PORT': '5432',
-    }
+    },
+    # Example of a read replica (add its alias to IOT_READ_REPLICAS)
+    # 'replica1': {
+    #     'ENGINE': 'django.db.backends.postgresql_psycopg2',
+    #     'NAME': 'iot_db',
+    #     'USER': 'iot_user',
+    #     'PASSWORD': 'password',
+    #     'HOST': 'replica1.local',
+    #     'PORT': '5432',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
+    # Example of a Log shard (add its alias to IOT_LOG_SHARDS and run 'migrate --database=shard1')
+    # 'shard1': {
+    #     'ENGINE': 'django.db.backends.postgresql_psycopg2',
+    #     'NAME': 'iot_logs_1',
+    #     'USER': 'iot_user',
+    #     'PASSWORD': 'password',
+    #     'HOST': 'shard1.local',
+    #     'PORT': '5432',
+    # },
 }
 
+# Store the logs of each device on one of the IOT_LOG_SHARDS (see iot_backend/sharding.py), route the analytical
+# views' reads to the read replicas (see iot_backend/routers.py)
+DATABASE_ROUTERS = ['iot_backend.routers.LogShardRouter', 'iot_backend.routers.ReadReplicaRouter']
+IOT_LOG_SHARDS = []
+IOT_READ_REPLICAS = []
+IOT_REPLICA_MAX_LAG_SECONDS = 30
+IOT_REPLICA_CHECK_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -133,6 +160,61 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# IoT backend
+
+# Strip the keys identifying the device (serial, kind, model, hw) from stored logs, they are implied by 'Log.device'
+IOT_COMPACT_LOG_STORAGE = True
+
+# Seconds between reloads of the alerting rules and between checkpoints of their rolling states (see rules.py)
+IOT_RULES_RELOAD_SECONDS = 60
+IOT_RULES_CHECKPOINT_SECONDS = 60
+
+# Ingest mode of the logs: 'direct' saves them in the request, 'spool' appends them to the spool directory
+# to be saved by the 'ingest_spool' workers (see spool.py)
+IOT_INGEST_MODE = 'direct'
+IOT_SPOOL_DIR = BASE_DIR / 'spool'
+IOT_SPOOL_SEGMENT_BYTES = 64 * 1024 * 1024
+IOT_SPOOL_SEGMENT_SECONDS = 60
+IOT_SPOOL_FSYNC = False
+
+# Seconds between reloads of the compiled data formats used to validate the logs (see validators.py)
+IOT_VALIDATORS_RELOAD_SECONDS = 60
+
+# Seconds the rendered chart pages are cached (0 disables the cache)
+IOT_CHART_CACHE_SECONDS = 0
+
+# Live charts (see livestream.py): disabled by default, each open chart holds a worker thread on WSGI servers
+IOT_STREAM_ENABLED = False
+# Max number of points waiting to be sent to a live chart client, older points are dropped (see livestream.py)
+IOT_STREAM_MAX_PENDING = 100
+# PostgreSQL channel of the notifications of the new logs to the live charts of all the processes
+IOT_STREAM_NOTIFY_CHANNEL = 'iot_logs'
+
+# Max number of logs returned by each call of the incremental line series api
+IOT_SERIES_MAX_ROWS = 1000
+
+# In-memory cache of the recent values of the most read devices (requires numpy, see iot_backend/recentcache.py)
+IOT_RECENT_CACHE_DEVICES = 100
+IOT_RECENT_CACHE_POINTS = 4096
+IOT_RECENT_CACHE_SYNC_SECONDS = 1
+
+# Cost guardrails of the analytical views (see iot_backend/guardrails.py): max attributes and devices per request,
+# max cost (logs * attributes) before sampling the logs, max sampling rate and statement timeout (0 disables it)
+IOT_QUERY_MAX_ATTRIBUTES = 50
+IOT_QUERY_MAX_DEVICES = 100
+IOT_QUERY_COST_BUDGET = 10 ** 7
+IOT_QUERY_MAX_SAMPLING = 1000
+IOT_QUERY_STATEMENT_TIMEOUT_MS = 30000
+# Max devices per request of the latest values (a single indexed lookup for each device, see devs_latest_values)
+IOT_LATEST_MAX_DEVICES = 10000
+
+# Deduplication of the logs delivered more than once (see iot_backend/dedup.py): keys of the log file identifying
+# the message (the first one found is used, logs without any are never deduplicated), seconds each process remembers
+# the seen messages and max messages remembered in each window (about 1.2 MB per million)
+IOT_LOG_MESSAGE_ID_KEYS = ['msg_id', 'ts']
+IOT_DEDUP_WINDOW_SECONDS = 600
+IOT_DEDUP_CAPACITY = 1000000
+
 # Debug toolbar will work only for these IPs
 INTERNAL_IPS = [
     '127.0.0.1',
@@ -0,0 +1,26 @@
+"""
+Production settings for iot_server project.
+
+They extend the development settings (settings.py) removing the debug tooling, which slows down the startup and the
+requests of each worker. Use them with: DJANGO_SETTINGS_MODULE=iot_server.settings_production
+
+See https://docs.djangoproject.com/en/3.1/howto/deployment/checklist/
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import INSTALLED_APPS, MIDDLEWARE, DATABASES, SECRET_KEY
+
+DEBUG = False
+
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', SECRET_KEY)
+
+ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', '*').split(',')
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app != 'debug_toolbar']
+
+MIDDLEWARE = [middleware for middleware in MIDDLEWARE if not middleware.startswith('debug_toolbar.')]
+
+# Keep database connections open between requests
+DATABASES = {alias: dict(database, CONN_MAX_AGE=60) for alias, database in DATABASES.items()}
@@ -0,0 +1,31 @@
+"""
+Test settings for iot_server project.
+
+They extend the development settings (settings.py) with SQLite databases, so the test suite runs without a PostgreSQL
+server: 'default', a read replica mirroring it and two Log shards (the tests enable them with IOT_READ_REPLICAS and
+IOT_LOG_SHARDS).
+Run the tests with: python manage.py test --settings=iot_server.test_settings
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+    },
+    'replica1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'shard1.sqlite3',
+    },
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'shard2.sqlite3',
+    },
+}